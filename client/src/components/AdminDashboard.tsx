@@ -5,6 +5,7 @@ interface StudentAnalytics {
   id: string;
   name: string;
   email: string;
+  avatarUrl?: string | null;
   registeredAt: Date;
   lastActive: Date;
   totalSessions: number;
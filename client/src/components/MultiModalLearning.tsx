@@ -30,9 +30,9 @@ const MultiModalLearning: React.FC<MultiModalLearningProps> = ({ isDarkMode, onI
       const reader = new FileReader();
       reader.onload = (e) => {
         setUploadedImage(e.target?.result as string);
-        analyzeImage(e.target?.result as string);
       };
       reader.readAsDataURL(file);
+      analyzeImage(file);
     }
   };
 
@@ -60,7 +60,9 @@ const MultiModalLearning: React.FC<MultiModalLearningProps> = ({ isDarkMode, onI
       
       const imageData = canvas.toDataURL('image/png');
       setUploadedImage(imageData);
-      analyzeImage(imageData);
+      canvas.toBlob((blob) => {
+        if (blob) analyzeImage(blob);
+      }, 'image/jpeg', 0.9);
       
       // Stop camera
       const stream = video.srcObject as MediaStream;
@@ -69,24 +71,31 @@ const MultiModalLearning: React.FC<MultiModalLearningProps> = ({ isDarkMode, onI
     }
   };
 
-  const analyzeImage = async (imageData: string) => {
+  const analyzeImage = async (image: Blob) => {
     setIsAnalyzing(true);
-    
-    // Simulate AI image analysis
-    setTimeout(() => {
-      const sampleAnalyses = [
-        "I can see a physics diagram showing force vectors. Let me help you understand: What do you think the arrows represent in this diagram?",
-        "This appears to be a mathematical graph. What patterns do you notice in the curve? How might the slope change as x increases?",
-        "I notice this is a chemistry molecular structure. What do you observe about the bonds between atoms? How might this affect the molecule's properties?",
-        "This looks like a circuit diagram. Can you identify the different components? What path do you think the current would take?"
-      ];
-      
-      const randomAnalysis = sampleAnalyses[Math.floor(Math.random() * sampleAnalyses.length)];
-      setAnalysisResult(randomAnalysis);
-      setIsAnalyzing(false);
+
+    // Sent as a multipart upload; the server downscales it before analysis
+    const formData = new FormData();
+    formData.append('image', image, 'image.jpg');
+
+    try {
+      const response = await fetch(`${import.meta.env.VITE_API_URL}/ai/analyze-image/`, {
+        method: 'POST',
+        headers: {
+          'Authorization': `Token ${localStorage.getItem('token')}`,
+        },
+        body: formData
+      });
+      const data = await response.json();
+      const analysis = response.ok ? data.analysis : (data.error || 'Could not analyze this image.');
+      setAnalysisResult(analysis);
       setShowAnalysis(true);
-      onImageAnalysis(randomAnalysis);
-    }, 2000);
+      if (response.ok) onImageAnalysis(analysis);
+    } catch (error) {
+      console.error('Image analysis failed:', error);
+    } finally {
+      setIsAnalyzing(false);
+    }
   };
 
   return (
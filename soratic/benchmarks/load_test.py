@@ -0,0 +1,194 @@
+"""Scripted student sessions against a running server, with a latency report.
+
+Each simulated student registers, opens a conversation, sends --turns chat
+messages and an opening Socratic question, and loads the progress
+dashboard. The report gives p50/p95/p99 latency, throughput and the mean
+database query count per endpoint (from the X-DB-Query-Count header, so
+start the server with QUERY_COUNT_HEADER=True).
+
+To compare the sync and ASGI profiles, run the same load against each,
+with the providers pointed at benchmarks/mock_llm.py and the rate limits
+off so the test measures the server rather than the limits:
+
+    export QUERY_COUNT_HEADER=True RATE_LIMITS_ENABLED=False \\
+        OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock \\
+        NVIDIA_BASE_URL=http://127.0.0.1:8100/v1 NVIDIA_API_KEY=mock
+    gunicorn --config gunicorn.conf.py soratic.wsgi:application
+    python benchmarks/load_test.py --students 50 --concurrency 25 --json sync.json
+    gunicorn --config gunicorn.asgi.conf.py soratic.asgi:application
+    python benchmarks/load_test.py --students 50 --concurrency 25 --json asgi.json
+    python benchmarks/load_test.py --compare sync.json asgi.json
+"""
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import time
+import uuid
+import httpx
+
+QUESTIONS = [
+    "Why does a heavier ball not fall faster?",
+    "What is the difference between a list and a tuple?",
+    "How do I know which way friction points?",
+    "Why does my loop never stop?",
+]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.started = time.monotonic()
+        self.finished = None
+
+    def add(self, endpoint, status, seconds, queries):
+        self.samples.setdefault(endpoint, []).append((status, seconds, queries))
+
+    def report(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds for status, seconds, queries in samples)
+            queries = [queries for status, seconds, queries in samples if queries is not None]
+            statuses = {}
+            for status, seconds, q in samples:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'statuses': statuses,
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                'requests_per_second': round(len(samples) / elapsed, 2),
+                'mean_queries': round(statistics.mean(queries), 2) if queries else None,
+            }
+        total = sum(endpoint['requests'] for endpoint in endpoints.values())
+        return {'elapsed_seconds': round(elapsed, 2), 'requests': total,
+                'requests_per_second': round(total / elapsed, 2), 'endpoints': endpoints}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def endpoint_name(method, path):
+    # Collapse ids so every conversation counts as one endpoint
+    path = re.sub(r'/(\d+|[0-9a-f]{8}-[0-9a-f-]{27})(?=/)', '/<id>', path)
+    return f"{method} {path}"
+
+
+async def call(client, recorder, method, path, token=None, **kwargs):
+    headers = {'Authorization': f'Token {token}'} if token else {}
+    started = time.monotonic()
+    try:
+        response = await client.request(method, path, headers=headers, **kwargs)
+    except httpx.HTTPError:
+        recorder.add(endpoint_name(method, path), 'error', time.monotonic() - started, None)
+        return None
+    queries = response.headers.get('X-DB-Query-Count')
+    recorder.add(endpoint_name(method, path), response.status_code, time.monotonic() - started,
+                 int(queries) if queries is not None else None)
+    return response
+
+
+async def student_session(client, recorder, run_id, number, subject_id, turns):
+    username = f"bench-{run_id}-{number}"
+    response = await call(client, recorder, 'POST', '/api/auth/register/',
+                          json={'username': username, 'password': 'bench-password', 'email': f'{username}@example.com'})
+    if response is None or response.status_code != 200:
+        return
+    token = response.json()['token']
+
+    response = await call(client, recorder, 'POST', '/api/conversations/create/', token, json={'subject_id': subject_id})
+    if response is None or response.status_code != 200:
+        return
+    conversation_id = response.json()['id']
+
+    for turn in range(turns):
+        await call(client, recorder, 'POST', f'/api/conversations/{conversation_id}/chat/', token,
+                   json={'message': QUESTIONS[(number + turn) % len(QUESTIONS)]})
+
+    await call(client, recorder, 'POST', '/api/socratic-response/', token,
+               json={'message': QUESTIONS[number % len(QUESTIONS)], 'subject': 'physics'})
+    await call(client, recorder, 'GET', '/api/progress/dashboard/', token)
+
+
+async def run(options):
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=options.concurrency, max_keepalive_connections=options.concurrency)
+    async with httpx.AsyncClient(base_url=options.url, timeout=options.timeout, limits=limits) as client:
+        # Any user can list subjects; register one just for that
+        run_id = uuid.uuid4().hex[:8]
+        setup = Recorder()
+        response = await call(client, setup, 'POST', '/api/auth/register/',
+                              json={'username': f'bench-{run_id}-setup', 'password': 'bench-password'})
+        response.raise_for_status()
+        subjects = await call(client, setup, 'GET', '/api/subjects/', response.json()['token'])
+        subjects.raise_for_status()
+        if not subjects.json():
+            raise SystemExit("No subjects: run `manage.py load_subjects` first")
+        subject_id = subjects.json()[0]['id']
+
+        semaphore = asyncio.Semaphore(options.concurrency)
+
+        async def limited(number):
+            async with semaphore:
+                await student_session(client, recorder, run_id, number, subject_id, options.turns)
+
+        recorder.started = time.monotonic()
+        await asyncio.gather(*(limited(number) for number in range(options.students)))
+        recorder.finished = time.monotonic()
+    return recorder.report()
+
+
+def print_report(report, label=''):
+    print(f"{label}{report['requests']} requests in {report['elapsed_seconds']}s "
+          f"({report['requests_per_second']} req/s)")
+    print(f"{'endpoint':48} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>7} {'queries':>8}  statuses")
+    for endpoint, row in report['endpoints'].items():
+        queries = '' if row['mean_queries'] is None else row['mean_queries']
+        print(f"{endpoint:48} {row['requests']:>5} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9} "
+              f"{row['requests_per_second']:>7} {queries:>8}  {row['statuses']}")
+
+
+def compare(paths):
+    reports = [(path, json.load(open(path))) for path in paths]
+    for path, report in reports:
+        print_report(report, f"{path}: ")
+        print()
+    base_path, base = reports[0]
+    for path, report in reports[1:]:
+        print(f"{path} vs {base_path} (p95, lower is better)")
+        for endpoint, row in report['endpoints'].items():
+            other = base['endpoints'].get(endpoint)
+            if other and other['p95_ms']:
+                print(f"  {endpoint:48} {other['p95_ms']:>9} -> {row['p95_ms']:>9} ms "
+                      f"({row['p95_ms'] / other['p95_ms']:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--students', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=10, help='Students in session at once')
+    parser.add_argument('--turns', type=int, default=3, help='Chat turns per student')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', help='Also write the report to this file')
+    parser.add_argument('--compare', nargs='+', metavar='REPORT', help='Compare saved JSON reports instead of running')
+    options = parser.parse_args()
+
+    if options.compare:
+        return compare(options.compare)
+    report = asyncio.run(run(options))
+    print_report(report)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
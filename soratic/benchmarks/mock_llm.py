@@ -0,0 +1,121 @@
+"""OpenAI-compatible mock LLM server for load tests.
+
+Serves ``POST /v1/chat/completions`` (plain and ``stream: true``) with a
+Socratic-sounding reply, after a configurable first-token latency and at a
+configurable token rate, and fails a configurable share of requests. Point a
+provider at it instead of a paid model:
+
+    python benchmarks/mock_llm.py --port 8100 --latency 0.8 --tokens-per-second 40
+
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock \\
+    NVIDIA_BASE_URL=http://127.0.0.1:8100/v1 NVIDIA_API_KEY=mock \\
+    gunicorn --config gunicorn.conf.py soratic.wsgi:application
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = ("That's a good place to start. What do you already know about this, and what would "
+         "you expect to happen if you changed one thing at a time? Try to explain your reasoning "
+         "step by step, then tell me which step you feel least sure about.")
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+    counters = {'requests': 0, 'failures': 0}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.lock:
+                return self._send_json(200, dict(self.counters))
+        self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': 'Not found'}})
+
+        with self.lock:
+            self.counters['requests'] += 1
+        time.sleep(max(0.0, random.gauss(self.options.latency, self.options.jitter)))
+        if random.random() < self.options.failure_rate:
+            with self.lock:
+                self.counters['failures'] += 1
+            return self._send_json(503, {'error': {'message': 'Injected failure', 'type': 'server_error'}})
+
+        words = REPLY.split(' ')[:self.options.reply_tokens]
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 4
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                 'total_tokens': prompt_tokens + len(words)}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get('model', 'mock')
+        created = int(time.time())
+
+        if not body.get('stream'):
+            time.sleep(len(words) / self.options.tokens_per_second)
+            return self._send_json(200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                'usage': usage,
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for i, word in enumerate(words):
+            time.sleep(1 / self.options.tokens_per_second)
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                     'choices': [{'index': 0, 'finish_reason': None,
+                                  'delta': {'content': word if i == 0 else ' ' + word}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        final = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                 'choices': [{'index': 0, 'finish_reason': 'stop', 'delta': {}}], 'usage': usage}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds before the first token')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Standard deviation of the latency')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--reply-tokens', type=int, default=40, help='Words per reply')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered with a 503')
+    options = parser.parse_args()
+
+    MockLLMHandler.options = options
+    server = ThreadingHTTPServer((options.host, options.port), MockLLMHandler)
+    server.daemon_threads = True
+    print(f"Mock LLM listening on http://{options.host}:{options.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
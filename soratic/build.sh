@@ -9,9 +9,13 @@ pip install -r requirements.txt
 cd ../client
 npm ci
 npm run build
+# Pre-compressed index.html.gz/.br for serve_react
+python -m whitenoise.compress dist
 cd ../soratic
 
 # Django setup
 python manage.py collectstatic --no-input
 python manage.py migrate
-python manage.py load_subjects
\ No newline at end of file
+python manage.py load_subjects
+# Real pathway and exercise rows, so attempts have something to grade against
+python manage.py create_sample_data
@@ -0,0 +1,29 @@
+# ASGI deployment profile for the LLM-bound endpoints.
+#
+# The chat, socratic-response and session-summary views are native async
+# views. Under the sync profile (gunicorn.conf.py) each in-flight model call
+# still pins one of the three workers; under uvicorn workers they only hold
+# an await, so a single process can keep hundreds of calls in flight.
+#
+#   gunicorn --config gunicorn.asgi.conf.py soratic.asgi:application
+#
+# Sync DRF views keep working: Django runs them in a thread pool. Keep the
+# worker count low (roughly one per core) and size the DB pool for the
+# thread pool rather than for concurrent LLM calls.
+bind = "127.0.0.1:8000"
+workers = 2
+worker_class = "uvicorn.workers.UvicornWorker"
+max_requests = 1000
+max_requests_jitter = 100
+# Streaming chat responses stay open for the whole completion
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_worker_init(worker):
+    # Start the exercise sandbox pool before the first submission needs it
+    from django.conf import settings
+    if settings.EXERCISE_SANDBOX['PREFORK']:
+        from tutor.grader import get_evaluator_pool
+        get_evaluator_pool().start()
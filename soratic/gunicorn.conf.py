@@ -5,4 +5,11 @@ worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 100
 timeout = 30
-keepalive = 2
\ No newline at end of file
+keepalive = 2
+
+def post_worker_init(worker):
+    # Start the exercise sandbox pool before the first submission needs it
+    from django.conf import settings
+    if settings.EXERCISE_SANDBOX['PREFORK']:
+        from tutor.grader import get_evaluator_pool
+        get_evaluator_pool().start()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 
@@ -50,6 +51,7 @@ INSTALLED_APPS = [
     'tutor',
 ]
 MIDDLEWARE = [
+    'tutor.middleware.QueryCountMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -61,6 +63,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Report each response's database query count in an X-DB-Query-Count
+# header (for the benchmarks in benchmarks/)
+QUERY_COUNT_HEADER = os.getenv('QUERY_COUNT_HEADER', 'False').lower() == 'true'
+
 ROOT_URLCONF = 'soratic.urls'
 
 TEMPLATES = [
@@ -150,10 +156,27 @@ STATICFILES_DIRS = [
     BASE_DIR / 'client' / 'dist' / 'assets',
 ]
 
+# The React shell served at / (tutor.views.serve_react). It must be
+# revalidated on every load so a deploy shows up at once; the hashed assets
+# it points to are cached for good by WhiteNoise.
+SPA_INDEX_PATH = os.getenv('SPA_INDEX_PATH', str(BASE_DIR / 'client' / 'dist' / 'index.html'))
+SPA_CACHE_CONTROL = os.getenv('SPA_CACHE_CONTROL', 'no-cache')
+
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Profile picture variants (tutor/avatars.py). Their paths are content
+# hashes, so the web server can serve MEDIA_URL + 'avatars/' with
+# "Cache-Control: public, max-age=31536000, immutable".
+AVATAR = {
+    'SIZES': [64, 128, 256],
+    'FORMATS': ['webp', 'jpeg'],
+    'QUALITY': int(os.getenv('AVATAR_QUALITY', '82')),
+    'MAX_UPLOAD_BYTES': int(os.getenv('AVATAR_MAX_UPLOAD_BYTES', str(5 * 1024 * 1024))),
+    'MAX_PIXELS': int(os.getenv('AVATAR_MAX_PIXELS', str(40_000_000))),
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -174,8 +197,200 @@ if DEBUG:
 
 CORS_ALLOW_CREDENTIALS = True
 
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'tutor.auth.CachedTokenAuthentication',
+    ],
+}
+
+# Authenticated tokens are cached per process for TOKEN_AUTH_CACHE_TTL
+# seconds. Deleting a token or saving/deleting its user evicts it at once
+# in the process that made the change; other workers see it at expiry.
+TOKEN_AUTH_CACHE_TTL = int(os.getenv('TOKEN_AUTH_CACHE_TTL', '60'))
+TOKEN_AUTH_CACHE_MAX_ENTRIES = int(os.getenv('TOKEN_AUTH_CACHE_MAX_ENTRIES', '10000'))
+
+# Admin dashboard student pages are cached for this long at most; student,
+# conversation, message and progress changes invalidate them sooner. LLM
+# usage figures on those pages can lag by up to this long.
+ADMIN_STUDENTS_CACHE_TTL = int(os.getenv('ADMIN_STUDENTS_CACHE_TTL', '60'))
+
+# How often each process checks the database for subject changes made
+# elsewhere (tutor/catalog.py); saves in the same process apply at once.
+SUBJECT_CATALOG_RECHECK_SECONDS = float(os.getenv('SUBJECT_CATALOG_RECHECK_SECONDS', '10'))
+
+# Progress time counts the gap between a student's messages in a subject
+# when it is shorter than this; longer gaps start a new study session.
+ACTIVITY_SESSION_GAP_MINUTES = int(os.getenv('ACTIVITY_SESSION_GAP_MINUTES', '30'))
+
+# Sandbox for grading exercise answers against their test cases
+# (tutor/grader.py). WORKERS warm processes per server process, started by
+# the gunicorn hooks when PREFORK is on; each test case gets CPU_SECONDS of
+# CPU, WALL_SECONDS of wall time, MEMORY_MB of memory and OUTPUT_BYTES of
+# output. Grades are cached for RESULT_TTL seconds per exact answer.
+EXERCISE_SANDBOX = {
+    'WORKERS': int(os.getenv('EXERCISE_SANDBOX_WORKERS', '2')),
+    'PREFORK': os.getenv('EXERCISE_SANDBOX_PREFORK', 'True').lower() == 'true',
+    'MAX_TASKS_PER_WORKER': int(os.getenv('EXERCISE_SANDBOX_MAX_TASKS', '500')),
+    'CPU_SECONDS': int(os.getenv('EXERCISE_SANDBOX_CPU_SECONDS', '2')),
+    'WALL_SECONDS': float(os.getenv('EXERCISE_SANDBOX_WALL_SECONDS', '5')),
+    'MEMORY_MB': int(os.getenv('EXERCISE_SANDBOX_MEMORY_MB', '256')),
+    'OUTPUT_BYTES': int(os.getenv('EXERCISE_SANDBOX_OUTPUT_BYTES', '65536')),
+    'QUEUE_TIMEOUT': float(os.getenv('EXERCISE_SANDBOX_QUEUE_TIMEOUT', '10')),
+    'CACHE_ALIAS': 'default',
+    'RESULT_TTL': int(os.getenv('EXERCISE_SANDBOX_RESULT_TTL', '86400')),
+}
+
+# Image analysis (tutor/vision.py): uploads up to MAX_UPLOAD_BYTES and
+# MAX_PIXELS are downscaled to MAX_DIMENSION on DECODE_WORKERS threads
+# before going to LLM_VISION_PROVIDER; analyses are cached per image hash.
+IMAGE_ANALYSIS = {
+    'MAX_UPLOAD_BYTES': int(os.getenv('IMAGE_ANALYSIS_MAX_UPLOAD_BYTES', str(10 * 1024 * 1024))),
+    'MAX_PIXELS': int(os.getenv('IMAGE_ANALYSIS_MAX_PIXELS', str(50_000_000))),
+    'MAX_DIMENSION': int(os.getenv('IMAGE_ANALYSIS_MAX_DIMENSION', '1024')),
+    'JPEG_QUALITY': int(os.getenv('IMAGE_ANALYSIS_JPEG_QUALITY', '85')),
+    'DETAIL': os.getenv('IMAGE_ANALYSIS_DETAIL', 'auto'),
+    'DECODE_WORKERS': int(os.getenv('IMAGE_ANALYSIS_DECODE_WORKERS', '2')),
+    'CACHE_ALIAS': 'default',
+    'TTL': int(os.getenv('IMAGE_ANALYSIS_TTL', '86400')),
+}
+
 # API Keys
 NVIDIA_API_KEY = os.getenv('NVIDIA_API_KEY')
 
+# LLM providers. Each provider gets one pooled keep-alive client per
+# process (see tutor/llm.py); per-provider entries may override the
+# timeout and pool settings below.
+LLM_PROVIDERS = {
+    'nvidia': {
+        'base_url': os.getenv('NVIDIA_BASE_URL', 'https://integrate.api.nvidia.com/v1'),
+        'api_key': NVIDIA_API_KEY,
+        'model': os.getenv('NVIDIA_MODEL', 'meta/llama-3.1-405b-instruct'),
+    },
+    'openai': {
+        'base_url': os.getenv('OPENAI_BASE_URL'),
+        'api_key': os.getenv('OPENAI_API_KEY'),
+        'model': os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo'),
+    },
+    'openai_vision': {
+        'base_url': os.getenv('OPENAI_BASE_URL'),
+        'api_key': os.getenv('OPENAI_API_KEY'),
+        'model': os.getenv('OPENAI_VISION_MODEL', 'gpt-4o-mini'),
+    },
+    'stub': {
+        'stub': True,
+        'model': 'stub',
+    },
+}
+LLM_CHAT_PROVIDER = os.getenv('LLM_CHAT_PROVIDER', 'openai')
+LLM_SOCRATIC_PROVIDER = os.getenv('LLM_SOCRATIC_PROVIDER', 'nvidia')
+LLM_SUMMARY_PROVIDER = os.getenv('LLM_SUMMARY_PROVIDER', 'nvidia')
+LLM_VISION_PROVIDER = os.getenv('LLM_VISION_PROVIDER', 'openai_vision')
+
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '30'))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '1'))
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '100'))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('LLM_MAX_KEEPALIVE_CONNECTIONS', '20'))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv('LLM_KEEPALIVE_EXPIRY', '60'))
+
+# Circuit breaker per provider (tutor/breaker.py): once at least MIN_CALLS
+# calls in the last WINDOW seconds include FAILURE_RATE errors or calls
+# slower than SLOW_CALL_SECONDS, the provider is skipped for RESET_TIMEOUT
+# seconds.
+LLM_BREAKER = {
+    'WINDOW': float(os.getenv('LLM_BREAKER_WINDOW', '60')),
+    'MIN_CALLS': int(os.getenv('LLM_BREAKER_MIN_CALLS', '5')),
+    'FAILURE_RATE': float(os.getenv('LLM_BREAKER_FAILURE_RATE', '0.5')),
+    'SLOW_CALL_SECONDS': float(os.getenv('LLM_BREAKER_SLOW_CALL_SECONDS', '10')),
+    'RESET_TIMEOUT': float(os.getenv('LLM_BREAKER_RESET_TIMEOUT', '30')),
+}
+# Backup provider for Socratic answers, used while the primary's circuit is
+# open or when it fails. With LLM_HEDGE_AFTER > 0 the backup is also asked
+# once the primary has been silent that many seconds. Empty disables both.
+LLM_SOCRATIC_BACKUP_PROVIDER = os.getenv('LLM_SOCRATIC_BACKUP_PROVIDER', '')
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', '0'))
+
+# Identical Socratic prompts in flight at the same time share one upstream
+# call (tutor/singleflight.py). Set CACHE_ALIAS to a cache every worker
+# shares to coalesce across workers too; LOCK_TIMEOUT bounds how long a
+# request waits on another worker's call.
+SINGLE_FLIGHT = {
+    'ENABLED': os.getenv('SINGLE_FLIGHT_ENABLED', 'True').lower() == 'true',
+    'CACHE_ALIAS': os.getenv('SINGLE_FLIGHT_CACHE_ALIAS') or None,
+    'LOCK_TIMEOUT': float(os.getenv('SINGLE_FLIGHT_LOCK_TIMEOUT', '30')),
+    'POLL_INTERVAL': float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', '0.05')),
+    'RESULT_TTL': int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '10')),
+}
+
+# USD per 1K (prompt, completion) tokens, for the cost column of the LLM
+# usage ledger. Models missing here are recorded at zero cost; add or
+# override entries with a JSON object in LLM_PRICING_JSON.
+LLM_PRICING = {
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+    'gpt-4o-mini': (0.00015, 0.0006),
+    **json.loads(os.getenv('LLM_PRICING_JSON', '{}')),
+}
+
+# Token buckets for chat and Socratic calls, in LLM tokens (tutor/usage.py).
+# Each user's bucket holds USER_CAPACITY tokens and refills at
+# USER_REFILL_PER_SECOND; the global bucket caps everyone together. The
+# 'memory' backend limits per worker process; 'cache' shares the buckets
+# through CACHE_ALIAS, which should then be a cache every worker uses.
+RATE_LIMITS = {
+    'ENABLED': os.getenv('RATE_LIMITS_ENABLED', 'True').lower() == 'true',
+    'BACKEND': os.getenv('RATE_LIMITS_BACKEND', 'memory'),
+    'CACHE_ALIAS': os.getenv('RATE_LIMITS_CACHE_ALIAS', 'default'),
+    'USER_CAPACITY': int(os.getenv('RATE_LIMIT_USER_CAPACITY', '20000')),
+    'USER_REFILL_PER_SECOND': float(os.getenv('RATE_LIMIT_USER_REFILL', '100')),
+    'GLOBAL_CAPACITY': int(os.getenv('RATE_LIMIT_GLOBAL_CAPACITY', '500000')),
+    'GLOBAL_REFILL_PER_SECOND': float(os.getenv('RATE_LIMIT_GLOBAL_REFILL', '5000')),
+}
+
+# Micro-batching for summary calls (tutor/batching.py): requests gather for
+# up to MAX_WAIT seconds or MAX_BATCH requests, go out at most
+# MAX_CONCURRENCY at a time, and wait up to MAX_DEFER seconds while
+# YIELD_ABOVE or more chat/Socratic calls are in flight.
+BATCHING = {
+    'ENABLED': os.getenv('BATCHING_ENABLED', 'True').lower() == 'true',
+    'MAX_BATCH': int(os.getenv('BATCHING_MAX_BATCH', '8')),
+    'MAX_WAIT': float(os.getenv('BATCHING_MAX_WAIT', '0.2')),
+    'MAX_CONCURRENCY': int(os.getenv('BATCHING_MAX_CONCURRENCY', '4')),
+    'YIELD_ABOVE': int(os.getenv('BATCHING_YIELD_ABOVE', '8')),
+    'MAX_DEFER': float(os.getenv('BATCHING_MAX_DEFER', '5')),
+}
+
+# Conversation context sent with each chat turn: at most CONTEXT_MAX_MESSAGES
+# recent messages, trimmed further to fit the subject's token budget.
+CONTEXT_MAX_MESSAGES = int(os.getenv('CONTEXT_MAX_MESSAGES', '20'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+
+# Rolling session summaries: once ROLLING_SUMMARY_TURNS turns have piled up
+# beyond the newest ROLLING_SUMMARY_KEEP_MESSAGES messages, they are folded
+# into SessionSummary.ai_summary in the background. 0 turns disables it.
+ROLLING_SUMMARY_TURNS = int(os.getenv('ROLLING_SUMMARY_TURNS', '4'))
+ROLLING_SUMMARY_KEEP_MESSAGES = int(os.getenv('ROLLING_SUMMARY_KEEP_MESSAGES', '8'))
+
+# Background jobs (tutor/jobs.py, run by `manage.py run_tutor_worker`).
+# A running job whose worker hasn't finished it within JOB_LOCK_TIMEOUT
+# seconds is assumed dead and handed to another worker.
+JOB_LOCK_TIMEOUT = int(os.getenv('JOB_LOCK_TIMEOUT', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+
+# Cache of first-turn Socratic answers (tutor/response_cache.py).
+# BACKEND is 'memory' (per process), 'file' (per host, under PATH) or
+# 'django' (the CACHE_ALIAS cache, e.g. Redis). A SIMILARITY_THRESHOLD
+# between 0 and 1 also serves near-identical questions; 0 disables that.
+RESPONSE_CACHE = {
+    'ENABLED': os.getenv('RESPONSE_CACHE_ENABLED', 'True').lower() == 'true',
+    'BACKEND': os.getenv('RESPONSE_CACHE_BACKEND', 'memory'),
+    'TTL': int(os.getenv('RESPONSE_CACHE_TTL', '86400')),
+    'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '2000')),
+    'PATH': os.getenv('RESPONSE_CACHE_PATH', str(BASE_DIR / 'cache' / 'responses')),
+    'CACHE_ALIAS': 'default',
+    'SIMILARITY_THRESHOLD': float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.9')),
+    'INDEX_SIZE': int(os.getenv('RESPONSE_CACHE_INDEX_SIZE', '200')),
+    'EMBEDDER': None,
+}
+
 # Pillow for ImageField
 INSTALLED_APPS += ['PIL'] if 'PIL' not in INSTALLED_APPS else []
@@ -1,15 +1,20 @@
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from rest_framework.authtoken.models import Token
 from .models import Conversation, Message, UserProgress
+from .auth import token_cache
+from .response_cache import get_response_cache
+from .breaker import breaker_stats
+from .singleflight import get_single_flight
+from .usage import get_rate_limiter
+from .batching import batching_stats
+from .grader import get_evaluator_pool
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def admin_create_student(request):
     try:
@@ -46,7 +51,6 @@ def admin_create_student(request):
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['DELETE'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def admin_delete_student(request, student_id):
     try:
@@ -59,7 +63,6 @@ def admin_delete_student(request, student_id):
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['PUT'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def admin_update_student(request, student_id):
     try:
@@ -87,4 +90,18 @@ def admin_update_student(request, student_id):
     except User.DoesNotExist:
         return Response({'error': 'Student not found'}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def admin_metrics(request):
+    # Per-process figures: each worker reports its own caches
+    return Response({
+        'auth_cache': token_cache.stats(),
+        'response_cache': get_response_cache().stats(),
+        'llm_breakers': breaker_stats(),
+        'single_flight': get_single_flight().stats(),
+        'rate_limits': get_rate_limiter().stats(),
+        'batching': batching_stats(),
+        'exercise_sandbox': get_evaluator_pool().stats(),
+    })
@@ -1,20 +1,40 @@
 from rest_framework import status
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
-from openai import OpenAI
-import os
+import asyncio
+import json
+import time
+from asgiref.sync import sync_to_async
 from dotenv import load_dotenv
 from datetime import timedelta
 from django.utils import timezone
-from .models import Subject, Conversation, Message, UserProfile, LearningPathway, Exercise, UserProgress, SessionSummary
-from .serializers import (UserSerializer, SubjectSerializer, ConversationSerializer, MessageSerializer,
+from django.utils.dateparse import parse_datetime
+from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Substr
+from django.http import JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from .models import Conversation, Message, UserProfile, LearningPathway, Exercise, UserProgress, SessionSummary, Job
+from .serializers import (UserSerializer, SubjectSerializer, ConversationSerializer, ConversationListSerializer, MessageSerializer,
                          LearningPathwaySerializer, ExerciseSerializer, ExerciseWithSolutionSerializer,
                          UserProgressSerializer, SessionSummarySerializer)
+from .auth import async_api_view
+from .llm import get_model
+from .breaker import acomplete, acomplete_stream, complete_stream
+from .context import abuild_context, clean_history, fit_to_budget, token_budget
+from .summaries import schedule_rolling_summary
+from .response_cache import get_response_cache
+from .singleflight import flight_key, get_single_flight
+from .usage import RateLimited, get_rate_limiter, estimate_tokens, record, arecord, rate_limited_response
+from .pagination import ConversationCursorPagination
+from .jobs import aenqueue, job_accepted, serialize_job
+from .catalog import DEFAULT_SYSTEM_PROMPT, aget_catalog, get_catalog
+from .turns import DEFAULT_TITLE, asave_turn, save_turn, serialize_turn
+from .avatars import InvalidAvatar, avatar_urls, store_avatar, variant_path
 
 load_dotenv()
 
@@ -57,163 +77,370 @@ def login_user(request):
 
 # Protected API endpoints (require token authentication)
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_subjects(request):
-    subjects = Subject.objects.all()
-    serializer = SubjectSerializer(subjects, many=True)
-    return Response(serializer.data)
+    # Served from the in-process catalog; unchanged lists are answered with a 304
+    catalog = get_catalog()
+    if catalog.etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(catalog.data)
+    response['ETag'] = catalog.etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_conversations(request):
-    conversations = Conversation.objects.filter(user=request.user).order_by('-created_at')
-    serializer = ConversationSerializer(conversations, many=True)
-    return Response(serializer.data)
+    # One query per page: the subject is joined and the message count and
+    # last-message preview are annotated. Full transcripts stay on get_conversation.
+    latest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-timestamp', '-id')
+    conversations = (Conversation.objects.filter(user=request.user)
+                     .select_related('subject')
+                     .annotate(message_count=Count('messages'),
+                               last_message=Subquery(latest.annotate(preview=Substr('content', 1, 100)).values('preview')[:1]),
+                               last_message_at=Subquery(latest.values('timestamp')[:1])))
+    paginator = ConversationCursorPagination()
+    page = paginator.paginate_queryset(conversations, request)
+    serializer = ConversationListSerializer(page, many=True)
+    return paginator.get_paginated_response(serializer.data)
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def create_conversation(request):
-    subject_id = request.data.get('subject_id')
-    try:
-        subject = Subject.objects.get(id=subject_id)
-        conversation = Conversation.objects.create(
-            user=request.user,
-            subject=subject,
-            title="New Conversation"
-        )
-        serializer = ConversationSerializer(conversation)
-        return Response(serializer.data)
-    except Subject.DoesNotExist:
+    subject = get_catalog().get(request.data.get('subject_id'))
+    if subject is None:
         return Response({'error': 'Subject not found'}, status=status.HTTP_404_NOT_FOUND)
+    conversation = Conversation.objects.create(
+        user=request.user,
+        subject=subject,
+        title=DEFAULT_TITLE
+    )
+    serializer = ConversationSerializer(conversation)
+    return Response(serializer.data)
+
+MESSAGE_SYNC_LIMIT = 200
+
+def _conversation_etag(conversation_id, version):
+    return f'"conversation-{conversation_id}-v{version}"'
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_conversation(request, conversation_id):
     try:
         conversation = Conversation.objects.get(id=conversation_id, user=request.user)
         serializer = ConversationSerializer(conversation)
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        response['ETag'] = _conversation_etag(conversation.id, conversation.version)
+        return response
     except Conversation.DoesNotExist:
         return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
 
-@api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@api_view(['GET'])
 @permission_classes([IsAuthenticated])
-def get_ai_response(request, conversation_id):
+def get_conversation_messages(request, conversation_id):
+    # Messages newer than the client's cursor: ?after=<message id> or ?since=<ISO timestamp>.
+    # The ETag follows Conversation.version, which every saved turn bumps, so a
+    # client that is up to date gets a 304 after a single query.
+    conversation = (Conversation.objects.filter(id=conversation_id, user=request.user)
+                    .values('id', 'title', 'version').first())
+    if conversation is None:
+        return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+    etag = _conversation_etag(conversation['id'], conversation['version'])
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
+    
+    messages = Message.objects.filter(conversation_id=conversation['id'])
+    after = None
     try:
-        conversation = Conversation.objects.get(id=conversation_id, user=request.user)
+        if request.GET.get('after'):
+            after = int(request.GET['after'])
+            messages = messages.filter(id__gt=after)
+        if request.GET.get('since'):
+            since = parse_datetime(request.GET['since'])
+            if since is None:
+                raise ValueError(request.GET['since'])
+            messages = messages.filter(timestamp__gt=since)
+        limit = max(1, min(int(request.GET.get('limit', MESSAGE_SYNC_LIMIT)), MESSAGE_SYNC_LIMIT))
+    except ValueError:
+        return Response({'error': 'after and limit must be integers and since an ISO timestamp'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    
+    # One extra row tells whether the client needs to ask again
+    page = list(messages.order_by('timestamp', 'id')[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    response = Response({
+        'conversation_id': conversation['id'],
+        'title': conversation['title'],
+        'version': conversation['version'],
+        'messages': MessageSerializer(page, many=True).data,
+        'cursor': page[-1].id if page else after,
+        'has_more': has_more,
+    })
+    # A partial page is not the whole change, so it gets no ETag to revalidate against
+    if not has_more:
+        response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _wants_stream(request):
+    if str(request.data.get('stream', '')).lower() in ('1', 'true'):
+        return True
+    return 'text/event-stream' in request.META.get('HTTP_ACCEPT', '')
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _save_streamed_turn(conversation, user_message, messages_for_ai, chunks, finished, failed, usage, latency,
+                        reserved):
+    # Runs however the stream ended. A provider that failed before sending
+    # anything leaves nothing to keep; otherwise the question is saved with
+    # whatever reply arrived, marked partial unless the stream finished.
+    if failed and not chunks:
+        get_rate_limiter().settle(conversation.user_id, -reserved)
+        return None
+    turn = [('user', user_message)] + ([('assistant', ''.join(chunks))] if chunks else [])
+    messages = save_turn(conversation, *turn, partial=not finished)
+    record(conversation.user_id, 'chat', get_model(settings.LLM_CHAT_PROVIDER), usage, messages_for_ai,
+           ''.join(chunks), latency, reserved)
+    schedule_rolling_summary(conversation.id)
+    return messages
+
+def _stream_end(conversation, messages, error):
+    # The last event: 'done' with the saved turn, or 'error', with the turn
+    # if a partial reply was saved
+    if error is None:
+        return _sse('done', serialize_turn(conversation, messages))
+    if messages is None:
+        return _sse('error', {'error': error})
+    return _sse('error', dict(serialize_turn(conversation, messages), error=error))
+
+def _stream_ai_response(conversation, user_message, messages_for_ai, reserved):
+    # Relay tokens as they arrive and persist the turn once the stream ends,
+    # also when the client goes away mid-reply (GeneratorExit at a yield)
+    chunks = []
+    usage = None
+    error = None
+    finished = False
+    messages = None
+    started = time.monotonic()
+    try:
+        for chunk in complete_stream(settings.LLM_CHAT_PROVIDER, messages=messages_for_ai, temperature=0.7):
+            usage = getattr(chunk, 'usage', None) or usage
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                chunks.append(token)
+                yield _sse('token', {'content': token})
+        finished = True
+    except Exception as e:
+        error = str(e)
+    finally:
+        messages = _save_streamed_turn(conversation, user_message, messages_for_ai, chunks, finished, error is not None,
+                                       usage, time.monotonic() - started, reserved)
+    yield _stream_end(conversation, messages, error)
+
+async def _astream_ai_response(conversation, user_message, messages_for_ai, reserved):
+    # Same as _stream_ai_response, for ASGI servers; the save is shielded so
+    # a cancelled response still finishes it
+    chunks = []
+    usage = None
+    error = None
+    finished = False
+    messages = None
+    started = time.monotonic()
+    try:
+        async for chunk in acomplete_stream(settings.LLM_CHAT_PROVIDER, messages=messages_for_ai, temperature=0.7):
+            usage = getattr(chunk, 'usage', None) or usage
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                chunks.append(token)
+                yield _sse('token', {'content': token})
+        finished = True
+    except Exception as e:
+        error = str(e)
+    finally:
+        messages = await asyncio.shield(sync_to_async(_save_streamed_turn)(
+            conversation, user_message, messages_for_ai, chunks, finished, error is not None, usage,
+            time.monotonic() - started, reserved
+        ))
+    yield _stream_end(conversation, messages, error)
+
+@async_api_view(['POST'])
+async def get_ai_response(request, conversation_id):
+    try:
+        conversation = await Conversation.objects.select_related('subject').aget(id=conversation_id, user=request.user)
         user_message = request.data.get('message')
         
         if not user_message:
-            return Response({'error': 'No message provided'}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'error': 'No message provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Save user message
-        Message.objects.create(
-            conversation=conversation,
-            role='user',
-            content=user_message
-        )
+        # Leave the model call to a worker and let the client poll for it;
+        # the question is saved now so the worker can read it back. The
+        # worker takes the rate limit reservation when it runs the turn.
+        if str(request.data.get('background', '')).lower() in ('1', 'true'):
+            await asave_turn(conversation, ('user', user_message))
+            job = await aenqueue('chat_turn', {'conversation_id': conversation.id}, user=request.user)
+            return JsonResponse(job_accepted(job), status=status.HTTP_202_ACCEPTED)
         
-        # Update conversation title if it's the first message
-        if conversation.title == "New Conversation":
-            conversation.title = user_message[:50] + "..." if len(user_message) > 50 else user_message
-            conversation.save()
+        # Hold the most this turn can send until the real usage is known
+        limiter = get_rate_limiter()
+        reserved = token_budget(conversation.subject)
+        await limiter.areserve(request.user.id, reserved)
         
-        # Prepare messages for OpenAI
-        messages_for_ai = [{"role": "system", "content": conversation.subject.system_prompt}]
+        # Prepare messages for the model: recent history within the subject's token budget,
+        # then the question, which is saved together with the reply
+        messages_for_ai = await abuild_context(conversation, conversation.subject,
+                                               pending=[{'role': 'user', 'content': user_message}])
         
-        # Get recent conversation history (last 10 messages)
-        recent_messages = Message.objects.filter(conversation=conversation).order_by('timestamp')
-        for msg in recent_messages:
-            messages_for_ai.append({"role": msg.role, "content": msg.content})
+        # Stream tokens back as Server-Sent Events when the client asks for it.
+        # Under WSGI an async iterator would be buffered whole, so hand the
+        # server a plain generator there instead.
+        if _wants_stream(request):
+            if isinstance(request, ASGIRequest):
+                stream = _astream_ai_response(conversation, user_message, messages_for_ai, reserved)
+            else:
+                stream = _stream_ai_response(conversation, user_message, messages_for_ai, reserved)
+            response = StreamingHttpResponse(stream, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
         
-        # Call OpenAI API
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages_for_ai,
-            temperature=0.7
-        )
+        # Call the chat model
+        started = time.monotonic()
+        try:
+            response = await acomplete(
+                settings.LLM_CHAT_PROVIDER,
+                messages=messages_for_ai,
+                temperature=0.7
+            )
+        except Exception:
+            await limiter.asettle(request.user.id, -reserved)
+            raise
         
         ai_response = response.choices[0].message.content
+        await arecord(request.user.id, 'chat', response.model, response.usage, messages_for_ai, ai_response,
+                      time.monotonic() - started, reserved)
         
-        # Save AI response
-        Message.objects.create(
-            conversation=conversation,
-            role='assistant',
-            content=ai_response
-        )
-        
-        # Return the updated conversation
-        serializer = ConversationSerializer(conversation)
-        return Response(serializer.data)
+        # Save the question and the reply together, and return just the new messages
+        messages = await asave_turn(conversation, ('user', user_message), ('assistant', ai_response))
+        schedule_rolling_summary(conversation.id)
+        return JsonResponse(serialize_turn(conversation, messages))
     
     except Conversation.DoesNotExist:
-        return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+    except RateLimited as e:
+        return rate_limited_response(e)
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@api_view(['GET'])
 @permission_classes([IsAuthenticated])
-def socratic_response(request):
+def get_job(request, job_id):
+    try:
+        job = Job.objects.get(id=job_id, user=request.user)
+        return Response(serialize_job(job))
+    except Job.DoesNotExist:
+        return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+@async_api_view(['POST'])
+async def socratic_response(request):
     message = request.data.get('message')
     subject = request.data.get('subject')
     conversation_history = request.data.get('conversation_history', [])
     
     try:
         # Get subject-specific system prompt with fallback
-        try:
-            subject_obj = Subject.objects.get(name__icontains=subject)
+        subject_obj = (await aget_catalog()).resolve(subject)
+        if subject_obj is not None:
             system_prompt = subject_obj.system_prompt
-        except Subject.DoesNotExist:
-            system_prompt = "You are a Socratic tutor. Guide students through questions, never give direct answers."
+        else:
+            system_prompt = DEFAULT_SYSTEM_PROMPT
         
-        # Initialize NVIDIA API client
-        client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key=os.getenv('NVIDIA_API_KEY')
-        )
+        provider = settings.LLM_SOCRATIC_PROVIDER
+        model = get_model(provider)
         
-        # Prepare messages
-        messages = [{"role": "system", "content": system_prompt}]
+        # Prepare messages: client-side history plus the current message, within the token budget
+        history = clean_history(conversation_history)
+        messages = fit_to_budget(system_prompt, history + [{"role": "user", "content": message}], token_budget(subject_obj))
         
-        # Add conversation history
-        for msg in conversation_history[-5:]:  # Last 5 messages for context
-            if msg.get('role') and msg.get('content'):
-                messages.append({"role": msg.get('role'), "content": msg.get('content')})
+        # Opening questions repeat a lot across students, so answer them from the cache
+        cache = get_response_cache() if settings.RESPONSE_CACHE['ENABLED'] and not history else None
+        cache_subject = str(subject_obj.id if subject_obj else subject).lower()
+        system_hash = subject_obj.prompt_hash if subject_obj else None
+        if cache:
+            cached = await cache.aget(cache_subject, system_prompt, message, system_hash)
+            if cached is not None:
+                return JsonResponse({
+                    'response': cached['response'],
+                    'confidence': 0.95,
+                    'metadata': {
+                        'subject': subject,
+                        'questionType': 'guided_inquiry',
+                        'model': cached['model'],
+                        'cached': True
+                    }
+                })
         
-        # Add current message
-        messages.append({"role": "user", "content": message})
+        # Cache misses count against the caller's rate limits, whether or
+        # not they end up sharing another request's upstream call
+        limiter = get_rate_limiter()
+        reserved = estimate_tokens(messages)
+        await limiter.areserve(request.user.id, reserved)
         
-        # Call NVIDIA API
-        completion = client.chat.completions.create(
-            model="meta/llama-3.1-405b-instruct",
-            messages=messages,
-            temperature=0.2,
-            top_p=0.7,
-            max_tokens=1024,
-            stream=False
-        )
+        # Call the Socratic tutor model, falling back to (or hedging with)
+        # the backup provider when the primary is failing or slow
+        async def ask_model():
+            started = time.monotonic()
+            completion = await acomplete(
+                provider,
+                backup=settings.LLM_SOCRATIC_BACKUP_PROVIDER,
+                hedge_after=settings.LLM_HEDGE_AFTER,
+                messages=messages,
+                temperature=0.2,
+                top_p=0.7,
+                max_tokens=1024,
+                stream=False
+            )
+            answer = {'response': completion.choices[0].message.content, 'model': completion.model or model}
+            await arecord(request.user.id, 'socratic', answer['model'], completion.usage, messages, answer['response'],
+                          time.monotonic() - started, reserved)
+            if cache:
+                await cache.aset(cache_subject, system_prompt, message, answer, system_hash)
+            return answer
         
-        response_text = completion.choices[0].message.content
+        # A class asking the same question at once shares one upstream call
+        try:
+            if settings.SINGLE_FLIGHT['ENABLED']:
+                answer = await get_single_flight().ado(flight_key(model, messages, 0.2), ask_model)
+            else:
+                answer = await ask_model()
+        except Exception:
+            await limiter.asettle(request.user.id, -reserved)
+            raise
+        response_text = answer['response']
+        model = answer['model']
         
-        return Response({
+        return JsonResponse({
             'response': response_text,
             'confidence': 0.95,
             'metadata': {
                 'subject': subject,
                 'questionType': 'guided_inquiry',
-                'model': 'meta/llama-3.1-405b-instruct'
+                'model': model
             }
         })
         
+    except RateLimited as e:
+        return rate_limited_response(e)
     except Exception as e:
-        print(f"NVIDIA API Error: {str(e)}")
+        print(f"LLM API Error: {str(e)}")
         # Return fallback Socratic response
         fallback_responses = {
             'python': "What do you think this Python function should return? Walk me through your reasoning.",
@@ -224,7 +451,7 @@ def socratic_response(request):
         
         fallback_text = fallback_responses.get(subject, "That's an interesting observation! What makes you think that's the case?")
         
-        return Response({
+        return JsonResponse({
             'response': fallback_text,
             'confidence': 0.5,
             'metadata': {
@@ -236,34 +463,43 @@ def socratic_response(request):
         })
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def upload_profile_picture(request):
     try:
-        profile, created = UserProfile.objects.get_or_create(user=request.user)
+        upload = request.FILES.get('profile_picture')
+        if upload is None:
+            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if upload.size > settings.AVATAR['MAX_UPLOAD_BYTES']:
+            return Response({'error': 'Image is too large'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        
+        # Only the resized, metadata-free variants are kept, never the upload itself
+        try:
+            digest = store_avatar(upload.read())
+        except InvalidAvatar as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        if 'profile_picture' in request.FILES:
-            profile.profile_picture = request.FILES['profile_picture']
-            profile.save()
-            
-            return Response({
-                'message': 'Profile picture uploaded successfully',
-                'profile_picture_url': profile.profile_picture.url if profile.profile_picture else None
-            })
+        profile, created = UserProfile.objects.get_or_create(user=request.user)
+        profile.avatar_hash = digest
+        profile.profile_picture.name = variant_path(digest, max(settings.AVATAR['SIZES']), 'jpeg')
+        profile.save(update_fields=['avatar_hash', 'profile_picture'])
         
-        return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'message': 'Profile picture uploaded successfully',
+            'profile_picture_url': profile.profile_picture.url,
+            'avatar': avatar_urls(profile)
+        })
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_profile(request):
     try:
         profile, created = UserProfile.objects.get_or_create(user=request.user)
         return Response({
             'user': UserSerializer(request.user).data,
-            'profile_picture_url': profile.profile_picture.url if profile.profile_picture else None
+            'profile_picture_url': profile.profile_picture.url if profile.profile_picture else None,
+            'avatar': avatar_urls(profile)
         })
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TutorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tutor'
+
+    def ready(self):
+        from . import signals
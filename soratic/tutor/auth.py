@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+class TokenCache:
+    """Short-lived, size-bounded LRU of token key -> (user, token).
+
+    Entries are dropped when the token is deleted or the user is saved or
+    deleted (see tutor.signals), and expire after ``ttl`` seconds anyway:
+    invalidation only reaches the current process, so the TTL bounds how
+    long other workers can keep honouring a revoked token.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[1]
+
+    def set(self, key, user, token):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, (user, token))
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.counters['evictions'] += 1
+
+    def _drop(self, key):
+        expires, (user, token) = self._entries.pop(key)
+        keys = self._keys_by_user.get(user.pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[user.pk]
+
+    def invalidate_key(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+                self.counters['invalidations'] += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._drop(key)
+                self.counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, size=len(self._entries))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+token_cache = TokenCache(settings.TOKEN_AUTH_CACHE_TTL, settings.TOKEN_AUTH_CACHE_MAX_ENTRIES)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    # TokenAuthentication without the Token+User query on every request
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(key, user, token)
+        return user, token
+
+
+def _parse_body(request):
+    # The views read fields with request.data.get(), so only a JSON object will do
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+async def authenticate_token(request):
+    # Async twin of DRF's TokenAuthentication: "Authorization: Token <key>"
+    parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(parts) != 2 or parts[0].lower() != 'token':
+        return None
+    cached = token_cache.get(parts[1])
+    if cached is not None:
+        return cached[0]
+    try:
+        token = await Token.objects.select_related('user').aget(key=parts[1])
+    except Token.DoesNotExist:
+        return None
+    if not token.user.is_active:
+        return None
+    token_cache.set(token.key, token.user, token)
+    return token.user
+
+
+def async_api_view(methods):
+    """Decorator for native async views that need token auth.
+
+    Mirrors what ``api_view`` + ``TokenAuthentication`` + ``IsAuthenticated``
+    give the sync views: method check, CSRF exemption, 401 on a missing or bad
+    token, and the parsed body on ``request.data``.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                                    status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+            user = await authenticate_token(request)
+            if user is None:
+                response = JsonResponse({'detail': 'Invalid or missing authentication token.'},
+                                        status=status.HTTP_401_UNAUTHORIZED)
+                response['WWW-Authenticate'] = 'Token'
+                return response
+            request.user = user
+
+            data = _parse_body(request)
+            if data is None:
+                return JsonResponse({'detail': 'JSON parse error: expected an object.'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+            request.data = data
+
+            return await view_func(request, *args, **kwargs)
+
+        # django.views.decorators.csrf.csrf_exempt only learned about
+        # coroutine views in Django 5.0, so mark the wrapper directly.
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
@@ -0,0 +1,97 @@
+import hashlib
+import io
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Profile pictures are stored as square variants (AVATAR['SIZES'] pixels,
+# in each of AVATAR['FORMATS']) under avatars/<sha256 of the upload>/, never
+# as the uploaded file. Encoding from a fresh image drops EXIF, GPS and
+# other metadata. The paths only ever hold one image, so they can be served
+# with a far-future immutable Cache-Control, and identical uploads share
+# their files.
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+ALLOWED_UPLOAD_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+
+
+class InvalidAvatar(Exception):
+    pass
+
+
+def variant_path(digest, size, fmt):
+    return f"avatars/{digest[:2]}/{digest}/{size}.{fmt}"
+
+
+def _open(data):
+    options = settings.AVATAR
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format not in ALLOWED_UPLOAD_FORMATS:
+            raise InvalidAvatar('Profile pictures must be JPEG, PNG, WebP or GIF images')
+        if image.width * image.height > options['MAX_PIXELS']:
+            raise InvalidAvatar('Image is too large')
+        image.draft('RGB', (max(options['SIZES']),) * 2)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidAvatar(f'Could not read image: {e}')
+    if image.mode != 'RGB':
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    return image
+
+
+def render_variants(data):
+    """Returns {(size, fmt): bytes} for every configured variant of the
+    image in ``data``, center-cropped to a square."""
+    options = settings.AVATAR
+    image = _open(data)
+    variants = {}
+    for size in sorted(options['SIZES'], reverse=True):
+        square = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        # A new image carries no info dict, so nothing from the upload's metadata is written
+        clean = Image.new('RGB', square.size)
+        clean.paste(square)
+        for fmt in options['FORMATS']:
+            output = io.BytesIO()
+            clean.save(output, format=FORMATS[fmt][0], quality=options['QUALITY'], optimize=fmt == 'jpeg')
+            variants[(size, fmt)] = output.getvalue()
+    return variants
+
+
+def store_avatar(data):
+    """Stores the variants of ``data`` and returns its content hash. Files
+    that already exist (the same picture uploaded before) are reused."""
+    digest = hashlib.sha256(data).hexdigest()
+    options = settings.AVATAR
+    paths = [variant_path(digest, size, fmt) for size in options['SIZES'] for fmt in options['FORMATS']]
+    if all(default_storage.exists(path) for path in paths):
+        return digest
+    for (size, fmt), content in render_variants(data).items():
+        path = variant_path(digest, size, fmt)
+        if not default_storage.exists(path):
+            default_storage.save(path, ContentFile(content))
+    return digest
+
+
+def avatar_urls(profile):
+    """{size: {format: url}} for the profile's picture, or None."""
+    if profile is None or not profile.avatar_hash:
+        return None
+    options = settings.AVATAR
+    return {
+        str(size): {fmt: default_storage.url(variant_path(profile.avatar_hash, size, fmt)) for fmt in options['FORMATS']}
+        for size in options['SIZES']
+    }
+
+
+def avatar_url(profile, size, fmt='jpeg'):
+    if profile is None or not profile.avatar_hash:
+        return None
+    return default_storage.url(variant_path(profile.avatar_hash, size, fmt))
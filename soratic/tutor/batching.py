@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+import weakref
+from django.conf import settings
+from .breaker import acomplete, interactive_calls
+
+# Micro-batching for LLM calls nobody is waiting on (session summaries).
+# Requests are gathered for up to MAX_WAIT seconds or until MAX_BATCH have
+# queued, then sent together, at most MAX_CONCURRENCY at a time per event
+# loop. The chat completions API takes one conversation per request, so a
+# batch goes out as concurrent requests on the pooled connections rather
+# than as one combined prompt. Before sending, a batch waits (up to
+# MAX_DEFER seconds) while YIELD_ABOVE or more interactive calls are in
+# flight in this process, so chat and Socratic answers go first.
+
+_counters = {'requests': 0, 'batches': 0, 'deferred_batches': 0, 'deferred_seconds': 0.0}
+_counters_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _counters_lock:
+        _counters[name] += amount
+
+
+class MicroBatcher:
+    def __init__(self, options):
+        self.max_batch = options['MAX_BATCH']
+        self.max_wait = options['MAX_WAIT']
+        self.yield_above = options['YIELD_ABOVE']
+        self.max_defer = options['MAX_DEFER']
+        self._semaphore = asyncio.Semaphore(options['MAX_CONCURRENCY'])
+        self._queue = []
+        self._full = asyncio.Event()
+        self._runner = None
+        self._tasks = set()
+
+    async def submit(self, provider, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((future, provider, kwargs))
+        _count('requests')
+        if len(self._queue) >= self.max_batch:
+            self._full.set()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.ensure_future(self._run())
+        return await future
+
+    async def _run(self):
+        while self._queue:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            if len(self._queue) < self.max_batch:
+                self._full.clear()
+            await self._yield_to_interactive()
+            _count('batches')
+            for item in batch:
+                task = asyncio.ensure_future(self._send(*item))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _yield_to_interactive(self):
+        if interactive_calls() < self.yield_above:
+            return
+        started = time.monotonic()
+        while interactive_calls() >= self.yield_above and time.monotonic() - started < self.max_defer:
+            await asyncio.sleep(0.05)
+        _count('deferred_batches')
+        _count('deferred_seconds', time.monotonic() - started)
+
+    async def _send(self, future, provider, kwargs):
+        async with self._semaphore:
+            if future.cancelled():
+                return
+            try:
+                result = await acomplete(provider, interactive=False, **kwargs)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+
+# Futures and semaphores belong to one event loop, so each loop gets its own
+# batcher: the rolling-summary loop, the worker's loop, or the ASGI loop
+_batchers = weakref.WeakKeyDictionary()
+_batchers_lock = threading.Lock()
+
+
+def get_batcher():
+    loop = asyncio.get_running_loop()
+    with _batchers_lock:
+        if loop not in _batchers:
+            _batchers[loop] = MicroBatcher(settings.BATCHING)
+        return _batchers[loop]
+
+
+async def abatched_complete(provider, **kwargs):
+    """Same as ``acomplete`` for calls that can wait a little: the call is
+    queued with other batch work and sent with the next batch."""
+    if not settings.BATCHING['ENABLED']:
+        return await acomplete(provider, interactive=False, **kwargs)
+    return await get_batcher().submit(provider, **kwargs)
+
+
+def batching_stats():
+    with _counters_lock:
+        stats = dict(_counters)
+    stats['deferred_seconds'] = round(stats['deferred_seconds'], 3)
+    stats['average_batch_size'] = round(stats['requests'] / stats['batches'], 2) if stats['batches'] else 0.0
+    return stats
@@ -0,0 +1,245 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .llm import acreate, astream, iterate_on_client_loop
+
+# Per-provider circuit breakers. A provider that keeps failing or answering
+# slower than SLOW_CALL_SECONDS is skipped for RESET_TIMEOUT seconds instead
+# of making every request wait out the client timeout; then a single probe
+# request decides whether it is healthy again.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, options):
+        self.name = name
+        self.window = options['WINDOW']
+        self.min_calls = options['MIN_CALLS']
+        self.failure_rate = options['FAILURE_RATE']
+        self.slow_call_seconds = options['SLOW_CALL_SECONDS']
+        self.reset_timeout = options['RESET_TIMEOUT']
+        self.state = CLOSED
+        self.opened_at = None
+        self._calls = deque()  # (finished at, bad, latency)
+        self._probing = False
+        self._lock = threading.Lock()
+        self.counters = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'trips': 0}
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def record(self, latency, error=False, slow=False):
+        now = time.monotonic()
+        slow = slow or latency >= self.slow_call_seconds
+        with self._lock:
+            self.counters['calls'] += 1
+            self.counters['failures'] += error
+            self.counters['slow_calls'] += slow and not error
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if error or slow:
+                    self._trip(now)
+                else:
+                    self.state = CLOSED
+                    self._calls.clear()
+                return
+            self._calls.append((now, error or slow, latency))
+            self._prune(now)
+            bad = sum(1 for call in self._calls if call[1])
+            if self.state == CLOSED and len(self._calls) >= self.min_calls and bad / len(self._calls) >= self.failure_rate:
+                self._trip(now)
+
+    def release(self):
+        # The call was cancelled (e.g. it lost a hedge race): no verdict
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def _trip(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self._calls.clear()
+        self.counters['trips'] += 1
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            latencies = sorted(call[2] for call in self._calls)
+            bad = sum(1 for call in self._calls if call[1])
+            return dict(
+                self.counters,
+                state=self.state,
+                window_calls=len(self._calls),
+                window_error_rate=round(bad / len(self._calls), 4) if self._calls else 0.0,
+                window_p95_latency=round(latencies[int(len(latencies) * 0.95)], 3) if latencies else None,
+            )
+
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    with _lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider, settings.LLM_BREAKER)
+        return _breakers[provider]
+
+
+def breaker_stats():
+    with _lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+def reset_breakers():
+    with _lock:
+        _breakers.clear()
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(sender, setting, **kwargs):
+    if setting == 'LLM_BREAKER':
+        reset_breakers()
+
+
+async def _guarded_create(provider, slow_after=None, **kwargs):
+    # ``slow_after``: a call cancelled after this many seconds lost a hedge
+    # race by being slow, and counts as a slow call
+    breaker = get_breaker(provider)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit for LLM provider '{provider}' is open")
+    started = time.monotonic()
+    try:
+        completion = await acreate(provider, **kwargs)
+    except asyncio.CancelledError:
+        latency = time.monotonic() - started
+        if latency >= breaker.slow_call_seconds or (slow_after is not None and latency >= slow_after):
+            breaker.record(latency, slow=True)
+        else:
+            breaker.release()
+        raise
+    except Exception:
+        breaker.record(time.monotonic() - started, error=True)
+        raise
+    breaker.record(time.monotonic() - started)
+    return completion
+
+
+# Calls made while a user waits on the answer; batch work (tutor/batching.py)
+# holds back while there are many of them
+_interactive_calls = 0
+_interactive_lock = threading.Lock()
+
+
+def interactive_calls():
+    return _interactive_calls
+
+
+async def acomplete(provider, backup=None, hedge_after=None, interactive=True, **kwargs):
+    """Creates a chat completion on ``provider`` behind its circuit breaker.
+
+    With a ``backup`` provider, requests go straight to the backup while the
+    primary's circuit is open or when the primary fails, and if
+    ``hedge_after`` seconds pass without an answer a second request is sent
+    to the backup; whichever answers first wins.
+    """
+    global _interactive_calls
+    if not interactive:
+        return await _acomplete(provider, backup, hedge_after, **kwargs)
+    with _interactive_lock:
+        _interactive_calls += 1
+    try:
+        return await _acomplete(provider, backup, hedge_after, **kwargs)
+    finally:
+        with _interactive_lock:
+            _interactive_calls -= 1
+
+
+async def _acomplete(provider, backup, hedge_after, **kwargs):
+    if not backup or backup == provider:
+        return await _guarded_create(provider, **kwargs)
+
+    primary = asyncio.ensure_future(_guarded_create(provider, slow_after=hedge_after, **kwargs))
+    pending = {primary}
+    try:
+        if hedge_after:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        else:
+            done, pending = await asyncio.wait(pending)
+        if done and primary.exception() is None:
+            return primary.result()
+        hedge = asyncio.ensure_future(_guarded_create(backup, **kwargs))
+        pending.add(hedge)
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        raise hedge.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def acomplete_stream(provider, interactive=True, **kwargs):
+    """Streams a chat completion from ``provider`` behind its circuit
+    breaker. The call is judged once the stream ends: failed if it raised,
+    slow if the first chunk took SLOW_CALL_SECONDS or more. A reader that
+    stops early leaves no verdict."""
+    global _interactive_calls
+    breaker = get_breaker(provider)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit for LLM provider '{provider}' is open")
+    if interactive:
+        with _interactive_lock:
+            _interactive_calls += 1
+    started = time.monotonic()
+    first_chunk = None
+    try:
+        async for chunk in astream(provider, **kwargs):
+            if first_chunk is None:
+                first_chunk = time.monotonic() - started
+            yield chunk
+    except Exception:
+        breaker.record(time.monotonic() - started, error=True)
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    else:
+        breaker.record(first_chunk if first_chunk is not None else time.monotonic() - started)
+    finally:
+        if interactive:
+            with _interactive_lock:
+                _interactive_calls -= 1
+
+
+def complete_stream(provider, **kwargs):
+    # acomplete_stream for sync code, run on the LLM client loop
+    return iterate_on_client_loop(acomplete_stream(provider, **kwargs))
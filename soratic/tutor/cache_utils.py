@@ -0,0 +1,21 @@
+from django.core.cache import caches
+
+
+def get_version(namespace, alias='default'):
+    # Version counters let a whole family of cache keys be dropped at once
+    # by bumping one number instead of deleting keys one by one.
+    cache = caches[alias]
+    version = cache.get(f'version:{namespace}')
+    if version is None:
+        cache.add(f'version:{namespace}', 1, None)
+        version = cache.get(f'version:{namespace}', 1)
+    return version
+
+
+def bump_version(namespace, alias='default'):
+    cache = caches[alias]
+    try:
+        return cache.incr(f'version:{namespace}')
+    except ValueError:
+        cache.add(f'version:{namespace}', 2, None)
+        return cache.get(f'version:{namespace}', 2)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils.text import slugify
+from .models import Subject
+from .response_cache import prompt_hash
+from .serializers import SubjectSerializer
+
+# Subjects change a few times a year but are read on every Socratic turn,
+# so each process keeps the whole table in memory. Two things make it
+# reload:
+#
+# - Saving or deleting a Subject changes a version token in the default
+#   cache. With a shared cache (Redis, Memcached) every process sees that on
+#   its next lookup; with the default per-process LocMemCache only the
+#   process that made the change does. The token is random rather than a
+#   counter (cache_utils.get_version) so an evicted or cleared key can never
+#   bring back a version a process already has loaded.
+# - Every SUBJECT_CATALOG_RECHECK_SECONDS a lookup compares the table's
+#   count, highest id and latest updated_at with the loaded ones, one small
+#   aggregate query. This catches changes made by other processes and
+#   management commands whatever the cache.
+
+VERSION_KEY = 'subject_catalog:version'
+
+DEFAULT_SYSTEM_PROMPT = "You are a Socratic tutor. Guide students through questions, never give direct answers."
+
+
+class SubjectCatalog:
+    def __init__(self, subjects, version, fingerprint):
+        self.version = version
+        self.fingerprint = fingerprint
+        self.checked_at = time.monotonic()
+        self.subjects = subjects
+        self.by_id = {subject.id: subject for subject in subjects}
+        for subject in subjects:
+            subject.prompt_hash = prompt_hash(subject.system_prompt)
+
+        # Slugs resolve exactly; names and first words ("python" for
+        # "python-programming") only when no other subject claims them
+        self.by_key = {subject.slug: subject for subject in subjects}
+        claims = {}
+        for subject in subjects:
+            for alias in {slugify(subject.name), subject.slug.split('-')[0]}:
+                claims.setdefault(alias, set()).add(subject.id)
+        for alias, ids in claims.items():
+            if alias not in self.by_key and len(ids) == 1:
+                self.by_key[alias] = self.by_id[ids.pop()]
+
+        self.data = json.loads(json.dumps(SubjectSerializer(subjects, many=True).data))
+        self.etag = '"%s"' % hashlib.sha256(json.dumps(self.data, sort_keys=True).encode()).hexdigest()[:32]
+
+    def resolve(self, key):
+        """The subject for a slug, name or short name, or None."""
+        if not key:
+            return None
+        return self.by_key.get(slugify(str(key)))
+
+    def get(self, subject_id):
+        try:
+            return self.by_id.get(int(subject_id))
+        except (TypeError, ValueError):
+            return None
+
+
+_catalog = None
+_lock = threading.Lock()
+
+
+def _current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _fingerprint():
+    row = Subject.objects.aggregate(count=Count('id'), last_id=Max('id'), updated=Max('updated_at'))
+    return row['count'], row['last_id'], row['updated']
+
+
+def _is_fresh(catalog, version):
+    return (catalog is not None and catalog.version == version
+            and time.monotonic() - catalog.checked_at < settings.SUBJECT_CATALOG_RECHECK_SECONDS)
+
+
+def get_catalog():
+    global _catalog
+    version = _current_version()
+    catalog = _catalog
+    if _is_fresh(catalog, version):
+        return catalog
+    with _lock:
+        catalog = _catalog
+        if _is_fresh(catalog, version):
+            return catalog
+        # Fingerprint first: a change made while the rows load shows up at the next check
+        fingerprint = _fingerprint()
+        if catalog is not None and catalog.version == version and catalog.fingerprint == fingerprint:
+            catalog.checked_at = time.monotonic()
+            return catalog
+        _catalog = SubjectCatalog(list(Subject.objects.order_by('id')), version, fingerprint)
+        return _catalog
+
+
+async def aget_catalog():
+    catalog = _catalog
+    if _is_fresh(catalog, await cache.aget(VERSION_KEY)):
+        return catalog
+    return await sync_to_async(get_catalog)()
+
+
+def invalidate_catalog():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
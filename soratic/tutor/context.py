@@ -0,0 +1,98 @@
+from functools import lru_cache
+from django.conf import settings
+from .models import Message, SessionSummary
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Per-message framing overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# What one image part costs a vision model (a 1024px image at high detail)
+IMAGE_PART_TOKENS = 765
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Roughly four characters per token for English text and code
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message):
+    content = message['content']
+    if isinstance(content, str):
+        return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    # Multimodal content is a list of text and image parts
+    return sum(count_tokens(part['text']) if part.get('type') == 'text' else IMAGE_PART_TOKENS
+               for part in content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def token_budget(subject=None):
+    if subject is not None and subject.context_token_budget:
+        return subject.context_token_budget
+    return settings.CONTEXT_TOKEN_BUDGET
+
+
+def fit_to_budget(system_prompt, history, budget):
+    """Returns the prompt messages: the system prompt plus as many of the
+    newest ``history`` turns as fit in ``budget`` tokens.
+
+    The newest turn (the one being answered) is always kept.
+    """
+    remaining = budget - message_tokens({'content': system_prompt})
+    kept = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if kept and cost > remaining:
+            break
+        kept.append(message)
+        remaining -= cost
+    kept.reverse()
+    return [{"role": "system", "content": system_prompt}] + kept
+
+
+def clean_history(history):
+    # Client-supplied history: keep only well-formed user/assistant turns
+    return [
+        {"role": msg['role'], "content": msg['content']}
+        for msg in history
+        if isinstance(msg, dict) and msg.get('role') in ('user', 'assistant') and msg.get('content')
+    ][-settings.CONTEXT_MAX_MESSAGES:]
+
+
+async def arecent_messages(conversation, limit=None, after_id=0):
+    # Newest-first with a LIMIT, so long conversations are never fully loaded
+    limit = limit or settings.CONTEXT_MAX_MESSAGES
+    queryset = (Message.objects.filter(conversation=conversation, id__gt=after_id)
+                .order_by('-timestamp', '-id')
+                .values('role', 'content')[:limit])
+    messages = [msg async for msg in queryset]
+    messages.reverse()
+    return messages
+
+
+async def abuild_context(conversation, subject, pending=()):
+    # Rolling summary of the older turns plus the recent turns verbatim.
+    # ``pending`` are messages of the current turn that are not saved yet.
+    system_prompt = subject.system_prompt
+    summary = await (SessionSummary.objects.filter(conversation=conversation)
+                     .values('ai_summary', 'summarized_through').afirst())
+    after_id = summary['summarized_through'] if summary else 0
+    if summary and summary['ai_summary']:
+        system_prompt += f"\n\nSummary of the earlier part of this session:\n{summary['ai_summary']}"
+
+    history = await arecent_messages(conversation, limit=settings.CONTEXT_MAX_MESSAGES - len(pending), after_id=after_id)
+    return fit_to_budget(system_prompt, history + list(pending), token_budget(subject))
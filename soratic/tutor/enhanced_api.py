@@ -1,132 +1,129 @@
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
-from django.db.models import Count, Sum, Avg
+from django.db.models import Count, Sum, Avg, Max, Q, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import IntegrityError, transaction
+from django.conf import settings
+from django.contrib.auth.models import User
 from datetime import timedelta
 from django.utils import timezone
-from .models import Subject, LearningPathway, Exercise, UserProgress, SessionSummary, Conversation
+from django.http import JsonResponse
+import hashlib
+import json
+import time
+from .models import (Subject, LearningPathway, Exercise, UserProgress, SessionSummary, Conversation, Message, UsageRecord,
+                     UserSubjectStats)
 from .serializers import (LearningPathwaySerializer, ExerciseSerializer, ExerciseWithSolutionSerializer,
                          UserProgressSerializer, SessionSummarySerializer)
+from .auth import async_api_view
+from .summaries import asession_summary
+from .jobs import aenqueue, job_accepted
+from .cache_utils import bump_version, get_version
+from .grader import SandboxError, grade_answer, normalize_answer
+from .breaker import acomplete
+from .llm import get_model
+from .singleflight import get_single_flight
+from .usage import RateLimited, arecord, estimate_tokens, get_rate_limiter, rate_limited_response
+from .avatars import avatar_url
+from .catalog import DEFAULT_SYSTEM_PROMPT, aget_catalog
+from .vision import (InvalidImage, aget_analysis, aprepare_image, aset_analysis, decode_data_url, image_hash,
+                     image_messages)
+from . import rollups
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_learning_pathways(request, subject_id):
     try:
         pathways = LearningPathway.objects.filter(subject_id=subject_id)
-        
-        # Fallback sample data if no pathways exist
-        if not pathways.exists():
-            sample_pathways = [
-                {
-                    'id': 1,
-                    'title': 'Python Basics',
-                    'description': 'Learn fundamental Python concepts',
-                    'order': 1
-                },
-                {
-                    'id': 2,
-                    'title': 'Data Structures',
-                    'description': 'Master Python data structures',
-                    'order': 2
-                }
-            ]
-            return Response(sample_pathways)
-        
         serializer = LearningPathwaySerializer(pathways, many=True)
         return Response(serializer.data)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_exercises(request, pathway_id):
     try:
         exercises = Exercise.objects.filter(pathway_id=pathway_id)
-        
-        # Fallback sample data if no exercises exist
-        if not exercises.exists():
-            sample_exercises = [
-                {
-                    'id': 1,
-                    'title': 'Variables and Data Types',
-                    'problem_statement': 'Create variables of different data types (int, float, str, bool) and print their types using the type() function.',
-                    'hints': ['Use type() function to check variable types', 'Try creating: age = 25, price = 19.99, name = "John", is_student = True'],
-                    'difficulty': 'easy',
-                    'solution': 'age = 25\nprice = 19.99\nname = "John"\nis_student = True\nprint(type(age), type(price), type(name), type(is_student))'
-                },
-                {
-                    'id': 2,
-                    'title': 'Control Structures',
-                    'problem_statement': 'Write a program that checks if a number is positive, negative, or zero using if-else statements.',
-                    'hints': ['Use if, elif, else statements', 'Compare the number with 0'],
-                    'difficulty': 'medium',
-                    'solution': 'num = int(input("Enter a number: "))\nif num > 0:\n    print("Positive")\nelif num < 0:\n    print("Negative")\nelse:\n    print("Zero")'
-                }
-            ]
-            return Response(sample_exercises)
-        
         serializer = ExerciseSerializer(exercises, many=True)
         return Response(serializer.data)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def _record_attempt(user, exercise, is_correct):
+    """Adds one attempt to the (user, exercise) progress row, creating it on
+    the first attempt, and returns (attempts, completed). Counts go through
+    F() in the database so concurrent submissions are never lost."""
+    progress = UserProgress.objects.filter(user=user, exercise=exercise)
+    with transaction.atomic():
+        if not progress.update(attempts=F('attempts') + 1):
+            try:
+                with transaction.atomic():
+                    UserProgress.objects.create(user=user, exercise=exercise, subject_id=exercise.pathway.subject_id,
+                                                pathway_id=exercise.pathway_id, attempts=1, completed=is_correct)
+                return 1, is_correct
+            except IntegrityError:
+                # A concurrent first attempt created the row
+                progress.update(attempts=F('attempts') + 1)
+        # update() skips signals, so a new completion updates the rollups here
+        if is_correct and progress.filter(completed=False).update(completed=True):
+            rollups.progress_changed(user.id, exercise.pathway.subject_id, completed=1)
+            bump_version('admin_students')
+        return progress.values_list('attempts', 'completed').get()
+
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def submit_exercise_attempt(request, exercise_id):
     try:
         user_answer = request.data.get('answer', '').strip()
+        exercise = Exercise.objects.select_related('pathway').filter(id=exercise_id).first()
+        if exercise is None:
+            return Response({'error': 'Exercise not found'}, status=status.HTTP_404_NOT_FOUND)
         
-        # Handle sample data exercises
-        sample_solutions = {
-            1: 'age = 25\nprice = 19.99\nname = "John"\nis_student = True\nprint(type(age), type(price), type(name), type(is_student))',
-            2: 'num = int(input("Enter a number: "))\nif num > 0:\n    print("Positive")\nelif num < 0:\n    print("Negative")\nelse:\n    print("Zero")'
-        }
-        
-        # Get or create progress tracking in session
-        session_key = f'exercise_{exercise_id}_attempts'
-        attempts = request.session.get(session_key, 0)
-        
-        # Simple answer checking
-        solution = sample_solutions.get(int(exercise_id), '')
-        is_correct = False
-        
-        if solution:
-            # Check for key concepts in the answer
-            if exercise_id == '1':
-                is_correct = 'type(' in user_answer and any(t in user_answer for t in ['int', 'float', 'str', 'bool'])
-            elif exercise_id == '2':
-                is_correct = 'if' in user_answer and ('elif' in user_answer or 'else' in user_answer)
+        # Exercises with test cases run the answer; the rest compare it with the solution
+        grade = None
+        if exercise.test_cases and user_answer:
+            try:
+                grade = grade_answer(exercise, user_answer)
+            except SandboxError as e:
+                print(f"Exercise sandbox error: {e}")
+                return Response({'error': 'Answer checking is unavailable, please try again'},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            is_correct = grade['passed']
+        else:
+            is_correct = bool(user_answer) and normalize_answer(user_answer) == normalize_answer(exercise.solution)
+        attempts, completed = _record_attempt(request.user, exercise, is_correct)
         
         if is_correct:
-            request.session[session_key] = 0  # Reset attempts
-            return Response({
-                'attempts': attempts + 1,
+            response_data = {
+                'attempts': attempts,
                 'completed': True,
                 'show_solution': False,
                 'message': 'Correct! Well done!'
-            })
+            }
+            if grade:
+                response_data['test_results'] = grade['cases']
+            return Response(response_data)
         else:
-            attempts += 1
-            request.session[session_key] = attempts
-            
             # Show solution after 3 failed attempts
             show_solution = attempts >= 3
             
             response_data = {
                 'attempts': attempts,
-                'completed': False,
+                'completed': completed,
                 'show_solution': show_solution,
                 'message': f'Incorrect. You have {3 - attempts} attempts remaining.' if not show_solution else 'Solution revealed after 3 attempts.'
             }
+            if grade:
+                response_data['test_results'] = grade['cases']
             
             if show_solution:
-                response_data['solution'] = solution
-                response_data['explanation'] = f"The correct solution is:\n{solution}"
+                response_data['solution'] = exercise.solution
+                response_data['explanation'] = f"The correct solution is:\n{exercise.solution}"
             
             return Response(response_data)
         
@@ -134,102 +131,137 @@ def submit_exercise_attempt(request, exercise_id):
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_progress_dashboard(request):
     try:
-        # Sample progress data
-        progress_data = {
-            'Python Programming': {
-                'subject_id': 1,
-                'total_exercises': 10,
-                'completed_exercises': 3,
-                'completion_percentage': 30,
-                'conversations_count': 5,
-                'time_spent_minutes': 45
-            },
-            'Physics': {
-                'subject_id': 2,
-                'total_exercises': 8,
-                'completed_exercises': 2,
-                'completion_percentage': 25,
-                'conversations_count': 3,
-                'time_spent_minutes': 30
-            },
-            'Mathematics': {
-                'subject_id': 3,
-                'total_exercises': 12,
-                'completed_exercises': 5,
-                'completion_percentage': 42,
-                'conversations_count': 7,
-                'time_spent_minutes': 60
-            },
-            'Chemistry': {
-                'subject_id': 4,
-                'total_exercises': 6,
-                'completed_exercises': 1,
-                'completion_percentage': 17,
-                'conversations_count': 2,
-                'time_spent_minutes': 20
+        # One row per subject from the rollup table, plus the exercise count
+        stats = {row.subject_id: row for row in UserSubjectStats.objects.filter(user=request.user)}
+        subjects = Subject.objects.annotate(total_exercises=Count('learningpathway__exercise')).order_by('name')
+        
+        progress_data = {}
+        for subject in subjects:
+            row = stats.get(subject.id)
+            completed = row.exercises_completed if row else 0
+            progress_data[subject.name] = {
+                'subject_id': subject.id,
+                'total_exercises': subject.total_exercises,
+                'completed_exercises': completed,
+                'completion_percentage': round(completed / subject.total_exercises * 100) if subject.total_exercises else 0,
+                'conversations_count': row.conversation_count if row else 0,
+                'time_spent_minutes': int(row.time_spent.total_seconds() // 60) if row else 0
             }
-        }
         
         return Response(progress_data)
         
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@api_view(['POST'])
-@authentication_classes([TokenAuthentication])
-@permission_classes([IsAuthenticated])
-def analyze_image(request):
+# Canned replies for when the vision model can't be reached
+FALLBACK_IMAGE_ANALYSES = {
+    'physics': [
+        "I can see force vectors in this diagram. What do you think each arrow represents?",
+        "This appears to be a circuit diagram. Can you identify the components?",
+        "I notice this is a wave diagram. What patterns do you observe?"
+    ],
+    'mathematics': [
+        "This looks like a graph. What can you tell me about the slope?",
+        "I see geometric shapes. How might we calculate the area?",
+        "This appears to be an equation. What's the first step to solve it?"
+    ],
+    'chemistry': [
+        "I can see molecular structures. What do the bonds tell us?",
+        "This looks like a reaction diagram. What's happening to the atoms?",
+        "I notice this is a periodic table section. What patterns do you see?"
+    ],
+    'python': [
+        "I can see code in this image. What do you think this function does?",
+        "This looks like a data structure. How would you access the elements?",
+        "I see an algorithm. Can you trace through the logic?"
+    ]
+}
+
+IMAGE_SUGGESTIONS = [
+    'Ask follow-up questions',
+    'Request step-by-step explanation',
+    'Try a similar problem'
+]
+
+@async_api_view(['POST'])
+async def analyze_image(request):
+    subject = request.data.get('subject', 'general')
+    
     try:
-        # Simulate AI image analysis
-        image_data = request.data.get('image')
-        subject = request.data.get('subject', 'general')
+        # Multipart upload, or a data URL from the camera capture
+        upload = request.FILES.get('image')
+        if upload is not None:
+            if upload.size > settings.IMAGE_ANALYSIS['MAX_UPLOAD_BYTES']:
+                return JsonResponse({'error': 'Image is too large'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            data = upload.read()
+        elif request.data.get('image'):
+            data = decode_data_url(request.data['image'])
+        else:
+            return JsonResponse({'error': 'No image provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(data) > settings.IMAGE_ANALYSIS['MAX_UPLOAD_BYTES']:
+            return JsonResponse({'error': 'Image is too large'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         
-        # Sample AI analysis responses based on subject
-        analyses = {
-            'physics': [
-                "I can see force vectors in this diagram. What do you think each arrow represents?",
-                "This appears to be a circuit diagram. Can you identify the components?",
-                "I notice this is a wave diagram. What patterns do you observe?"
-            ],
-            'mathematics': [
-                "This looks like a graph. What can you tell me about the slope?",
-                "I see geometric shapes. How might we calculate the area?",
-                "This appears to be an equation. What's the first step to solve it?"
-            ],
-            'chemistry': [
-                "I can see molecular structures. What do the bonds tell us?",
-                "This looks like a reaction diagram. What's happening to the atoms?",
-                "I notice this is a periodic table section. What patterns do you see?"
-            ],
-            'python': [
-                "I can see code in this image. What do you think this function does?",
-                "This looks like a data structure. How would you access the elements?",
-                "I see an algorithm. Can you trace through the logic?"
-            ]
-        }
+        subject_obj = (await aget_catalog()).resolve(subject)
+        system_prompt = subject_obj.system_prompt if subject_obj else DEFAULT_SYSTEM_PROMPT
         
-        subject_analyses = analyses.get(subject, analyses['physics'])
-        analysis = subject_analyses[hash(str(image_data)) % len(subject_analyses)]
+        # The same image (a worksheet the whole class photographs) is analysed once
+        digest = image_hash(data)
+        cached = await aget_analysis(digest, subject, system_prompt)
+        if cached is not None:
+            return JsonResponse({**cached, 'metadata': {**cached['metadata'], 'cached': True}})
         
-        return Response({
-            'analysis': analysis,
-            'confidence': 0.85,
-            'suggestions': [
-                'Ask follow-up questions',
-                'Request step-by-step explanation',
-                'Try a similar problem'
-            ]
-        })
+        async def analyse():
+            jpeg, width, height = await aprepare_image(data)
+            messages = image_messages(system_prompt, subject, jpeg)
+            provider = settings.LLM_VISION_PROVIDER
+            limiter = get_rate_limiter()
+            reserved = estimate_tokens(messages)
+            await limiter.areserve(request.user.id, reserved)
+            started = time.monotonic()
+            try:
+                completion = await acomplete(provider, messages=messages, temperature=0.2, max_tokens=512)
+            except Exception:
+                await limiter.asettle(request.user.id, -reserved)
+                raise
+            model = completion.model or get_model(provider)
+            analysis = completion.choices[0].message.content
+            await arecord(request.user.id, 'image_analysis', model, completion.usage, messages, analysis,
+                          time.monotonic() - started, reserved)
+            result = {
+                'analysis': analysis,
+                'confidence': 0.85,
+                'suggestions': IMAGE_SUGGESTIONS,
+                'metadata': {'model': model, 'width': width, 'height': height, 'cached': False}
+            }
+            await aset_analysis(digest, subject, system_prompt, result)
+            return result
+        
+        # Identical uploads arriving together share one decode and one model call
+        if settings.SINGLE_FLIGHT['ENABLED']:
+            flight = hashlib.sha256(f"{subject}:{digest}".encode()).hexdigest()
+            result = await get_single_flight().ado(f"image:{flight}", analyse)
+        else:
+            result = await analyse()
+        return JsonResponse(result)
         
+    except InvalidImage as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except RateLimited as e:
+        return rate_limited_response(e)
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        print(f"Image analysis error: {str(e)}")
+        subject_analyses = FALLBACK_IMAGE_ANALYSES.get(subject, FALLBACK_IMAGE_ANALYSES['physics'])
+        return JsonResponse({
+            'analysis': subject_analyses[0],
+            'confidence': 0.5,
+            'suggestions': IMAGE_SUGGESTIONS,
+            'metadata': {'fallback': True}
+        })
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def adaptive_difficulty(request):
     try:
@@ -273,33 +305,24 @@ def adaptive_difficulty(request):
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@api_view(['POST'])
-@authentication_classes([TokenAuthentication])
-@permission_classes([IsAuthenticated])
-def generate_session_summary(request, conversation_id):
+@async_api_view(['POST'])
+async def generate_session_summary(request, conversation_id):
     try:
-        # Sample session summary data
-        sample_summary = {
-            'id': conversation_id,
-            'topics_covered': ['Variables and Data Types', 'Control Structures', 'Functions'],
-            'key_concepts': [
-                'Python variables can store different data types',
-                'Use if-else statements for conditional logic',
-                'Functions help organize and reuse code'
-            ],
-            'questions_asked': 8,
-            'time_spent': '1800',  # 30 minutes in seconds
-            'ai_summary': 'This session focused on Python fundamentals including variable types, conditional statements, and basic function concepts. The student demonstrated good understanding of data types and showed progress in logical thinking through guided questioning.',
-            'created_at': timezone.now().isoformat()
-        }
+        conversation = await Conversation.objects.aget(id=conversation_id, user=request.user)
+        
+        # Hand the work to run_tutor_worker and let the client poll the job
+        if str(request.data.get('background', '')).lower() in ('1', 'true'):
+            job = await aenqueue('session_summary', {'conversation_id': conversation.id}, user=request.user)
+            return JsonResponse(job_accepted(job), status=status.HTTP_202_ACCEPTED)
         
-        return Response(sample_summary)
+        return JsonResponse(await asession_summary(conversation))
         
+    except Conversation.DoesNotExist:
+        return JsonResponse({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def get_user_progress(request, subject_id=None):
     try:
@@ -314,56 +337,114 @@ def get_user_progress(request, subject_id=None):
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+ADMIN_STUDENT_SORTS = {
+    'registeredAt': 'date_joined',
+    'lastActive': 'last_active',
+    'totalSessions': 'total_sessions',
+    'totalQuestions': 'total_questions',
+    'name': 'username',
+}
+
+def _admin_students_page(search, sort, page, page_size):
+    # Per-user figures summed from the rollup table, one subquery each
+    def rollup(expression):
+        return (UserSubjectStats.objects.filter(user=OuterRef('pk'))
+                .values('user').annotate(value=expression).values('value'))
+    
+    users = User.objects.annotate(
+        total_sessions=Coalesce(Subquery(rollup(Sum('conversation_count'))), 0),
+        total_questions=Coalesce(Subquery(rollup(Sum('questions_asked'))), 0),
+        last_active=Coalesce(Subquery(rollup(Max('last_activity'))), F('date_joined'))
+    ).select_related('userprofile')
+    if search:
+        users = users.filter(Q(username__icontains=search) | Q(email__icontains=search) |
+                             Q(first_name__icontains=search) | Q(last_name__icontains=search))
+    
+    field = ADMIN_STUDENT_SORTS.get(sort.lstrip('-'), 'date_joined')
+    order = f"-{field}" if sort.startswith('-') else field
+    users = users.order_by(order, '-id')
+    
+    if page_size is None:
+        page_users = list(users)
+        pages = {'count': len(page_users)}
+    else:
+        paginator = Paginator(users, page_size)
+        page_obj = paginator.get_page(page)
+        page_users = list(page_obj.object_list)
+        pages = {
+            'count': paginator.count,
+            'page': page_obj.number,
+            'page_size': page_size,
+            'num_pages': paginator.num_pages
+        }
+    user_ids = [user.id for user in page_users]
+    
+    # Subjects, progress and time for the whole page from one rollup query
+    subjects_studied, progress_by_subject, time_spent = {}, {}, {}
+    for row in (UserSubjectStats.objects.filter(user_id__in=user_ids)
+                .select_related('subject').order_by('subject__name')):
+        if row.conversation_count:
+            subjects_studied.setdefault(row.user_id, []).append(row.subject.name)
+        if row.exercises_attempted:
+            progress_by_subject.setdefault(row.user_id, {})[row.subject.name.lower()] = int((row.exercises_completed / row.exercises_attempted) * 100)
+        time_spent[row.user_id] = time_spent.get(row.user_id, timedelta(0)) + row.time_spent
+    
+    # LLM usage from the ledger; the favourite model is the one called most
+    api_usage = {}
+    for row in (UsageRecord.objects.filter(user_id__in=user_ids)
+                .values('user_id', 'model')
+                .annotate(tokens=Sum('total_tokens'), cost=Sum('cost'), calls=Count('id'))
+                .order_by('user_id', '-calls', 'model')):
+        usage = api_usage.setdefault(row['user_id'], {'totalTokens': 0, 'totalCost': 0.0, 'favoriteModel': row['model']})
+        usage['totalTokens'] += row['tokens']
+        usage['totalCost'] = round(usage['totalCost'] + float(row['cost']), 6)
+    
+    students = []
+    for user in page_users:
+        students.append({
+            'id': str(user.id),
+            'name': f"{user.first_name} {user.last_name}".strip() or user.username,
+            'email': user.email,
+            'avatarUrl': avatar_url(getattr(user, 'userprofile', None), min(settings.AVATAR['SIZES'])),
+            'registeredAt': user.date_joined.isoformat(),
+            'lastActive': user.last_active.isoformat(),
+            'totalSessions': user.total_sessions,
+            'totalQuestions': user.total_questions,
+            'subjectsStudied': subjects_studied.get(user.id, []),
+            'averageSessionTime': round(time_spent.get(user.id, timedelta(0)).total_seconds() / 60 / user.total_sessions) if user.total_sessions else 0,
+            'progressBySubject': progress_by_subject.get(user.id, {}),
+            'achievements': [],
+            'apiUsage': api_usage.get(user.id, {'totalTokens': 0, 'totalCost': 0.0, 'favoriteModel': ''})
+        })
+    
+    return dict(pages, students=students)
+
 @api_view(['GET'])
-@authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def admin_students(request):
     try:
-        from django.contrib.auth.models import User
-        from .models import Subject, Conversation, Message
-        
-        students = []
-        users = User.objects.all().order_by('-date_joined')
+        search = request.query_params.get('search', '').strip()
+        sort = request.query_params.get('sort', '-registeredAt')
+        # Paged only when the caller asks for a page; the dashboard loads
+        # the whole list
+        page = request.query_params.get('page')
+        page_size = None
+        if page is not None or 'page_size' in request.query_params:
+            page = page or 1
+            try:
+                page_size = min(max(int(request.query_params.get('page_size', 50)), 1), 200)
+            except ValueError:
+                page_size = 50
         
-        for user in users:
-            conversations = Conversation.objects.filter(user=user)
-            progress_data = UserProgress.objects.filter(user=user)
-            
-            subjects_studied = list(conversations.values_list('subject__name', flat=True).distinct())
-            
-            progress_by_subject = {}
-            for subject in Subject.objects.all():
-                subject_progress = progress_data.filter(subject=subject)
-                if subject_progress.exists():
-                    completed = subject_progress.filter(completed=True).count()
-                    total = subject_progress.count()
-                    progress_by_subject[subject.name.lower()] = int((completed / total) * 100) if total > 0 else 0
-            
-            total_sessions = conversations.count()
-            total_questions = Message.objects.filter(conversation__user=user, role='user').count()
-            
-            last_message = Message.objects.filter(conversation__user=user).order_by('-timestamp').first()
-            last_active = last_message.timestamp if last_message else user.date_joined
-            
-            students.append({
-                'id': str(user.id),
-                'name': f"{user.first_name} {user.last_name}".strip() or user.username,
-                'email': user.email,
-                'registeredAt': user.date_joined.isoformat(),
-                'lastActive': last_active.isoformat(),
-                'totalSessions': total_sessions,
-                'totalQuestions': total_questions,
-                'subjectsStudied': subjects_studied,
-                'averageSessionTime': 25,
-                'progressBySubject': progress_by_subject,
-                'achievements': [],
-                'apiUsage': {
-                    'totalTokens': total_questions * 50,
-                    'totalCost': total_questions * 0.001,
-                    'favoriteModel': 'deepseek-ai/deepseek-v3.1'
-                }
-            })
+        # Pages are cached until a student, conversation, message or progress row
+        # changes; LLM usage figures can lag by up to ADMIN_STUDENTS_CACHE_TTL
+        params = json.dumps([search, sort, str(page), page_size])
+        cache_key = f"admin_students:{get_version('admin_students')}:{hashlib.md5(params.encode()).hexdigest()}"
+        data = cache.get(cache_key)
+        if data is None:
+            data = _admin_students_page(search, sort, page, page_size)
+            cache.set(cache_key, data, settings.ADMIN_STUDENTS_CACHE_TTL)
         
-        return Response({'students': students})
+        return Response(data)
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
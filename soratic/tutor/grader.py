@@ -0,0 +1,199 @@
+import atexit
+import hashlib
+import json
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Grading for exercises with test cases. Answers run in sandbox_worker.py
+# processes that are started ahead of time and reused, so a submission
+# only pays for a fork, not for starting Python. Results are cached per
+# (exercise version, normalized answer), so resubmitting the same code is
+# free.
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox_worker.py')
+
+
+class SandboxError(Exception):
+    pass
+
+
+def normalize_answer(text):
+    # Ignore trailing spaces, blank lines and line-ending differences
+    lines = text.replace('\r\n', '\n').strip().split('\n')
+    return '\n'.join(line.rstrip() for line in lines if line.strip())
+
+
+def outputs_match(actual, expected):
+    return normalize_answer(actual) == normalize_answer(expected)
+
+
+class SandboxWorker:
+    def __init__(self):
+        # Empty environment and isolated mode: no secrets, no project imports
+        self.process = subprocess.Popen(
+            [sys.executable, '-I', WORKER_PATH],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env={}, cwd='/', text=True, bufsize=1
+        )
+        self.tasks = 0
+
+    def run(self, code, cases, limits, timeout):
+        self.process.stdin.write(json.dumps({'code': code, 'cases': cases, 'limits': limits}) + '\n')
+        self.process.stdin.flush()
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        line = self.process.stdout.readline() if ready else ''
+        if not line:
+            raise SandboxError('Sandbox worker did not answer')
+        self.tasks += 1
+        return json.loads(line)['results']
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class EvaluatorPool:
+    def __init__(self, options):
+        self.size = options['WORKERS']
+        self.max_tasks = options['MAX_TASKS_PER_WORKER']
+        self.limits = {
+            'cpu_seconds': options['CPU_SECONDS'],
+            'wall_seconds': options['WALL_SECONDS'],
+            'memory_mb': options['MEMORY_MB'],
+            'output_bytes': options['OUTPUT_BYTES'],
+        }
+        self.acquire_timeout = options['QUEUE_TIMEOUT']
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._stats = {'evaluations': 0, 'worker_restarts': 0}
+
+    def start(self):
+        # Pre-fork the whole pool so the first submissions don't wait for it
+        with self._lock:
+            missing, self._workers = self.size - self._workers, self.size
+        for _ in range(missing):
+            self._idle.put(SandboxWorker())
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and self._workers < self.size:
+                self._workers += 1
+                return SandboxWorker()
+        try:
+            return self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            raise SandboxError('All sandbox workers are busy')
+
+    def _release(self, worker, healthy):
+        if healthy and worker.alive() and worker.tasks < self.max_tasks:
+            self._idle.put(worker)
+            return
+        worker.close()
+        with self._lock:
+            self._workers -= 1
+            self._stats['worker_restarts'] += 1
+
+    def evaluate(self, code, cases):
+        """Runs ``code`` once per case and returns a result per case:
+        status (ok, error, timeout, output_limit), output and error."""
+        worker = self._acquire()
+        healthy = False
+        try:
+            # Each case is bounded by WALL_SECONDS inside the worker
+            results = worker.run(code, cases, self.limits, self.limits['wall_seconds'] * len(cases) + 5)
+            healthy = True
+        except (OSError, ValueError) as e:
+            raise SandboxError(str(e))
+        finally:
+            self._release(worker, healthy)
+        with self._lock:
+            self._stats['evaluations'] += 1
+        return results
+
+    def close(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
+            with self._lock:
+                self._workers -= 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['workers'] = self._workers
+        stats['idle'] = self._idle.qsize()
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_evaluator_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EvaluatorPool(settings.EXERCISE_SANDBOX)
+            atexit.register(_pool.close)
+        return _pool
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(sender, setting, **kwargs):
+    global _pool
+    if setting == 'EXERCISE_SANDBOX' and _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+def _grade_key(exercise, answer):
+    # The exercise part changes whenever its test cases do
+    version = hashlib.sha256(json.dumps(exercise.test_cases, sort_keys=True).encode()).hexdigest()[:16]
+    digest = hashlib.sha256(normalize_answer(answer).encode()).hexdigest()
+    return f"exercise_grade:{exercise.id}:{version}:{digest}"
+
+
+def grade_answer(exercise, answer):
+    """Runs ``answer`` against ``exercise.test_cases`` in the sandbox and
+    returns ``{'passed': bool, 'cases': [...]}``. Raises SandboxError when
+    the sandbox itself fails; those results are never cached."""
+    options = settings.EXERCISE_SANDBOX
+    cache = caches[options['CACHE_ALIAS']]
+    key = _grade_key(exercise, answer)
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    cases = exercise.test_cases
+    runs = get_evaluator_pool().evaluate(answer, [{'input': case.get('input', '')} for case in cases])
+    graded = []
+    for case, run in zip(cases, runs):
+        passed = run['status'] == 'ok' and outputs_match(run['output'], case.get('output', ''))
+        graded.append({
+            'passed': passed,
+            'status': run['status'] if run['status'] != 'ok' or passed else 'wrong_output',
+            # Hidden cases only say whether they passed
+            'input': None if case.get('hidden') else case.get('input', ''),
+            'expected': None if case.get('hidden') else case.get('output', ''),
+            'output': None if case.get('hidden') else run['output'][:2000],
+            'error': run['error'].strip().splitlines()[-1] if run['error'].strip() else '',
+        })
+    result = {'passed': bool(graded) and all(case['passed'] for case in graded), 'cases': graded}
+    cache.set(key, result, options['RESULT_TTL'])
+    return result
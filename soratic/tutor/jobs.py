@@ -0,0 +1,207 @@
+import time
+import traceback
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+from .context import abuild_context, token_budget
+from .breaker import acomplete
+from .models import Conversation, Job, Message
+from .serializers import MessageSerializer
+from .summaries import asession_summary, schedule_rolling_summary
+from .turns import save_turn
+from .usage import RateLimited, arecord, get_rate_limiter
+
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Registers an async function ``handler(job) -> result`` for jobs of
+    ``kind``. The result must be JSON-serializable. A handler that raises
+    RateLimited is run again once the limit allows, without using up an
+    attempt."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, payload, user=None):
+    return Job.objects.create(kind=kind, payload=payload, user=user, max_attempts=settings.JOB_MAX_ATTEMPTS)
+
+
+async def aenqueue(kind, payload, user=None):
+    return await Job.objects.acreate(kind=kind, payload=payload, user=user, max_attempts=settings.JOB_MAX_ATTEMPTS)
+
+
+def job_accepted(job):
+    return {
+        'job_id': str(job.id),
+        'status': job.status,
+        'status_url': reverse('api_job_status', kwargs={'job_id': job.id}),
+    }
+
+
+def serialize_job(job):
+    return {
+        'id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'result': job.result,
+        'error': job.error,
+        'attempts': job.attempts,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def _runnable(kinds):
+    jobs = Job.objects.filter(status=Job.PENDING, run_after__lte=timezone.now())
+    if kinds:
+        jobs = jobs.filter(kind__in=kinds)
+    return jobs.order_by('run_after', 'created_at')
+
+
+def claim_next(worker_id, kinds=None):
+    """Marks the oldest runnable job as running for ``worker_id`` and
+    returns it, or returns None when the queue is empty."""
+    now = timezone.now()
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: concurrent workers skip rows another worker has locked
+        with transaction.atomic():
+            job = _runnable(kinds).select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            job.status = Job.RUNNING
+            job.locked_by = worker_id
+            job.locked_at = now
+            job.attempts += 1
+            job.save(update_fields=['status', 'locked_by', 'locked_at', 'attempts'])
+            return job
+
+    # SQLite has no row locks: claim with a conditional UPDATE and move on
+    # to the next candidate if another worker got there first
+    for job_id in _runnable(kinds).values_list('id', flat=True)[:10]:
+        claimed = Job.objects.filter(id=job_id, status=Job.PENDING).update(
+            status=Job.RUNNING, locked_by=worker_id, locked_at=now, attempts=F('attempts') + 1
+        )
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def complete(job, result):
+    job.status = Job.SUCCEEDED
+    job.result = result
+    job.error = ''
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+
+
+def fail(job, error):
+    job.error = error
+    if job.attempts < job.max_attempts:
+        # Back off 10s, 20s, 40s, ... before the next attempt
+        job.status = Job.PENDING
+        job.run_after = timezone.now() + timedelta(seconds=10 * 2 ** (job.attempts - 1))
+        job.save(update_fields=['status', 'error', 'run_after'])
+    else:
+        job.status = Job.FAILED
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'finished_at'])
+
+
+def defer(job, seconds):
+    # Back in the queue without using up an attempt
+    job.status = Job.PENDING
+    job.attempts -= 1
+    job.run_after = timezone.now() + timedelta(seconds=seconds)
+    job.save(update_fields=['status', 'attempts', 'run_after'])
+
+
+def release_stale():
+    # Jobs whose worker died mid-run go back to the queue, or fail once
+    # they have used up their attempts, so a job that keeps crashing its
+    # worker is not run forever
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT))
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, error='Worker stopped before the job finished', finished_at=now, locked_by=''
+    )
+    return failed + stale.filter(attempts__lt=F('max_attempts')).update(status=Job.PENDING, locked_by='')
+
+
+async def run_job(job):
+    handler = HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise ValueError(f"No handler for job kind '{job.kind}'")
+        result = await handler(job)
+    except RateLimited as e:
+        await sync_to_async(defer)(job, e.retry_after)
+        return False
+    except Exception:
+        await sync_to_async(fail)(job, traceback.format_exc(limit=5))
+        return False
+    await sync_to_async(complete)(job, result)
+    return True
+
+
+# Handlers for the work the API can defer
+
+def _save_reply(job, conversation, content):
+    # The reply and a note of it on the job commit together, so a retry
+    # finds the reply instead of writing it a second time
+    with transaction.atomic():
+        message, = save_turn(conversation, ('assistant', content))
+        job.payload = dict(job.payload, reply_id=message.id)
+        job.save(update_fields=['payload'])
+    return message
+
+
+def _chat_turn_result(conversation, message):
+    return {'conversation_id': conversation.id, 'version': conversation.version, 'message': MessageSerializer(message).data}
+
+
+@job_handler('chat_turn')
+async def chat_turn(job):
+    # The user message is already saved; answer it like get_ai_response would
+    payload = job.payload
+    conversation = await Conversation.objects.select_related('subject').aget(id=payload['conversation_id'])
+    if payload.get('reply_id'):
+        message = await Message.objects.filter(id=payload['reply_id']).afirst()
+        if message is not None:
+            return _chat_turn_result(conversation, message)
+
+    # The reservation is taken here rather than by the web process that
+    # enqueued the turn: with per-process buckets, only the process that
+    # reserves can settle the reservation against the real usage
+    limiter = get_rate_limiter()
+    reserved = token_budget(conversation.subject)
+    await limiter.areserve(conversation.user_id, reserved)
+
+    messages_for_ai = await abuild_context(conversation, conversation.subject)
+    started = time.monotonic()
+    try:
+        response = await acomplete(
+            settings.LLM_CHAT_PROVIDER,
+            messages=messages_for_ai,
+            temperature=0.7
+        )
+    except Exception:
+        await limiter.asettle(conversation.user_id, -reserved)
+        raise
+    message = await sync_to_async(_save_reply)(job, conversation, response.choices[0].message.content)
+    await arecord(conversation.user_id, 'chat', response.model, response.usage, messages_for_ai, message.content,
+                  time.monotonic() - started, reserved)
+    schedule_rolling_summary(conversation.id)
+    return _chat_turn_result(conversation, message)
+
+
+@job_handler('session_summary')
+async def session_summary(job):
+    conversation = await Conversation.objects.aget(id=job.payload['conversation_id'])
+    return await asession_summary(conversation)
@@ -0,0 +1,256 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import httpx
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from openai import OpenAI, AsyncOpenAI
+
+# One keep-alive client per provider per process. Async clients are bound to
+# the event loop they were created on, and under WSGI every async view runs
+# on a loop of its own that is gone after the request, so async model calls
+# are all made on one long-lived loop per process (acreate, astream), where
+# the clients and their connection pools live. Sync code streams on that loop
+# too, through iterate_on_client_loop.
+_lock = threading.Lock()
+_clients = {}
+_async_clients = {}
+_loop = None
+
+
+def provider_config(name):
+    try:
+        return settings.LLM_PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown LLM provider: {name}")
+
+
+def get_model(name):
+    return provider_config(name)['model']
+
+
+def _client_kwargs(config):
+    return {
+        'base_url': config.get('base_url'),
+        'api_key': config.get('api_key') or 'missing',
+        'max_retries': config.get('max_retries', settings.LLM_MAX_RETRIES),
+    }
+
+
+def _timeout(config):
+    return httpx.Timeout(
+        config.get('timeout', settings.LLM_TIMEOUT),
+        connect=config.get('connect_timeout', settings.LLM_CONNECT_TIMEOUT)
+    )
+
+
+def _limits(config):
+    return httpx.Limits(
+        max_connections=config.get('max_connections', settings.LLM_MAX_CONNECTIONS),
+        max_keepalive_connections=config.get('max_keepalive_connections', settings.LLM_MAX_KEEPALIVE_CONNECTIONS),
+        keepalive_expiry=config.get('keepalive_expiry', settings.LLM_KEEPALIVE_EXPIRY)
+    )
+
+
+def _build_client(name):
+    config = provider_config(name)
+    if config.get('stub'):
+        return StubClient(config)
+    http_client = httpx.Client(timeout=_timeout(config), limits=_limits(config))
+    return OpenAI(http_client=http_client, **_client_kwargs(config))
+
+
+def _build_async_client(name):
+    config = provider_config(name)
+    if config.get('stub'):
+        return AsyncStubClient(config)
+    http_client = httpx.AsyncClient(timeout=_timeout(config), limits=_limits(config))
+    return AsyncOpenAI(http_client=http_client, **_client_kwargs(config))
+
+
+def get_client(name):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = _build_client(name)
+    return client
+
+
+def _client_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='tutor-llm', daemon=True).start()
+        return _loop
+
+
+async def _on_client_loop(coro):
+    loop = _client_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    # Cancelling the caller cancels the call on the client loop too
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def _get_async_client(name):
+    # Only called on the client loop
+    with _lock:
+        if name not in _async_clients:
+            _async_clients[name] = _build_async_client(name)
+        return _async_clients[name]
+
+
+async def _create(name, kwargs):
+    return await _get_async_client(name).chat.completions.create(model=get_model(name), **kwargs)
+
+
+async def acreate(name, **kwargs):
+    """chat.completions.create on the provider's pooled async client."""
+    return await _on_client_loop(_create(name, kwargs))
+
+
+_END = object()
+
+
+async def _next_chunk(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+async def astream(name, **kwargs):
+    """Streams a completion from the provider's pooled async client,
+    reading each chunk on the client loop."""
+    stream = await acreate(name, stream=True, **kwargs)
+    iterator = stream.__aiter__()
+    try:
+        while True:
+            chunk = await _on_client_loop(_next_chunk(iterator))
+            if chunk is _END:
+                return
+            yield chunk
+    finally:
+        # Hands the connection back to the pool when the reader stops early
+        close = getattr(stream, 'close', None) or getattr(stream, 'aclose', None)
+        if close:
+            await _on_client_loop(close())
+
+
+def iterate_on_client_loop(agen):
+    """Iterates the async generator ``agen`` from sync code (e.g. a WSGI
+    streaming response), running it on the client loop."""
+    loop = _client_loop()
+    try:
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(_next_chunk(agen), loop).result()
+            if chunk is _END:
+                return
+            yield chunk
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+def reset_clients():
+    # Drops cached clients, closing their connections; the next call builds
+    # new ones from settings
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        async_clients = list(_async_clients.values())
+        _async_clients.clear()
+        loop = _loop
+    for client in async_clients:
+        asyncio.run_coroutine_threadsafe(client.close(), loop)
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(sender, setting, **kwargs):
+    if setting.startswith('LLM_'):
+        reset_clients()
+
+
+# Local stub provider: answers instantly without network access, for
+# development, tests and load tests that must not reach a paid model.
+def _text(content):
+    # Text of a message, skipping the image parts of multimodal content
+    if isinstance(content, str):
+        return content
+    return ' '.join(part['text'] for part in content if part.get('type') == 'text')
+
+
+def _stub_reply(messages):
+    question = next((_text(m['content']) for m in reversed(messages) if m['role'] == 'user'), '')
+    topic = ' '.join(question.split()[:8]) or 'this'
+    return f"What do you already know about {topic}? What would you try first?"
+
+
+def _stub_usage(messages, reply):
+    prompt_tokens = sum(len(_text(m['content'])) for m in messages) // 4
+    completion_tokens = len(reply) // 4
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens)
+
+
+def _stub_completion(model, messages):
+    reply = _stub_reply(messages)
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(index=0, finish_reason='stop',
+                                 message=SimpleNamespace(role='assistant', content=reply))],
+        usage=_stub_usage(messages, reply)
+    )
+
+
+def _stub_chunks(model, messages, fail_after=None):
+    reply = _stub_reply(messages)
+    words = reply.split(' ')
+    for i, word in enumerate(words):
+        if fail_after is not None and i >= fail_after:
+            raise RuntimeError(f"Stub provider '{model}' dropped the stream")
+        token = word if i == 0 else ' ' + word
+        yield SimpleNamespace(model=model, usage=None,
+                              choices=[SimpleNamespace(index=0, finish_reason=None,
+                                                       delta=SimpleNamespace(content=token))])
+    yield SimpleNamespace(model=model, choices=[], usage=_stub_usage(messages, reply))
+
+
+class StubClient:
+    def __init__(self, config):
+        self.config = config
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model=None, messages=(), stream=False, **kwargs):
+        if self.config.get('fail'):
+            raise RuntimeError(f"Stub provider '{model}' is down")
+        if stream:
+            return _stub_chunks(model, messages, self.config.get('fail_after'))
+        return _stub_completion(model, messages)
+
+    def close(self):
+        pass
+
+
+class AsyncStubClient(StubClient):
+    async def close(self):
+        pass
+
+    async def _create(self, model=None, messages=(), stream=False, **kwargs):
+        # 'delay', 'fail' and 'fail_after' (chunks into a stream) let tests and
+        # load tests mimic a slow or broken provider
+        if self.config.get('delay'):
+            await asyncio.sleep(self.config['delay'])
+        if self.config.get('fail'):
+            raise RuntimeError(f"Stub provider '{model}' is down")
+        if stream:
+            return self._astream(model, messages)
+        return _stub_completion(model, messages)
+
+    async def _astream(self, model, messages):
+        for chunk in _stub_chunks(model, messages, self.config.get('fail_after')):
+            yield chunk
@@ -39,10 +39,15 @@ class Command(BaseCommand):
                     },
                     {
                         'title': 'Control Structures',
-                        'problem_statement': 'Write a program using if-else statements and loops.',
-                        'solution': 'Use if/elif/else for conditions, for/while for loops.',
-                        'hints': ['Consider different conditions', 'Think about repetitive tasks'],
-                        'difficulty': 'medium'
+                        'problem_statement': 'Read a number and print "Positive", "Negative" or "Zero" using if-else statements.',
+                        'solution': 'num = int(input())\nif num > 0:\n    print("Positive")\nelif num < 0:\n    print("Negative")\nelse:\n    print("Zero")',
+                        'hints': ['Use if, elif, else statements', 'Compare the number with 0'],
+                        'difficulty': 'medium',
+                        'test_cases': [
+                            {'input': '5\n', 'output': 'Positive'},
+                            {'input': '-3\n', 'output': 'Negative'},
+                            {'input': '0\n', 'output': 'Zero', 'hidden': True},
+                        ]
                     }
                 ]
             },
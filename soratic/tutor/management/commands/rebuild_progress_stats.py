@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from tutor.rollups import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-subject progress rollups from conversations, messages and progress'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only rebuild this user id (can be repeated)')
+
+    def handle(self, *args, **options):
+        rows = rebuild_stats(options['users'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} progress rollup rows"))
@@ -0,0 +1,47 @@
+import asyncio
+import os
+import socket
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from tutor.jobs import claim_next, release_stale, run_job
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (chat turns, session summaries)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Jobs run at the same time by this worker')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.work(options['concurrency'], options['poll_interval'], options['once']))
+
+    async def work(self, concurrency, poll_interval, once):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stdout.write(f"Worker {worker_id} started with concurrency {concurrency}")
+        claim = sync_to_async(claim_next)
+        running = set()
+        while True:
+            # Like a request would, drop a connection the database has closed
+            # or that is past CONN_MAX_AGE before it fails the next job
+            await sync_to_async(close_old_connections)()
+            await sync_to_async(release_stale)()
+            while len(running) < concurrency:
+                job = await claim(worker_id)
+                if job is None:
+                    break
+                task = asyncio.create_task(run_job(job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+            if once and not running:
+                return
+            if len(running) >= concurrency:
+                await asyncio.wait(running, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(poll_interval)
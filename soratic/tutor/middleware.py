@@ -0,0 +1,64 @@
+import contextvars
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Per-request query counter. A context variable rather than a connection
+# attribute, because async views run their queries on sync_to_async
+# threads, each with its own connection; asgiref copies the context there.
+_query_count = contextvars.ContextVar('tutor_query_count', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def _install_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class QueryCountMiddleware:
+    """Adds an ``X-DB-Query-Count`` header with the number of database
+    queries the request ran. Only loaded when QUERY_COUNT_HEADER is on;
+    meant for benchmarks (see benchmarks/load_test.py), not production."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.QUERY_COUNT_HEADER:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        connection_created.connect(_install_counter, dispatch_uid='tutor_query_count')
+        for connection in connections.all(initialized_only=True):
+            _install_counter(None, connection)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        counter = [0]
+        token = _query_count.set(counter)
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_count.reset(token)
+        response['X-DB-Query-Count'] = str(counter[0])
+        return response
+
+    async def __acall__(self, request):
+        counter = [0]
+        token = _query_count.set(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_count.reset(token)
+        response['X-DB-Query-Count'] = str(counter[0])
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0003_learningpathway_sessionsummary_exercise_userprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subject',
+            name='context_token_budget',
+            field=models.PositiveIntegerField(blank=True, help_text="Prompt token budget for this subject's chats. Leave empty to use CONTEXT_TOKEN_BUDGET.", null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0004_subject_context_token_budget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sessionsummary',
+            name='summarized_through',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sessionsummary',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0005_sessionsummary_rolling'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', '-created_at'], name='tutor_conv_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp'], name='tutor_msg_conv_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprogress',
+            index=models.Index(fields=['user', 'subject', 'completed'], name='tutor_progress_user_subj_idx'),
+        ),
+    ]
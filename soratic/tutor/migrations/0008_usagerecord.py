@@ -0,0 +1,34 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tutor', '0007_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(max_length=20)),
+                ('model', models.CharField(max_length=100)),
+                ('prompt_tokens', models.IntegerField(default=0)),
+                ('completion_tokens', models.IntegerField(default=0)),
+                ('total_tokens', models.IntegerField(default=0)),
+                ('cost', models.DecimalField(decimal_places=6, default=0, max_digits=12)),
+                ('latency_ms', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='llm_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='tutor_usage_user_created_idx')],
+            },
+        ),
+    ]
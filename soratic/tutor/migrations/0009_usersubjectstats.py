@@ -0,0 +1,35 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:44
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tutor', '0008_usagerecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSubjectStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('exercises_attempted', models.IntegerField(default=0)),
+                ('exercises_completed', models.IntegerField(default=0)),
+                ('conversation_count', models.IntegerField(default=0)),
+                ('questions_asked', models.IntegerField(default=0)),
+                ('time_spent', models.DurationField(default=datetime.timedelta(0))),
+                ('last_activity', models.DateTimeField(blank=True, null=True)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_stats', to='tutor.subject')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subject_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'subject')},
+            },
+        ),
+    ]
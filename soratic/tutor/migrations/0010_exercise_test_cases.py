@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0009_usersubjectstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exercise',
+            name='test_cases',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-16 22:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0010_exercise_test_cases'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def populate_slugs(apps, schema_editor):
+    Subject = apps.get_model('tutor', 'Subject')
+    taken = set()
+    for subject in Subject.objects.order_by('id'):
+        base = slugify(subject.name) or f'subject-{subject.id}'
+        slug, counter = base, 2
+        while slug in taken:
+            slug = f'{base}-{counter}'
+            counter += 1
+        taken.add(slug)
+        subject.slug = slug
+        subject.save(update_fields=['slug'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0011_userprofile_avatar_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subject',
+            name='slug',
+            field=models.SlugField(default='', max_length=100, db_index=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='subject',
+            name='slug',
+            field=models.SlugField(max_length=100, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0012_subject_slug'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.23 on 2026-10-17 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0013_conversation_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subject',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
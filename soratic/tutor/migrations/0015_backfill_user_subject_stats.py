@@ -0,0 +1,75 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Max, Q, Sum
+
+
+def backfill_stats(apps, schema_editor):
+    # The rollups are kept up to date by deltas, so they need a correct
+    # starting point for the conversations and progress that predate them.
+    # This is tutor.rollups.rebuild_stats written against the historical
+    # models, so later changes to the live ones don't break it.
+    Conversation = apps.get_model('tutor', 'Conversation')
+    Message = apps.get_model('tutor', 'Message')
+    UserProgress = apps.get_model('tutor', 'UserProgress')
+    UserSubjectStats = apps.get_model('tutor', 'UserSubjectStats')
+    if not Conversation.objects.exists() and not UserProgress.objects.exists():
+        return
+
+    rows = {}
+
+    def row(user_id, subject_id):
+        return rows.setdefault((user_id, subject_id), UserSubjectStats(user_id=user_id, subject_id=subject_id))
+
+    for item in (Conversation.objects.values('user_id', 'subject_id')
+                 .annotate(conversations=Count('id', distinct=True),
+                           questions=Count('messages', filter=Q(messages__role='user')))
+                 .order_by()):
+        stats = row(item['user_id'], item['subject_id'])
+        stats.conversation_count = item['conversations']
+        stats.questions_asked = item['questions']
+
+    latest = {}
+    for item in (UserProgress.objects.values('user_id', 'subject_id')
+                 .annotate(attempted=Count('id'), completed=Count('id', filter=Q(completed=True)),
+                           time=Sum('time_spent'), latest=Max('created_at'))
+                 .order_by()):
+        stats = row(item['user_id'], item['subject_id'])
+        stats.exercises_attempted = item['attempted']
+        stats.exercises_completed = item['completed']
+        stats.time_spent = item['time'] or timedelta(0)
+        latest[(item['user_id'], item['subject_id'])] = [item['latest']]
+
+    for item in Conversation.objects.values('user_id', 'subject_id').annotate(latest=Max('created_at')).order_by():
+        latest.setdefault((item['user_id'], item['subject_id']), []).append(item['latest'])
+
+    # Chat time: short gaps between a student's messages in a subject
+    gap_limit = timedelta(minutes=getattr(settings, 'ACTIVITY_SESSION_GAP_MINUTES', 30))
+    chat_time, last_message = {}, {}
+    messages = (Message.objects.order_by('conversation__user_id', 'conversation__subject_id', 'timestamp')
+                .values_list('conversation__user_id', 'conversation__subject_id', 'timestamp'))
+    for user_id, subject_id, timestamp in messages.iterator(chunk_size=2000):
+        key = (user_id, subject_id)
+        previous = last_message.get(key)
+        if previous is not None and timestamp - previous <= gap_limit:
+            chat_time[key] = chat_time.get(key, timedelta(0)) + (timestamp - previous)
+        last_message[key] = timestamp
+
+    for key, stats in rows.items():
+        stats.time_spent += chat_time.get(key, timedelta(0))
+        stats.last_message_at = last_message.get(key)
+        stats.last_activity = max(filter(None, latest.get(key, []) + [stats.last_message_at]), default=None)
+
+    UserSubjectStats.objects.all().delete()
+    UserSubjectStats.objects.bulk_create(rows.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0014_subject_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-16 23:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutor', '0015_backfill_user_subject_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='partial',
+            field=models.BooleanField(default=False),
+        ),
+    ]
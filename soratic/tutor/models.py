@@ -1,13 +1,30 @@
+import uuid
+from datetime import timedelta
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils.text import slugify
 
 # Create your models here.
 class Subject(models.Model):
     name = models.CharField(max_length=100)
+    # URL-safe key the client sends ("physics", "python-programming")
+    slug = models.SlugField(max_length=100, unique=True)
     description = models.TextField(blank=True)
     # The system prompt for the AI agent for this subject
     system_prompt = models.TextField(help_text="The specialized system prompt for this subject's AI tutor.")
+    context_token_budget = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Prompt token budget for this subject's chats. Leave empty to use CONTEXT_TOKEN_BUDGET."
+    )
+    # Lets every process notice edits to the subject catalog (tutor/catalog.py)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        if not self.slug:
+            self.slug = slugify(self.name)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -17,6 +34,14 @@ class Conversation(models.Model):
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
     title = models.CharField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Bumped by every saved chat turn, so clients can tell which turns they have
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Sidebar: a user's conversations, newest first
+            models.Index(fields=['user', '-created_at'], name='tutor_conv_user_created_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('chat', kwargs={'conversation_id': self.id})
@@ -32,10 +57,16 @@ class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
+    # A streamed reply cut short by the provider or by the client leaving
+    partial = models.BooleanField(default=False)
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Transcripts and recent-context windows read one conversation in time order
+            models.Index(fields=['conversation', 'timestamp'], name='tutor_msg_conv_ts_idx'),
+        ]
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
@@ -43,6 +74,8 @@ class Message(models.Model):
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     profile_picture = models.ImageField(upload_to='profile_pics/', blank=True, null=True)
+    # SHA-256 of the uploaded picture; its variants live under avatars/ (tutor/avatars.py)
+    avatar_hash = models.CharField(max_length=64, blank=True)
     
     def __str__(self):
         return f"{self.user.username}'s Profile"
@@ -66,6 +99,8 @@ class Exercise(models.Model):
     hints = models.JSONField(default=list)
     solution = models.TextField()
     difficulty = models.CharField(max_length=20, choices=[('easy', 'Easy'), ('medium', 'Medium'), ('hard', 'Hard')])
+    # Python exercises: [{"input": stdin, "output": expected stdout, "hidden": bool}]
+    test_cases = models.JSONField(default=list, blank=True)
     
     def __str__(self):
         return self.title
@@ -82,6 +117,9 @@ class UserProgress(models.Model):
     
     class Meta:
         unique_together = ['user', 'exercise']
+        indexes = [
+            models.Index(fields=['user', 'subject', 'completed'], name='tutor_progress_user_subj_idx'),
+        ]
 
 class SessionSummary(models.Model):
     conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE)
@@ -90,7 +128,87 @@ class SessionSummary(models.Model):
     questions_asked = models.IntegerField(default=0)
     time_spent = models.DurationField(null=True, blank=True)
     ai_summary = models.TextField(blank=True)
+    # Id of the newest message folded into ai_summary; later messages are
+    # still sent to the model verbatim
+    summarized_through = models.BigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
-        return f"Summary: {self.conversation.title}"
\ No newline at end of file
+        return f"Summary: {self.conversation.title}"
+
+class Job(models.Model):
+    # Background work (LLM calls) picked up by `manage.py run_tutor_worker`
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers poll for the oldest runnable job
+            models.Index(fields=['status', 'run_after'], name='tutor_job_status_run_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} ({self.status})"
+
+class UsageRecord(models.Model):
+    # One row per upstream LLM call, with the provider's token counts
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='llm_usage')
+    endpoint = models.CharField(max_length=20)
+    model = models.CharField(max_length=100)
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    total_tokens = models.IntegerField(default=0)
+    cost = models.DecimalField(max_digits=12, decimal_places=6, default=0)
+    latency_ms = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='tutor_usage_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} {self.model} ({self.total_tokens} tokens)"
+
+class UserSubjectStats(models.Model):
+    # Per (user, subject) rollup kept current by tutor.rollups, so the
+    # dashboards don't scan progress and message history. Rebuild with
+    # `manage.py rebuild_progress_stats`.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='subject_stats')
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE, related_name='user_stats')
+    exercises_attempted = models.IntegerField(default=0)
+    exercises_completed = models.IntegerField(default=0)
+    conversation_count = models.IntegerField(default=0)
+    questions_asked = models.IntegerField(default=0)
+    time_spent = models.DurationField(default=timedelta(0))
+    last_activity = models.DateTimeField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ['user', 'subject']
+
+    def __str__(self):
+        return f"{self.user.username} / {self.subject.name}"
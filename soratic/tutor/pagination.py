@@ -0,0 +1,8 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ConversationCursorPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-created_at', '-id')
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from .cache_utils import bump_version, get_version
+
+# Cache for first-turn Socratic answers. Entries are keyed by subject,
+# system prompt hash and normalized question; an optional similarity index
+# lets near-identical phrasings ("what's a variable?") reuse an answer too.
+
+
+def prompt_hash(system_prompt):
+    return hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+
+
+def normalize(message):
+    message = re.sub(r"[^\w\s]", " ", message.lower())
+    return " ".join(message.split())
+
+
+def embed(text, dimensions=256):
+    # Dependency-free stand-in for an embedding model: hashed unigrams and
+    # bigrams, L2-normalized. Swap in a real one via RESPONSE_CACHE['EMBEDDER'].
+    words = text.split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    vector = [0.0] * dimensions
+    for feature in features:
+        digest = hashlib.md5(feature.encode()).digest()
+        vector[int.from_bytes(digest[:4], 'big') % dimensions] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def cosine(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self, options):
+        self.max_entries = options['MAX_ENTRIES']
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileBackend:
+    # One JSON file per entry, shared by every worker on the host. Reads
+    # touch the file so eviction by mtime approximates LRU.
+    blocking = True
+
+    def __init__(self, options):
+        self.path = options['PATH']
+        self.max_entries = options['MAX_ENTRIES']
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{hashlib.sha256(key.encode()).hexdigest()}.json")
+
+    def get(self, key):
+        path = self._file(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] < time.time():
+            self._remove(path)
+            return None
+        os.utime(path)
+        return entry['value']
+
+    def set(self, key, value, ttl):
+        path = self._file(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'expires': time.time() + ttl, 'value': value}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.path) if entry.name.endswith('.json')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            self._remove(entry.path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.json'):
+                self._remove(entry.path)
+
+
+class DjangoCacheBackend:
+    # Delegates to a Django cache alias, e.g. Redis or Memcached in
+    # production; the cache server handles expiry and eviction. The alias is
+    # usually shared with rate limits and version counters, so clearing bumps
+    # a version in the keys instead of wiping the cache; old entries expire.
+    blocking = True
+
+    def __init__(self, options):
+        self.alias = options['CACHE_ALIAS']
+        self.cache = caches[self.alias]
+
+    def _key(self, key):
+        return f"response_cache:{get_version('response_cache', self.alias)}:{key}"
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value, ttl):
+        self.cache.set(self._key(key), value, ttl)
+
+    def clear(self):
+        bump_version('response_cache', self.alias)
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'file': FileBackend,
+    'django': DjangoCacheBackend,
+}
+
+
+class ResponseCache:
+    def __init__(self, options):
+        self.ttl = options['TTL']
+        self.threshold = options['SIMILARITY_THRESHOLD']
+        self.backend = BACKENDS[options['BACKEND']](options)
+        self.embed = import_string(options['EMBEDDER']) if options.get('EMBEDDER') else embed
+        self.index_size = options['INDEX_SIZE']
+        # (subject, prompt hash) -> OrderedDict of normalized question -> vector,
+        # kept small because lookups scan it linearly
+        self._index = {}
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'similar_hits': 0, 'misses': 0, 'stores': 0}
+
+    def _key(self, subject, system_hash, question):
+        # Hashed: questions are client text of any length, and cache servers
+        # like Memcached take short keys without spaces
+        return hashlib.sha256(f"{subject}:{system_hash}:{question}".encode()).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _nearest(self, scope, vector):
+        with self._lock:
+            candidates = list(self._index.get(scope, {}).items())
+        best, best_score = None, self.threshold
+        for question, other in candidates:
+            score = cosine(vector, other)
+            if score >= best_score:
+                best, best_score = question, score
+        return best
+
+    def _remember(self, scope, question, vector):
+        with self._lock:
+            index = self._index.setdefault(scope, OrderedDict())
+            index[question] = vector
+            index.move_to_end(question)
+            while len(index) > self.index_size:
+                index.popitem(last=False)
+
+    def get(self, subject, system_prompt, message, system_hash=None):
+        system_hash = system_hash or prompt_hash(system_prompt)
+        question = normalize(message)
+        value = self.backend.get(self._key(subject, system_hash, question))
+        if value is not None:
+            self._count('hits')
+            return value
+        if self.threshold:
+            scope = (subject, system_hash)
+            similar = self._nearest(scope, self.embed(question))
+            if similar is not None:
+                value = self.backend.get(self._key(subject, system_hash, similar))
+                if value is not None:
+                    self._count('similar_hits')
+                    return value
+        self._count('misses')
+        return None
+
+    def set(self, subject, system_prompt, message, value, system_hash=None):
+        system_hash = system_hash or prompt_hash(system_prompt)
+        question = normalize(message)
+        self.backend.set(self._key(subject, system_hash, question), value, self.ttl)
+        if self.threshold:
+            self._remember((subject, system_hash), question, self.embed(question))
+        self._count('stores')
+
+    async def aget(self, subject, system_prompt, message, system_hash=None):
+        if self.backend.blocking:
+            return await sync_to_async(self.get, thread_sensitive=False)(subject, system_prompt, message, system_hash)
+        return self.get(subject, system_prompt, message, system_hash)
+
+    async def aset(self, subject, system_prompt, message, value, system_hash=None):
+        if self.backend.blocking:
+            return await sync_to_async(self.set, thread_sensitive=False)(subject, system_prompt, message, value, system_hash)
+        return self.set(subject, system_prompt, message, value, system_hash)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._index.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['similar_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['similar_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(settings.RESPONSE_CACHE)
+    return _cache
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(sender, setting, **kwargs):
+    global _cache
+    if setting == 'RESPONSE_CACHE':
+        _cache = None
@@ -0,0 +1,153 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (Case, Count, DurationField, ExpressionWrapper, F, Max, Q, Sum, Value,
+                              When)
+from django.utils import timezone
+from .models import Conversation, Message, UserProgress, UserSubjectStats
+
+# Incremental updates to UserSubjectStats. Signals (tutor.signals) call these
+# for ordinary saves; code that writes with update() or bulk_create() must
+# call them itself, since those skip signals.
+#
+# Time spent is active chat time, counting the gap between consecutive
+# messages in a subject when it is under ACTIVITY_SESSION_GAP_MINUTES, plus
+# the time_spent recorded on exercise progress.
+
+
+def _session_gap():
+    return timedelta(minutes=settings.ACTIVITY_SESSION_GAP_MINUTES)
+
+
+def _update(user_id, subject_id, **updates):
+    # One UPDATE when the row exists, which is almost always; create it first otherwise
+    rows = UserSubjectStats.objects.filter(user_id=user_id, subject_id=subject_id)
+    if not rows.update(**updates):
+        UserSubjectStats.objects.get_or_create(user_id=user_id, subject_id=subject_id)
+        rows.update(**updates)
+
+
+def conversation_started(conversation):
+    _update(conversation.user_id, conversation.subject_id,
+            conversation_count=F('conversation_count') + 1,
+            last_activity=conversation.created_at)
+
+
+def conversation_deleted(conversation, questions):
+    UserSubjectStats.objects.filter(user_id=conversation.user_id, subject_id=conversation.subject_id).update(
+        conversation_count=F('conversation_count') - 1,
+        questions_asked=F('questions_asked') - questions
+    )
+
+
+def message_added(conversation, message):
+    messages_added(conversation, [message])
+
+
+def messages_added(conversation, messages):
+    """Updates the stats for new messages of one conversation, oldest
+    first, in a single UPDATE."""
+    first, last = messages[0], messages[-1]
+    # The gap since the previous message is worked out in the UPDATE itself,
+    # the gaps between the new messages here
+    gap = ExpressionWrapper(Value(first.timestamp) - F('last_message_at'), output_field=DurationField())
+    active = Case(
+        When(last_message_at__lt=first.timestamp,
+             last_message_at__gte=first.timestamp - _session_gap(), then=gap),
+        default=Value(timedelta(0)),
+        output_field=DurationField()
+    )
+    between = timedelta(0)
+    for previous, message in zip(messages, messages[1:]):
+        if timedelta(0) < message.timestamp - previous.timestamp <= _session_gap():
+            between += message.timestamp - previous.timestamp
+    _update(conversation.user_id, conversation.subject_id,
+            questions_asked=F('questions_asked') + sum(1 for message in messages if message.role == 'user'),
+            time_spent=F('time_spent') + active + Value(between),
+            last_activity=last.timestamp,
+            last_message_at=last.timestamp)
+
+
+def progress_changed(user_id, subject_id, attempted=0, completed=0, time_spent=None):
+    """Adds deltas: ``attempted`` for new progress rows, ``completed`` for
+    exercises that became (1) or stopped being (-1) completed."""
+    if not (attempted or completed or time_spent):
+        return
+    updates = {}
+    if attempted:
+        updates['exercises_attempted'] = F('exercises_attempted') + attempted
+    if completed:
+        updates['exercises_completed'] = F('exercises_completed') + completed
+    if time_spent:
+        updates['time_spent'] = F('time_spent') + time_spent
+    if attempted > 0 or completed > 0:
+        updates['last_activity'] = timezone.now()
+    _update(user_id, subject_id, **updates)
+
+
+def _chat_time(user_ids):
+    # Walks messages in time order per (user, subject), summing short gaps
+    totals, last_seen = {}, {}
+    messages = (Message.objects.filter(conversation__user_id__in=user_ids) if user_ids is not None
+                else Message.objects.all())
+    rows = (messages.order_by('conversation__user_id', 'conversation__subject_id', 'timestamp')
+            .values_list('conversation__user_id', 'conversation__subject_id', 'timestamp'))
+    gap_limit = _session_gap()
+    for user_id, subject_id, timestamp in rows.iterator(chunk_size=2000):
+        key = (user_id, subject_id)
+        previous = last_seen.get(key)
+        if previous is not None and timestamp - previous <= gap_limit:
+            totals[key] = totals.get(key, timedelta(0)) + (timestamp - previous)
+        last_seen[key] = timestamp
+    return totals, last_seen
+
+
+def rebuild_stats(user_ids=None):
+    """Recomputes UserSubjectStats from conversations, messages and
+    progress, for ``user_ids`` or for everyone. Returns the row count."""
+    conversations = Conversation.objects.all()
+    progress = UserProgress.objects.all()
+    if user_ids is not None:
+        conversations = conversations.filter(user_id__in=user_ids)
+        progress = progress.filter(user_id__in=user_ids)
+
+    rows = {}
+
+    def row(user_id, subject_id):
+        return rows.setdefault((user_id, subject_id), UserSubjectStats(user_id=user_id, subject_id=subject_id))
+
+    for item in (conversations.values('user_id', 'subject_id')
+                 .annotate(conversations=Count('id', distinct=True),
+                           questions=Count('messages', filter=Q(messages__role='user')))
+                 .order_by()):
+        stats = row(item['user_id'], item['subject_id'])
+        stats.conversation_count = item['conversations']
+        stats.questions_asked = item['questions']
+
+    latest = {}
+    for item in (progress.values('user_id', 'subject_id')
+                 .annotate(attempted=Count('id'), completed=Count('id', filter=Q(completed=True)),
+                           time=Sum('time_spent'), latest=Max('created_at'))
+                 .order_by()):
+        stats = row(item['user_id'], item['subject_id'])
+        stats.exercises_attempted = item['attempted']
+        stats.exercises_completed = item['completed']
+        stats.time_spent = item['time'] or timedelta(0)
+        latest[(item['user_id'], item['subject_id'])] = [item['latest']]
+
+    for item in conversations.values('user_id', 'subject_id').annotate(latest=Max('created_at')).order_by():
+        latest.setdefault((item['user_id'], item['subject_id']), []).append(item['latest'])
+
+    chat_time, last_message = _chat_time(user_ids)
+    for key, stats in rows.items():
+        stats.time_spent += chat_time.get(key, timedelta(0))
+        stats.last_message_at = last_message.get(key)
+        stats.last_activity = max(filter(None, latest.get(key, []) + [stats.last_message_at]), default=None)
+
+    with transaction.atomic():
+        existing = UserSubjectStats.objects.all()
+        if user_ids is not None:
+            existing = existing.filter(user_id__in=user_ids)
+        existing.delete()
+        UserSubjectStats.objects.bulk_create(rows.values(), batch_size=500)
+    return len(rows)
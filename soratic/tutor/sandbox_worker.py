@@ -0,0 +1,151 @@
+"""Sandbox worker for grading exercise answers (see tutor/grader.py).
+
+Runs as ``python -I sandbox_worker.py`` with an empty environment, so it
+imports nothing from the project. It reads one JSON request per line on
+stdin, ``{"code": ..., "cases": [{"input": ..., "output": ...}], "limits":
+{...}}``, and writes one JSON reply per line on stdout.
+
+Each test case runs in a child forked from this already-warm interpreter.
+The child gets CPU, memory and file-size limits, and an audit hook that
+refuses file access, sockets, subprocesses and imports of anything not
+preloaded below. The parent enforces the wall-clock and output limits.
+"""
+import json
+import os
+import resource
+import select
+import signal
+import sys
+import time
+import traceback
+
+# The only modules answers can import; they are loaded before the audit hook
+# goes in, so importing them again is a dictionary lookup, not a file open
+import bisect, collections, copy, datetime, decimal, fractions, functools, heapq, itertools  # noqa: E401,F401
+import math, operator, random, re, statistics, string, textwrap  # noqa: E401,F401
+
+BLOCKED_EVENTS = ('open', 'import', 'socket.', 'subprocess.', 'os.', 'shutil.', 'ctypes.', 'pty.', 'fcntl.',
+                  'resource.', 'signal.', 'sys.addaudithook', 'sys.settrace', 'sys.setprofile', 'code.', 'mmap.')
+
+
+def _audit(event, args):
+    if event.startswith(BLOCKED_EVENTS):
+        raise PermissionError(f"{event} is not allowed in exercise answers")
+
+
+def _run_child(code, stdin_fd, stdout_fd, stderr_fd, limits):
+    os.dup2(stdin_fd, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    for fd in (stdin_fd, stdout_fd, stderr_fd):
+        os.close(fd)
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False)
+
+    cpu = limits['cpu_seconds']
+    memory = limits['memory_mb'] * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    sys.addaudithook(_audit)
+
+    status = 0
+    try:
+        exec(compile(code, '<answer>', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 0
+    except BaseException:
+        # Only the answer's own frames are useful to the student
+        error_type, error, tb = sys.exc_info()
+        frames = [frame for frame in traceback.extract_tb(tb) if frame.filename == '<answer>']
+        if frames:
+            sys.stderr.write('Traceback (most recent call last):\n' + ''.join(traceback.format_list(frames)))
+        sys.stderr.write(''.join(traceback.format_exception_only(error_type, error)))
+        status = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(status)
+
+
+def _run_case(code, case, limits):
+    stdin_read, stdin_write = os.pipe()
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    data = str(case.get('input', '')).encode()
+
+    pid = os.fork()
+    if pid == 0:
+        for fd in (stdin_write, stdout_read, stderr_read):
+            os.close(fd)
+        _run_child(code, stdin_read, stdout_write, stderr_write, limits)
+    for fd in (stdin_read, stdout_write, stderr_write):
+        os.close(fd)
+
+    # Case inputs must fit the pipe buffer; anything the answer doesn't read is dropped
+    try:
+        os.write(stdin_write, data[:60000])
+    except OSError:
+        pass
+    os.close(stdin_write)
+
+    buffers = {stdout_read: bytearray(), stderr_read: bytearray()}
+    open_fds = set(buffers)
+    deadline = time.monotonic() + limits['wall_seconds']
+    result = None
+    while open_fds and result is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            result = 'timeout'
+            break
+        ready, _, _ = select.select(list(open_fds), [], [], remaining)
+        for fd in ready:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                open_fds.discard(fd)
+                continue
+            buffers[fd] += chunk
+            if len(buffers[fd]) > limits['output_bytes']:
+                result = 'output_limit'
+    for fd in buffers:
+        os.close(fd)
+    # An answer can close its output and keep running, so wait against the deadline too
+    while result is None:
+        waited, wait_status = os.waitpid(pid, os.WNOHANG)
+        if waited:
+            break
+        if time.monotonic() >= deadline:
+            result = 'timeout'
+        else:
+            time.sleep(0.005)
+    if result is not None:
+        os.kill(pid, signal.SIGKILL)
+        _, wait_status = os.waitpid(pid, 0)
+
+    stdout = bytes(buffers[stdout_read][:limits['output_bytes']])
+    stderr = bytes(buffers[stderr_read][:limits['output_bytes']])
+    if result is None and os.WIFSIGNALED(wait_status):
+        # SIGXCPU (or SIGKILL past the hard limit) means the CPU limit was hit
+        result = 'timeout' if os.WTERMSIG(wait_status) in (signal.SIGXCPU, signal.SIGKILL) else 'error'
+    elif result is None and os.WEXITSTATUS(wait_status) != 0:
+        result = 'error'
+    return result or 'ok', stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+
+def main():
+    for line in sys.stdin:
+        request = json.loads(line)
+        results = []
+        for case in request['cases']:
+            status, stdout, stderr = _run_case(request['code'], case, request['limits'])
+            results.append({'status': status, 'output': stdout, 'error': stderr})
+        sys.stdout.write(json.dumps({'results': results}) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
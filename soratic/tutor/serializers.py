@@ -10,12 +10,12 @@ class UserSerializer(serializers.ModelSerializer):
 class SubjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subject
-        fields = ['id', 'name', 'description']
+        fields = ['id', 'name', 'slug', 'description']
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['id', 'role', 'content', 'timestamp']
+        fields = ['id', 'role', 'content', 'partial', 'timestamp']
 
 class ConversationSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(many=True, read_only=True)
@@ -23,7 +23,18 @@ class ConversationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
-        fields = ['id', 'title', 'subject', 'created_at', 'messages']
+        fields = ['id', 'title', 'subject', 'created_at', 'version', 'messages']
+
+class ConversationListSerializer(serializers.ModelSerializer):
+    # Sidebar rows; expects the annotations from get_conversations
+    subject_name = serializers.CharField(source='subject.name', read_only=True)
+    message_count = serializers.IntegerField(read_only=True)
+    last_message = serializers.CharField(read_only=True, allow_null=True)
+    last_message_at = serializers.DateTimeField(read_only=True, allow_null=True)
+    
+    class Meta:
+        model = Conversation
+        fields = ['id', 'title', 'subject_name', 'created_at', 'message_count', 'last_message', 'last_message_at']
 
 class LearningPathwaySerializer(serializers.ModelSerializer):
     class Meta:
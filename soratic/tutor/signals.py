@@ -0,0 +1,81 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .auth import token_cache
+from .cache_utils import bump_version
+from . import rollups
+from .catalog import invalidate_catalog
+from .models import Conversation, Message, Subject, UserProgress
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=Conversation)
+@receiver([post_save, post_delete], sender=UserProgress)
+@receiver(post_save, sender=Message)
+def invalidate_admin_students(sender, **kwargs):
+    bump_version('admin_students')
+
+
+@receiver([post_save, post_delete], sender=Subject)
+def invalidate_subject_catalog(sender, **kwargs):
+    # Again on commit, so no process reloads the catalog before the change is visible
+    invalidate_catalog()
+    transaction.on_commit(invalidate_catalog)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    token_cache.invalidate_key(instance.key)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user_tokens(sender, instance, **kwargs):
+    # Covers deactivation and deletion, e.g. through admin_delete_student
+    token_cache.invalidate_user(instance.pk)
+
+
+# Keep UserSubjectStats in step with ordinary saves and deletes
+@receiver(post_save, sender=Conversation)
+def rollup_conversation(sender, instance, created, **kwargs):
+    if created:
+        rollups.conversation_started(instance)
+
+
+@receiver(pre_delete, sender=Conversation)
+def rollup_conversation_deleted(sender, instance, **kwargs):
+    questions = Message.objects.filter(conversation=instance, role='user').count()
+    rollups.conversation_deleted(instance, questions)
+
+
+@receiver(post_save, sender=Message)
+def rollup_message(sender, instance, created, **kwargs):
+    if created:
+        rollups.message_added(instance.conversation, instance)
+
+
+@receiver(post_init, sender=UserProgress)
+def remember_progress_state(sender, instance, **kwargs):
+    instance._completed_before = instance.completed if instance.pk else False
+
+
+@receiver(post_save, sender=UserProgress)
+def rollup_progress(sender, instance, created, **kwargs):
+    rollups.progress_changed(
+        instance.user_id, instance.subject_id,
+        attempted=1 if created else 0,
+        completed=int(instance.completed) - int(instance._completed_before),
+        time_spent=instance.time_spent if created else None
+    )
+    instance._completed_before = instance.completed
+
+
+@receiver(post_delete, sender=UserProgress)
+def rollup_progress_deleted(sender, instance, **kwargs):
+    rollups.progress_changed(
+        instance.user_id, instance.subject_id,
+        attempted=-1,
+        completed=-1 if instance.completed else 0,
+        time_spent=-instance.time_spent if instance.time_spent else None
+    )
@@ -0,0 +1,123 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Single-flight for identical LLM prompts: while one request is waiting on
+# the provider, others with the same key wait for its answer instead of
+# starting their own call. Within a process this works across threads and
+# event loops; with SINGLE_FLIGHT['CACHE_ALIAS'] pointing at a cache every
+# worker shares (Redis, Memcached), across workers as well.
+
+
+def flight_key(model, messages, temperature):
+    payload = json.dumps([model, messages, temperature], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, options):
+        self.cache = caches[options['CACHE_ALIAS']] if options.get('CACHE_ALIAS') else None
+        self.lock_timeout = options['LOCK_TIMEOUT']
+        self.poll_interval = options['POLL_INTERVAL']
+        self.result_ttl = options['RESULT_TTL']
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {'leaders': 0, 'followers': 0, 'shared_followers': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    async def ado(self, key, func):
+        """Returns ``await func()``, sharing one call among concurrent
+        callers with the same ``key``. The result must be JSON-serializable
+        when a shared cache is configured."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            self._count('followers')
+            # Shielded, so a follower that is cancelled (e.g. its client went
+            # away) doesn't cancel the call for the leader and everyone else
+            return await asyncio.shield(asyncio.wrap_future(future))
+
+        try:
+            result = await self._shared(key, func)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        else:
+            if not future.done():
+                future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if not future.done():
+                future.cancel()
+
+    async def _shared(self, key, func):
+        if self.cache is None:
+            self._count('leaders')
+            return await func()
+
+        cache_call = lambda method, *args: sync_to_async(getattr(self.cache, method), thread_sensitive=False)(*args)
+        lock_key, result_key = f"singleflight:lock:{key}", f"singleflight:result:{key}"
+        if await cache_call('add', lock_key, 1, self.lock_timeout):
+            self._count('leaders')
+            try:
+                result = await func()
+                await cache_call('set', result_key, result, self.result_ttl)
+                return result
+            finally:
+                await cache_call('delete', lock_key)
+
+        # Another worker is already asking. The leader stores its result
+        # before releasing the lock, so a missing lock and no result means
+        # it failed and this request should try on its own.
+        self._count('shared_followers')
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            locked = await cache_call('get', lock_key)
+            result = await cache_call('get', result_key)
+            if result is not None:
+                return result
+            if not locked:
+                break
+        return await func()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._calls))
+
+
+_flight = None
+_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    global _flight
+    if _flight is None:
+        with _flight_lock:
+            if _flight is None:
+                _flight = SingleFlight(settings.SINGLE_FLIGHT)
+    return _flight
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(sender, setting, **kwargs):
+    global _flight
+    if setting == 'SINGLE_FLIGHT':
+        _flight = None
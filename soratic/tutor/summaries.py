@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, Max, Min, Q
+from .batching import abatched_complete
+from .usage import arecord
+from .models import Conversation, Message, SessionSummary
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a tutoring session. You are given the summary so far "
+    "(possibly empty) and the turns that happened since. Reply with JSON only, in the form "
+    '{"summary": "...", "topics": ["..."], "key_concepts": ["..."]}. '
+    "The summary should be 2-4 sentences about what the student explored, what they understood "
+    "and where they struggled; topics and key_concepts cover the whole session so far."
+)
+
+
+def parse_summary(content):
+    content = content.strip()
+    # Models like to wrap JSON in a code fence
+    content = content.removeprefix('```json').removeprefix('```').removesuffix('```')
+    try:
+        result = json.loads(content)
+    except ValueError:
+        return {'summary': content.strip()}
+    return result if isinstance(result, dict) else {'summary': content.strip()}
+
+
+async def asummarize(summary, messages, user_id=None):
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt = (
+        f"Summary so far:\n{summary.ai_summary or '(none)'}\n"
+        f"Topics so far: {', '.join(summary.topics_covered) or '(none)'}\n"
+        f"Key concepts so far: {', '.join(summary.key_concepts) or '(none)'}\n\n"
+        f"New turns:\n{transcript}"
+    )
+    prompt_messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    started = time.monotonic()
+    # Summaries can wait a moment, so they go out in batches behind chat
+    completion = await abatched_complete(
+        settings.LLM_SUMMARY_PROVIDER,
+        messages=prompt_messages,
+        temperature=0.2,
+        max_tokens=512
+    )
+    content = completion.choices[0].message.content
+    await arecord(user_id, 'summary', completion.model, completion.usage, prompt_messages, content,
+                  time.monotonic() - started)
+    return parse_summary(content)
+
+
+async def afold(conversation, keep_recent=0, min_messages=1):
+    """Folds the messages not yet covered by the conversation's
+    SessionSummary into its ``ai_summary``, except the newest
+    ``keep_recent`` ones, which chat turns still send verbatim.
+
+    Does nothing unless at least ``min_messages`` messages can be folded.
+    """
+    summary, created = await SessionSummary.objects.aget_or_create(conversation=conversation)
+    pending = [msg async for msg in Message.objects.filter(
+        conversation=conversation, id__gt=summary.summarized_through
+    ).order_by('timestamp', 'id').values('id', 'role', 'content')]
+    foldable = pending[:len(pending) - keep_recent] if keep_recent else pending
+    if len(foldable) < min_messages:
+        return summary
+
+    result = await asummarize(summary, foldable, user_id=conversation.user_id)
+    # Only advance if nobody folded these turns while the model was busy
+    await SessionSummary.objects.filter(
+        pk=summary.pk, summarized_through=summary.summarized_through
+    ).aupdate(
+        ai_summary=result.get('summary') or summary.ai_summary,
+        topics_covered=result.get('topics') or summary.topics_covered,
+        key_concepts=result.get('key_concepts') or summary.key_concepts,
+        summarized_through=foldable[-1]['id']
+    )
+    return await SessionSummary.objects.aget(pk=summary.pk)
+
+
+async def asession_summary(conversation):
+    """Brings the conversation's SessionSummary up to date and returns it
+    in the shape the session summary endpoint serves."""
+    # Fold the older turns the rolling summary hasn't covered yet, but leave
+    # the recent ones that chat turns send verbatim where they are. They are
+    # summarized on top for this response only, without moving the marker.
+    try:
+        summary = await afold(conversation, keep_recent=settings.ROLLING_SUMMARY_KEEP_MESSAGES)
+        recent = [msg async for msg in Message.objects.filter(
+            conversation=conversation, id__gt=summary.summarized_through
+        ).order_by('timestamp', 'id').values('role', 'content')]
+        if recent:
+            result = await asummarize(summary, recent, user_id=conversation.user_id)
+            summary.ai_summary = result.get('summary') or summary.ai_summary
+            summary.topics_covered = result.get('topics') or summary.topics_covered
+            summary.key_concepts = result.get('key_concepts') or summary.key_concepts
+    except Exception:
+        logger.exception("Session summary failed for conversation %s", conversation.id)
+        summary, created = await SessionSummary.objects.aget_or_create(conversation=conversation)
+
+    stats = await Message.objects.filter(conversation=conversation).aaggregate(
+        questions_asked=Count('id', filter=Q(role='user')),
+        started=Min('timestamp'),
+        ended=Max('timestamp')
+    )
+    time_spent = stats['ended'] - stats['started'] if stats['started'] else timedelta(0)
+    summary.questions_asked = stats['questions_asked']
+    summary.time_spent = time_spent
+    await summary.asave(update_fields=['questions_asked', 'time_spent', 'updated_at'])
+
+    return {
+        'id': summary.id,
+        'topics_covered': summary.topics_covered,
+        'key_concepts': summary.key_concepts,
+        'questions_asked': summary.questions_asked,
+        'time_spent': str(int(time_spent.total_seconds())),
+        'ai_summary': summary.ai_summary,
+        'created_at': summary.created_at.isoformat()
+    }
+
+
+# Rolling summaries are folded on one background event loop per process, so
+# the chat response never waits on the summary model and the async client
+# pool for that loop is reused across folds.
+_loop = None
+_loop_lock = threading.Lock()
+_pending = set()
+_pending_lock = threading.Lock()
+_tasks = set()
+
+
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='tutor-summaries', daemon=True).start()
+        return _loop
+
+
+async def _rolling_fold(conversation_id):
+    # No request cycle closes this thread's connections, so do it per fold
+    await sync_to_async(close_old_connections)()
+    try:
+        conversation = await Conversation.objects.aget(id=conversation_id)
+        await afold(
+            conversation,
+            keep_recent=settings.ROLLING_SUMMARY_KEEP_MESSAGES,
+            min_messages=settings.ROLLING_SUMMARY_TURNS * 2
+        )
+    except Exception:
+        logger.exception("Rolling summary failed for conversation %s", conversation_id)
+    finally:
+        with _pending_lock:
+            _pending.discard(conversation_id)
+        await sync_to_async(close_old_connections)()
+
+
+def schedule_rolling_summary(conversation_id):
+    """Queues a background fold for the conversation once enough turns have
+    piled up past the verbatim window. Safe to call after every turn."""
+    if not settings.ROLLING_SUMMARY_TURNS:
+        return
+    # Called from request threads and the worker at once: check and add together
+    with _pending_lock:
+        if conversation_id in _pending:
+            return
+        _pending.add(conversation_id)
+    # Start from an empty context: the caller's context carries asgiref's
+    # per-request executor, which is gone by the time the fold runs.
+    loop = _background_loop()
+    loop.call_soon_threadsafe(_start_rolling_fold, conversation_id, context=contextvars.Context())
+
+
+def _start_rolling_fold(conversation_id):
+    # The loop only keeps weak references to tasks
+    task = asyncio.ensure_future(_rolling_fold(conversation_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -1,3 +1,1631 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import shutil
+import warnings
+import tempfile
+from datetime import timedelta
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import CacheKeyWarning
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from . import llm, urls
+from .api import _astream_ai_response, _stream_ai_response
+from .auth import CachedTokenAuthentication, token_cache
+from .avatars import variant_path
+from .batching import abatched_complete, batching_stats
+from .breaker import CircuitOpenError, acomplete, get_breaker, reset_breakers, OPEN, CLOSED
+from .catalog import get_catalog
+from .context import IMAGE_PART_TOKENS, abuild_context, arecent_messages, fit_to_budget, message_tokens, token_budget
+from .llm import astream, reset_clients
+from .grader import get_evaluator_pool, grade_answer
+from .jobs import claim_next, release_stale, run_job
+from .models import (Subject, Conversation, Message, LearningPathway, Exercise, UserProgress, Job, SessionSummary, UsageRecord,
+                     UserProfile, UserSubjectStats)
+from .response_cache import ResponseCache, get_response_cache, prompt_hash
+from .rollups import rebuild_stats
+from .singleflight import SingleFlight
+from .turns import save_turn
+from .usage import RateLimiter, RateLimited, estimate_tokens, get_rate_limiter
+from .vision import image_messages, prepare_image
 
-# Create your tests here.
+# Query budget for every endpoint in tutor/urls.py, as (method, url kwargs,
+# payload, expected queries), measured with the caller's token already in the
+# auth cache. A change in any count fails CI: lower it when a query is
+# removed, and justify any increase in review.
+ENDPOINT_QUERY_BUDGETS = {
+    'api_auth_register': ('post', {}, {'username': 'newbie', 'password': 'pw-12345', 'email': 'n@example.com'}, 6),
+    'api_auth_login': ('post', {}, {'username': 'student', 'password': 'pw-12345'}, 2),
+    'api_subjects': ('get', {}, None, 0),
+    'api_conversations': ('get', {}, None, 1),
+    'api_create_conversation': ('post', {}, {'subject_id': 'subject'}, 3),
+    'api_get_conversation': ('get', {'conversation_id': 'conversation'}, None, 3),
+    'api_chat': ('post', {'conversation_id': 'conversation'}, {'message': 'Why does it fall?'}, 10),
+    'api_conversation_messages': ('get', {'conversation_id': 'conversation'}, None, 2),
+    'api_socratic_response': ('post', {}, {'message': 'What is a force?', 'subject': 'physics'}, 1),
+    'api_job_status': ('get', {'job_id': 'job'}, None, 1),
+    'api_get_profile': ('get', {}, None, 4),
+    'api_upload_profile_picture': ('post', {}, 'image', 5),
+    'api_oauth_login': ('post', {}, {'provider': 'google', 'oauth_id': '1', 'email': 'student@example.com', 'name': 'Stu Dent'}, 2),
+    'api_learning_pathways': ('get', {'subject_id': 'subject'}, None, 1),
+    'api_exercises': ('get', {'pathway_id': 'pathway'}, None, 1),
+    'api_exercise_attempt': ('post', {'exercise_id': 'exercise'}, {'answer': 'print(type(1))'}, 5),
+    'api_progress_dashboard': ('get', {}, None, 2),
+    'api_user_progress': ('get', {'subject_id': 'subject'}, None, 1),
+    'api_session_summary': ('post', {'conversation_id': 'conversation'}, {}, 13),
+    'api_analyze_image': ('post', {}, 'diagram', 1),
+    'api_adaptive_difficulty': ('post', {}, {'current_level': 'easy', 'struggle_count': 0}, 0),
+    'api_admin_students': ('get', {}, None, 3),
+    'api_admin_create_student': ('post', {}, {'username': 'other', 'email': 'o@example.com'}, 3),
+    'api_admin_delete_student': ('delete', {'student_id': 'other_user'}, None, 12),
+    'api_admin_update_student': ('put', {'student_id': 'other_user'}, {'first_name': 'Ada'}, 2),
+    'api_admin_metrics': ('get', {}, None, 0),
+}
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 32), 'orange').save(buffer, format='PNG')
+    return SimpleUploadedFile('avatar.png', buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(
+    LLM_CHAT_PROVIDER='stub',
+    LLM_SOCRATIC_PROVIDER='stub',
+    LLM_SUMMARY_PROVIDER='stub',
+    LLM_VISION_PROVIDER='stub',
+    ROLLING_SUMMARY_TURNS=0,
+)
+class EndpointQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student', email='student@example.com', password='pw-12345')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.other_user = User.objects.create_user('someone', email='someone@example.com')
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        cls.conversation = Conversation.objects.create(user=cls.user, subject=cls.subject, title='Falling')
+        for i in range(6):
+            Message.objects.create(conversation=cls.conversation, role='user', content=f'Question {i}')
+            Message.objects.create(conversation=cls.conversation, role='assistant', content=f'What do you think about {i}?')
+        cls.pathway = LearningPathway.objects.create(subject=cls.subject, title='Motion', description='Kinematics', order=1)
+        cls.exercise = Exercise.objects.create(pathway=cls.pathway, title='Free fall', problem_statement='Drop a ball',
+                                               solution='g = 9.81', difficulty='easy')
+        UserProgress.objects.create(user=cls.user, subject=cls.subject, pathway=cls.pathway, exercise=cls.exercise)
+        cls.job = Job.objects.create(user=cls.user, kind='session_summary', payload={'conversation_id': cls.conversation.id})
+
+    def setUp(self):
+        cache.clear()
+        get_response_cache().clear()
+        token_cache.clear()
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        # Budgets are for a running process, where the subject catalog is already loaded
+        get_catalog()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+
+    def _request(self, name, method, url_kwargs, payload):
+        kwargs = {key: getattr(self, value).id for key, value in url_kwargs.items()}
+        url = reverse(name, kwargs=kwargs)
+        headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+        if payload == 'image':
+            return self.client.post(url, {'profile_picture': _png()}, **headers)
+        if payload == 'diagram':
+            return self.client.post(url, {'image': _png(), 'subject': 'physics'}, **headers)
+        if isinstance(payload, dict):
+            payload = {key: getattr(self, value).id if value in ('subject',) else value
+                       for key, value in payload.items()}
+        return getattr(self.client, method)(url, payload, content_type='application/json', **headers)
+
+    def test_every_endpoint_has_a_budget(self):
+        names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(names, set(ENDPOINT_QUERY_BUDGETS))
+
+    def test_endpoint_query_counts(self):
+        for name, (method, url_kwargs, payload, expected) in ENDPOINT_QUERY_BUDGETS.items():
+            with self.subTest(endpoint=name), self.settings(MEDIA_ROOT=self.media_root):
+                # Run each request in its own rolled-back transaction so the
+                # fixtures look the same to every endpoint
+                with transaction.atomic():
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self._request(name, method, url_kwargs, payload)
+                    transaction.set_rollback(True)
+                self.assertLess(response.status_code, 400, response.content)
+                self.assertEqual(
+                    len(queries), expected,
+                    f"{name} ran {len(queries)} queries:\n" + "\n".join(q['sql'] for q in queries.captured_queries)
+                )
+
+    def test_conversation_list_is_constant(self):
+        for i in range(10):
+            conversation = Conversation.objects.create(user=self.user, subject=self.subject, title=f'Extra {i}')
+            Message.objects.create(conversation=conversation, role='user', content='Hi')
+        with self.assertNumQueries(ENDPOINT_QUERY_BUDGETS['api_conversations'][3]):
+            self.client.get(reverse('api_conversations'), HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_admin_students_is_constant(self):
+        for i in range(10):
+            user = User.objects.create_user(f'extra{i}')
+            Conversation.objects.create(user=user, subject=self.subject, title='Extra')
+        with self.assertNumQueries(ENDPOINT_QUERY_BUDGETS['api_admin_students'][3]):
+            self.client.get(reverse('api_admin_students'), HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+
+class ContextBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.', context_token_budget=60)
+        cls.conversation = Conversation.objects.create(user=cls.user, subject=cls.subject, title='Falling')
+        for i in range(30):
+            Message.objects.create(conversation=cls.conversation, role='user' if i % 2 == 0 else 'assistant',
+                                   content=f'Turn {i}: why does the ball keep falling?')
+
+    def history(self, count):
+        return [{'role': 'user', 'content': f'Turn {i}: why does the ball keep falling?'} for i in range(count)]
+
+    def test_oldest_turns_are_dropped_first(self):
+        history = self.history(10)
+        system_cost = message_tokens({'content': 'Ask.'})
+        turn_cost = message_tokens(history[0])
+        messages = fit_to_budget('Ask.', history, system_cost + 3 * turn_cost)
+        self.assertEqual(messages, [{'role': 'system', 'content': 'Ask.'}] + history[-3:])
+        # Everything fits under a large budget
+        self.assertEqual(fit_to_budget('Ask.', history, 10000)[1:], history)
+
+    def test_newest_turn_is_kept_over_budget(self):
+        question = {'role': 'user', 'content': 'Why? ' * 200}
+        messages = fit_to_budget('Ask.', self.history(3) + [question], 10)
+        self.assertEqual(messages, [{'role': 'system', 'content': 'Ask.'}, question])
+
+    def test_budget_comes_from_the_subject(self):
+        self.assertEqual(token_budget(self.subject), 60)
+        with self.settings(CONTEXT_TOKEN_BUDGET=500):
+            self.assertEqual(token_budget(), 500)
+            self.assertEqual(token_budget(Subject(name='Maths', system_prompt='Ask.')), 500)
+            messages = async_to_sync(abuild_context)(self.conversation, self.subject)
+        self.assertLessEqual(sum(message_tokens(message) for message in messages), 60)
+        self.assertEqual(messages[-1]['content'], 'Turn 29: why does the ball keep falling?')
+
+    @override_settings(CONTEXT_MAX_MESSAGES=5)
+    def test_recent_messages_is_one_limited_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            messages = async_to_sync(arecent_messages)(self.conversation)
+        self.assertEqual(len(queries), 1)
+        self.assertRegex(queries[0]['sql'], r'ORDER BY .* DESC.* LIMIT 5')
+        # Newest five, returned oldest first
+        self.assertEqual([message['content'][:7] for message in messages],
+                         ['Turn 25', 'Turn 26', 'Turn 27', 'Turn 28', 'Turn 29'])
+
+
+@override_settings(LLM_SOCRATIC_PROVIDER='stub')
+class CachedTokenAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        token_cache.clear()
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_second_request_skips_token_lookup(self):
+        self.client.get(reverse('api_progress_dashboard'), **self.headers)
+        # Only the dashboard's own two queries, none for authentication
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('api_progress_dashboard'), **self.headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get(reverse('api_progress_dashboard'), **self.headers)
+        self.token.delete()
+        response = self.client.get(reverse('api_progress_dashboard'), **self.headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get(reverse('api_progress_dashboard'), **self.headers)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(reverse('api_progress_dashboard'), **self.headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_async_views_reject_bodies_that_are_not_objects(self):
+        for body in ('[1]', '"question"', '{not json'):
+            response = self.client.post(reverse('api_socratic_response'), body,
+                                        content_type='application/json', **self.headers)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn('JSON parse error', response.json()['detail'])
+
+    def test_deleted_student_is_rejected_by_async_views(self):
+        admin_token = Token.objects.create(user=User.objects.create_user('admin'))
+        payload = {'message': 'What is a force?', 'subject': 'physics'}
+        self.client.post(reverse('api_socratic_response'), payload, content_type='application/json', **self.headers)
+        self.client.delete(reverse('api_admin_delete_student', kwargs={'student_id': self.user.id}),
+                           HTTP_AUTHORIZATION=f'Token {admin_token.key}')
+        response = self.client.post(reverse('api_socratic_response'), payload, content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 401)
+
+
+@override_settings(LLM_CHAT_PROVIDER='stub', LLM_SUMMARY_PROVIDER='stub', ROLLING_SUMMARY_TURNS=0)
+class JobQueueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        cls.conversation = Conversation.objects.create(user=cls.user, subject=cls.subject, title='Falling')
+
+    def setUp(self):
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def _work(self):
+        job = claim_next('test-worker')
+        self.assertIsNotNone(job)
+        self.assertEqual(job.status, Job.RUNNING)
+        async_to_sync(run_job)(job)
+        job.refresh_from_db()
+        return job
+
+    def test_background_chat_turn(self):
+        response = self.client.post(reverse('api_chat', kwargs={'conversation_id': self.conversation.id}),
+                                    {'message': 'Why does it fall?', 'background': True},
+                                    content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.conversation.messages.count(), 1)
+
+        job = self._work()
+        self.assertEqual(job.status, Job.SUCCEEDED, job.error)
+        self.assertIsNone(claim_next('test-worker'))
+        self.assertEqual(self.conversation.messages.filter(role='assistant').count(), 1)
+
+        status_response = self.client.get(response.json()['status_url'], **self.headers)
+        self.assertEqual(status_response.json()['result']['message']['role'], 'assistant')
+
+    def test_background_session_summary(self):
+        Message.objects.create(conversation=self.conversation, role='user', content='Why does it fall?')
+        response = self.client.post(reverse('api_session_summary', kwargs={'conversation_id': self.conversation.id}),
+                                    {'background': True}, content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 202)
+        job = self._work()
+        self.assertEqual(job.status, Job.SUCCEEDED, job.error)
+        self.assertEqual(job.result['questions_asked'], 1)
+        self.assertTrue(SessionSummary.objects.filter(conversation=self.conversation).exists())
+
+    @override_settings(ROLLING_SUMMARY_KEEP_MESSAGES=4)
+    def test_session_summary_leaves_recent_turns_verbatim(self):
+        for i in range(3):
+            save_turn(self.conversation, ('user', f'Question {i}'), ('assistant', f'Answer {i}'))
+        response = self.client.post(reverse('api_session_summary', kwargs={'conversation_id': self.conversation.id}),
+                                    {}, content_type='application/json', **self.headers)
+        self.assertTrue(response.json()['ai_summary'])
+
+        context = async_to_sync(abuild_context)(self.conversation, self.subject)
+        self.assertEqual([message['content'] for message in context[1:]],
+                         ['Question 1', 'Answer 1', 'Question 2', 'Answer 2'])
+        self.assertIn('Summary of the earlier part of this session', context[0]['content'])
+
+    def test_session_summary_failure_is_logged(self):
+        Message.objects.create(conversation=self.conversation, role='user', content='Why does it fall?')
+        with self.settings(LLM_PROVIDERS=TEST_PROVIDERS, LLM_SUMMARY_PROVIDER='down'), \
+                self.assertLogs('tutor.summaries', 'ERROR'):
+            response = self.client.post(reverse('api_session_summary', kwargs={'conversation_id': self.conversation.id}),
+                                        {}, content_type='application/json', **self.headers)
+        # The stats are still served
+        self.assertEqual(response.json()['questions_asked'], 1)
+
+    def test_failed_job_is_retried_then_given_up(self):
+        Job.objects.create(kind='no-such-kind', max_attempts=2)
+        job = self._work()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIsNone(claim_next('test-worker'))
+
+        Job.objects.filter(id=job.id).update(run_after=timezone.now())
+        job = self._work()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_stale_jobs_are_released(self):
+        Job.objects.create(kind='session_summary', status=Job.RUNNING, locked_by='dead-worker',
+                           locked_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertEqual(release_stale(), 1)
+        self.assertIsNotNone(claim_next('test-worker'))
+
+    def test_stale_jobs_out_of_attempts_fail(self):
+        job = Job.objects.create(kind='session_summary', status=Job.RUNNING, locked_by='dead-worker', attempts=3,
+                                 max_attempts=3, locked_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertEqual(release_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIsNone(claim_next('test-worker'))
+
+    def _bucket(self):
+        tokens, updated = get_rate_limiter().store._buckets[f'user:{self.user.id}']
+        return tokens
+
+    def test_failed_chat_turn_gives_back_its_reservation(self):
+        reset_breakers()
+        with self.settings(RATE_LIMITS=TEST_RATE_LIMITS, LLM_PROVIDERS=TEST_PROVIDERS, LLM_CHAT_PROVIDER='down'):
+            self.client.post(reverse('api_chat', kwargs={'conversation_id': self.conversation.id}),
+                             {'message': 'Why does it fall?', 'background': True},
+                             content_type='application/json', **self.headers)
+            # The worker reserves, not the web process, which may not share its buckets
+            self.assertNotIn(f'user:{self.user.id}', get_rate_limiter().store._buckets)
+            Job.objects.update(max_attempts=1)
+            job = self._work()
+            self.assertEqual(job.status, Job.FAILED)
+            self.assertGreater(self._bucket(), 999)
+
+    def test_rate_limited_chat_turn_waits_without_using_an_attempt(self):
+        with self.settings(RATE_LIMITS=TEST_RATE_LIMITS):
+            get_rate_limiter().reserve(self.user.id, 1000)
+            self.client.post(reverse('api_chat', kwargs={'conversation_id': self.conversation.id}),
+                             {'message': 'Why does it fall?', 'background': True},
+                             content_type='application/json', **self.headers)
+            job = self._work()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 0))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertFalse(self.conversation.messages.filter(role='assistant').exists())
+
+    def test_retried_chat_turn_does_not_save_its_reply_twice(self):
+        self.client.post(reverse('api_chat', kwargs={'conversation_id': self.conversation.id}),
+                         {'message': 'Why does it fall?', 'background': True},
+                         content_type='application/json', **self.headers)
+        job = self._work()
+        # As if the worker died after the reply was committed
+        Job.objects.filter(id=job.id).update(status=Job.PENDING, result=None)
+        retried = self._work()
+        self.assertEqual(retried.status, Job.SUCCEEDED, retried.error)
+        self.assertEqual(self.conversation.messages.filter(role='assistant').count(), 1)
+        self.assertEqual(retried.result['message']['id'], job.result['message']['id'])
+
+    def test_other_users_cannot_see_job(self):
+        job = Job.objects.create(user=User.objects.create_user('someone'), kind='session_summary')
+        response = self.client.get(reverse('api_job_status', kwargs={'job_id': job.id}), **self.headers)
+        self.assertEqual(response.status_code, 404)
+
+
+TEST_PROVIDERS = {
+    'stub': {'stub': True, 'model': 'stub'},
+    'down': {'stub': True, 'model': 'down', 'fail': True},
+    'slow': {'stub': True, 'model': 'slow', 'delay': 0.5},
+    'flaky': {'stub': True, 'model': 'flaky', 'fail_after': 3},
+}
+TEST_BREAKER = {'WINDOW': 60, 'MIN_CALLS': 2, 'FAILURE_RATE': 0.5, 'SLOW_CALL_SECONDS': 10, 'RESET_TIMEOUT': 0.05}
+
+
+@override_settings(LLM_PROVIDERS=TEST_PROVIDERS, LLM_BREAKER=TEST_BREAKER)
+class CircuitBreakerTests(TestCase):
+    messages = [{'role': 'user', 'content': 'What is a force?'}]
+
+    def setUp(self):
+        reset_breakers()
+
+    def complete(self, provider, **kwargs):
+        return async_to_sync(acomplete)(provider, messages=self.messages, **kwargs)
+
+    def test_failures_open_the_circuit(self):
+        for i in range(2):
+            with self.assertRaises(RuntimeError):
+                self.complete('down')
+        self.assertEqual(get_breaker('down').state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.complete('down')
+        stats = get_breaker('down').stats()
+        self.assertEqual((stats['trips'], stats['rejected']), (1, 1))
+
+    def test_successful_probe_closes_the_circuit(self):
+        breaker = get_breaker('stub')
+        breaker.record(0.1, error=True)
+        breaker.record(0.1, error=True)
+        self.assertEqual(breaker.state, OPEN)
+        time.sleep(0.06)
+        self.complete('stub')
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_backup_answers_when_primary_fails(self):
+        completion = self.complete('down', backup='stub')
+        self.assertEqual(completion.model, 'stub')
+
+    def test_hedged_request_beats_slow_primary(self):
+        started = time.monotonic()
+        completion = self.complete('slow', backup='stub', hedge_after=0.05)
+        self.assertEqual(completion.model, 'stub')
+        self.assertLess(time.monotonic() - started, 0.4)
+
+    def test_primary_that_loses_hedges_opens_the_circuit(self):
+        # SLOW_CALL_SECONDS is 10, but losing to the hedge marks the slow primary anyway
+        for i in range(2):
+            self.assertEqual(self.complete('slow', backup='stub', hedge_after=0.05).model, 'stub')
+        stats = get_breaker('slow').stats()
+        self.assertEqual((stats['slow_calls'], stats['state']), (2, OPEN))
+
+    def test_socratic_response_skips_open_circuit(self):
+        user = User.objects.create_user('student')
+        token = Token.objects.create(user=user)
+        with self.settings(LLM_SOCRATIC_PROVIDER='down', LLM_SOCRATIC_BACKUP_PROVIDER='stub'):
+            for i in range(3):
+                response = self.client.post(reverse('api_socratic_response'),
+                                            {'message': f'Question {i}', 'subject': 'physics'},
+                                            content_type='application/json', HTTP_AUTHORIZATION=f'Token {token.key}')
+                self.assertEqual(response.json()['metadata']['model'], 'stub')
+        self.assertEqual(get_breaker('down').stats()['rejected'], 1)
+
+
+@override_settings(LLM_PROVIDERS=TEST_PROVIDERS)
+class ProviderClientTests(TestCase):
+    messages = [{'role': 'user', 'content': 'What is a force?'}]
+
+    def setUp(self):
+        reset_breakers()
+        reset_clients()
+        self.addCleanup(reset_clients)
+
+    def test_requests_on_fresh_loops_share_one_client(self):
+        # Like WSGI, where every async view gets an event loop of its own
+        loops = set()
+        for i in range(3):
+            async def call():
+                loops.add(asyncio.get_running_loop())
+                return await acomplete('stub', messages=self.messages)
+            async_to_sync(call)()
+        self.assertEqual(len(loops), 3)
+        self.assertEqual(list(llm._async_clients), ['stub'])
+
+    def test_reset_closes_async_clients(self):
+        async_to_sync(acomplete)('stub', messages=self.messages)
+        client = llm._async_clients['stub']
+        with mock.patch.object(client, 'close', mock.AsyncMock()) as close:
+            reset_clients()
+            async_to_sync(llm._on_client_loop)(asyncio.sleep(0))
+        close.assert_awaited_once()
+        self.assertEqual(llm._async_clients, {})
+
+    def test_stream_reads_chunks_on_the_client_loop(self):
+        async def read():
+            return [chunk async for chunk in astream('stub', messages=self.messages)]
+        chunks = async_to_sync(read)()
+        reply = ''.join(chunk.choices[0].delta.content for chunk in chunks if chunk.choices)
+        self.assertTrue(reply.startswith('What do you already know about What is a force?'))
+        self.assertIsNotNone(chunks[-1].usage)
+
+
+class SingleFlightTests(TestCase):
+    options = {'CACHE_ALIAS': None, 'LOCK_TIMEOUT': 5, 'POLL_INTERVAL': 0.01, 'RESULT_TTL': 10}
+
+    def setUp(self):
+        cache.clear()
+        self.calls = 0
+
+    async def slow_call(self):
+        self.calls += 1
+        await asyncio.sleep(0.1)
+        return {'response': 'What do you think?', 'model': 'stub'}
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight(self.options)
+
+        async def burst():
+            return await asyncio.gather(*(flight.ado('key', self.slow_call) for i in range(5)))
+
+        results = async_to_sync(burst)()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len({r['response'] for r in results}), 1)
+        self.assertEqual(flight.stats(), {'leaders': 1, 'followers': 4, 'shared_followers': 0, 'in_flight': 0})
+
+    def test_callers_on_other_threads_share_one_call(self):
+        flight = SingleFlight(self.options)
+        threads = [threading.Thread(target=async_to_sync(flight.ado), args=('key', self.slow_call)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+
+    def test_workers_share_a_call_through_the_cache(self):
+        workers = [SingleFlight(dict(self.options, CACHE_ALIAS='default')) for i in range(2)]
+
+        async def burst():
+            return await asyncio.gather(*(worker.ado('key', self.slow_call) for worker in workers))
+
+        first, second = async_to_sync(burst)()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(workers[1].stats()['shared_followers'], 1)
+
+    def test_cancelled_follower_leaves_the_others_waiting(self):
+        flight = SingleFlight(self.options)
+
+        async def burst():
+            leader = asyncio.ensure_future(flight.ado('key', self.slow_call))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(flight.ado('key', self.slow_call)) for i in range(3)]
+            await asyncio.sleep(0.01)
+            followers[0].cancel()
+            return await asyncio.gather(leader, *followers, return_exceptions=True)
+
+        leader, cancelled, *others = async_to_sync(burst)()
+        self.assertIsInstance(cancelled, asyncio.CancelledError)
+        self.assertEqual([leader] + others, [{'response': 'What do you think?', 'model': 'stub'}] * 3)
+        self.assertEqual(self.calls, 1)
+
+    def test_failure_is_shared_then_forgotten(self):
+        flight = SingleFlight(self.options)
+
+        async def broken():
+            self.calls += 1
+            await asyncio.sleep(0.05)
+            raise RuntimeError('provider down')
+
+        async def burst():
+            return await asyncio.gather(*(flight.ado('key', broken) for i in range(3)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in async_to_sync(burst)()))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(async_to_sync(flight.ado)('key', self.slow_call)['model'], 'stub')
+
+
+def _response_cache(**options):
+    return ResponseCache(dict({
+        'ENABLED': True,
+        'BACKEND': 'memory',
+        'TTL': 60,
+        'MAX_ENTRIES': 10,
+        'PATH': '',
+        'CACHE_ALIAS': 'default',
+        'SIMILARITY_THRESHOLD': 0.9,
+        'INDEX_SIZE': 10,
+        'EMBEDDER': None,
+    }, **options))
+
+
+class ResponseCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Python', system_prompt='Ask, never tell.')
+
+    def setUp(self):
+        cache.clear()
+        get_response_cache().clear()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+
+    def assertBackendBehaves(self, response_cache):
+        response_cache.set('python', 'Ask.', 'What is a variable?', {'response': 'What do you think?'})
+        self.assertEqual(response_cache.get('python', 'Ask.', 'what is a variable'), {'response': 'What do you think?'})
+        self.assertIsNone(response_cache.get('python', 'Ask.', 'What is a loop?'))
+        self.assertIsNone(response_cache.get('maths', 'Ask.', 'What is a variable?'))
+        self.assertIsNone(response_cache.get('python', 'Tell.', 'What is a variable?'))
+        with mock.patch('tutor.response_cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(response_cache.get('python', 'Ask.', 'What is a variable?'))
+
+    def assertEvictsLeastRecentlyUsed(self, response_cache):
+        response_cache.set('python', 'Ask.', 'a', 1)
+        response_cache.set('python', 'Ask.', 'b', 2)
+        response_cache.get('python', 'Ask.', 'a')
+        response_cache.set('python', 'Ask.', 'c', 3)
+        self.assertEqual(response_cache.get('python', 'Ask.', 'a'), 1)
+        self.assertIsNone(response_cache.get('python', 'Ask.', 'b'))
+        self.assertEqual(response_cache.get('python', 'Ask.', 'c'), 3)
+
+    def test_memory_backend(self):
+        self.assertBackendBehaves(_response_cache(SIMILARITY_THRESHOLD=0))
+        self.assertEvictsLeastRecentlyUsed(_response_cache(SIMILARITY_THRESHOLD=0, MAX_ENTRIES=2))
+
+    def test_file_backend(self):
+        self.assertBackendBehaves(_response_cache(BACKEND='file', PATH=self.path, SIMILARITY_THRESHOLD=0))
+        response_cache = _response_cache(BACKEND='file', PATH=os.path.join(self.path, 'lru'), SIMILARITY_THRESHOLD=0,
+                                          MAX_ENTRIES=2)
+        # Eviction goes by mtime, so age the first two entries past its resolution
+        response_cache.set('python', 'Ask.', 'a', 1)
+        response_cache.set('python', 'Ask.', 'b', 2)
+        os.utime(response_cache.backend._file(response_cache._key('python', prompt_hash('Ask.'), 'a')), (0, 0))
+        os.utime(response_cache.backend._file(response_cache._key('python', prompt_hash('Ask.'), 'b')), (1, 1))
+        response_cache.get('python', 'Ask.', 'a')
+        response_cache.set('python', 'Ask.', 'c', 3)
+        self.assertEqual(response_cache.get('python', 'Ask.', 'a'), 1)
+        self.assertIsNone(response_cache.get('python', 'Ask.', 'b'))
+        self.assertEqual(response_cache.get('python', 'Ask.', 'c'), 3)
+        response_cache.clear()
+        self.assertEqual(os.listdir(os.path.join(self.path, 'lru')), [])
+
+    def test_django_cache_backend(self):
+        # Keys must be valid for Memcached too
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            self.assertBackendBehaves(_response_cache(BACKEND='django', SIMILARITY_THRESHOLD=0))
+
+    def test_django_cache_backend_clear_leaves_other_keys(self):
+        response_cache = _response_cache(BACKEND='django')
+        response_cache.set('python', 'Ask.', 'What is a variable?', 'cached')
+        cache.set('ratelimit:user:1', (10, 0))
+        response_cache.clear()
+        self.assertIsNone(response_cache.get('python', 'Ask.', 'What is a variable?'))
+        self.assertEqual(cache.get('ratelimit:user:1'), (10, 0))
+        # And a second instance, as in another worker, sees the clear too
+        response_cache.set('python', 'Ask.', 'What is a variable?', 'fresh')
+        _response_cache(BACKEND='django').clear()
+        self.assertIsNone(response_cache.get('python', 'Ask.', 'What is a variable?'))
+
+    def test_similar_questions_share_an_answer(self):
+        response_cache = _response_cache()
+        response_cache.set('python', 'Ask.', 'What is a variable in Python?', 'cached')
+        # cosine 0.92 with the stored question
+        self.assertEqual(response_cache.get('python', 'Ask.', 'What is a variable in Python, please?'), 'cached')
+        # cosine 0.73
+        self.assertIsNone(response_cache.get('python', 'Ask.', 'What is a loop in Python?'))
+        # The index is per subject and system prompt
+        self.assertIsNone(response_cache.get('maths', 'Ask.', 'What is a variable in Python, please?'))
+        self.assertEqual(response_cache.stats(), {'hits': 0, 'similar_hits': 1, 'misses': 2, 'stores': 1, 'hit_rate': 0.3333})
+
+        strict = _response_cache(SIMILARITY_THRESHOLD=0.95)
+        strict.set('python', 'Ask.', 'What is a variable in Python?', 'cached')
+        self.assertIsNone(strict.get('python', 'Ask.', 'What is a variable in Python, please?'))
+
+    def test_counters(self):
+        response_cache = _response_cache(SIMILARITY_THRESHOLD=0)
+        self.assertEqual(response_cache.stats()['hit_rate'], 0.0)
+        response_cache.get('python', 'Ask.', 'What is a variable?')
+        response_cache.set('python', 'Ask.', 'What is a variable?', 'cached')
+        response_cache.get('python', 'Ask.', 'What is a variable?')
+        response_cache.get('python', 'Ask.', 'What is a variable?')
+        self.assertEqual(response_cache.stats(), {'hits': 2, 'similar_hits': 0, 'misses': 1, 'stores': 1, 'hit_rate': 0.6667})
+
+    def ask(self, **payload):
+        payload = dict({'message': 'What is a variable?', 'subject': 'python'}, **payload)
+        return self.client.post(reverse('api_socratic_response'), payload, content_type='application/json',
+                                HTTP_AUTHORIZATION=f'Token {self.token.key}').json()
+
+    # A fresh RESPONSE_CACHE setting gives the test its own cache and counters
+    @override_settings(LLM_SOCRATIC_PROVIDER='stub', RESPONSE_CACHE=dict(settings.RESPONSE_CACHE, ENABLED=True))
+    def test_only_first_turns_are_cached(self):
+        history = [{'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'What would you like to learn?'}]
+        self.assertFalse(self.ask(conversation_history=history)['metadata'].get('cached'))
+        self.assertEqual(get_response_cache().stats()['stores'], 0)
+
+        self.assertFalse(self.ask()['metadata'].get('cached'))
+        self.assertTrue(self.ask()['metadata'].get('cached'))
+        # A follow-up with history still goes to the model
+        self.assertFalse(self.ask(conversation_history=history)['metadata'].get('cached'))
+        self.assertEqual(get_response_cache().stats(), {'hits': 1, 'similar_hits': 0, 'misses': 1, 'stores': 1, 'hit_rate': 0.5})
+
+
+TEST_RATE_LIMITS = {
+    'ENABLED': True, 'BACKEND': 'memory', 'CACHE_ALIAS': 'default',
+    'USER_CAPACITY': 1000, 'USER_REFILL_PER_SECOND': 1,
+    'GLOBAL_CAPACITY': 1500, 'GLOBAL_REFILL_PER_SECOND': 1,
+}
+
+
+@override_settings(LLM_CHAT_PROVIDER='stub', LLM_SOCRATIC_PROVIDER='stub', ROLLING_SUMMARY_TURNS=0,
+                   RATE_LIMITS=TEST_RATE_LIMITS, LLM_PRICING={'stub': (1, 2)})
+class UsageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.', context_token_budget=400)
+        cls.conversation = Conversation.objects.create(user=cls.user, subject=cls.subject, title='Falling')
+
+    def setUp(self):
+        cache.clear()
+        get_response_cache().clear()
+
+    def chat(self, user=None):
+        token = Token.objects.get_or_create(user=user)[0] if user else self.token
+        conversation = (Conversation.objects.create(user=user, subject=self.subject, title='Other')
+                        if user else self.conversation)
+        return self.client.post(reverse('api_chat', kwargs={'conversation_id': conversation.id}),
+                                {'message': 'Why does it fall?'}, content_type='application/json',
+                                HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_chat_is_recorded_with_provider_usage(self):
+        self.chat()
+        entry = UsageRecord.objects.get()
+        self.assertEqual((entry.user, entry.endpoint, entry.model), (self.user, 'chat', 'stub'))
+        self.assertGreater(entry.completion_tokens, 0)
+        self.assertEqual(entry.total_tokens, entry.prompt_tokens + entry.completion_tokens)
+        self.assertEqual(float(entry.cost), round((entry.prompt_tokens + 2 * entry.completion_tokens) / 1000, 6))
+
+    def test_heavy_user_is_limited_without_starving_others(self):
+        # Each turn reserves the subject's 400-token budget up front and is
+        # settled to its real, much smaller, usage afterwards
+        statuses = [self.chat().status_code for i in range(40)]
+        self.assertIn(429, statuses)
+        self.assertEqual(self.chat(User.objects.create_user('classmate')).status_code, 200)
+        limited = self.chat()
+        self.assertGreaterEqual(int(limited['Retry-After']), 1)
+        # Rejected turns are not saved
+        self.assertEqual(self.conversation.messages.count(), 2 * statuses.count(200))
+
+    def test_global_bucket_caps_everyone(self):
+        limiter = RateLimiter(TEST_RATE_LIMITS)
+        limiter.reserve(1, 1000)
+        with self.assertRaises(RateLimited) as raised:
+            limiter.reserve(2, 600)
+        self.assertEqual(raised.exception.scope, 'global')
+        # The user bucket charge is given back when the global one refuses
+        limiter.reserve(2, 500)
+
+    def test_cache_buckets_never_update_or_release_a_lock_they_do_not_hold(self):
+        limiter = RateLimiter(dict(TEST_RATE_LIMITS, BACKEND='cache'))
+        store = limiter.store
+        store.LOCK_ATTEMPTS = 2
+        cache.set('ratelimit:user:1:lock', 'another-worker', 5)
+        with self.assertRaises(RateLimited):
+            limiter.reserve(1, 10, scopes=('user',))
+        # Forced takes are parked, not lost, and applied by the next take
+        with self.assertLogs('tutor.usage', 'WARNING'):
+            store.take('user:1', 50, 1000, 1, force=True)
+            store.take('user:1', -20, 1000, 1, force=True)
+        self.assertIsNone(cache.get('ratelimit:user:1'))
+        self.assertEqual(cache.get('ratelimit:user:1:lock'), 'another-worker')
+
+        cache.delete('ratelimit:user:1:lock')
+        limiter.reserve(1, 10, scopes=('user',))
+        self.assertIsNone(cache.get('ratelimit:user:1:lock'))
+        self.assertEqual(round(cache.get('ratelimit:user:1')[0]), 960)
+        limiter.reserve(1, 10, scopes=('user',))
+        self.assertEqual(round(cache.get('ratelimit:user:1')[0]), 950)
+
+    def test_admin_usage_comes_from_ledger(self):
+        UsageRecord.objects.create(user=self.user, endpoint='chat', model='gpt-4o', total_tokens=100, cost='0.01')
+        UsageRecord.objects.create(user=self.user, endpoint='chat', model='llama', total_tokens=30, cost='0.002')
+        UsageRecord.objects.create(user=self.user, endpoint='socratic', model='llama', total_tokens=20, cost='0.001')
+        response = self.client.get(reverse('api_admin_students'), HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        usage = response.json()['students'][0]['apiUsage']
+        self.assertEqual(usage, {'totalTokens': 150, 'totalCost': 0.013, 'favoriteModel': 'llama'})
+
+
+TEST_BATCHING = {'ENABLED': True, 'MAX_BATCH': 4, 'MAX_WAIT': 0.05, 'MAX_CONCURRENCY': 4, 'YIELD_ABOVE': 1, 'MAX_DEFER': 1}
+
+
+@override_settings(LLM_PROVIDERS=TEST_PROVIDERS, BATCHING=TEST_BATCHING)
+class MicroBatchingTests(TestCase):
+    messages = [{'role': 'user', 'content': 'Summarize the session'}]
+
+    def test_requests_are_sent_in_batches(self):
+        before = batching_stats()
+
+        async def burst():
+            return await asyncio.gather(*(abatched_complete('stub', messages=self.messages) for i in range(6)))
+
+        results = async_to_sync(burst)()
+        self.assertEqual(len(results), 6)
+        after = batching_stats()
+        self.assertEqual(after['requests'] - before['requests'], 6)
+        self.assertEqual(after['batches'] - before['batches'], 2)
+
+    def test_batches_wait_for_interactive_calls(self):
+        order = []
+
+        async def interactive():
+            await acomplete('slow', messages=self.messages)
+            order.append('interactive')
+
+        async def batch():
+            await asyncio.sleep(0.01)
+            await abatched_complete('stub', messages=self.messages)
+            order.append('batch')
+
+        async def both():
+            await asyncio.gather(interactive(), batch())
+
+        async_to_sync(both)()
+        self.assertEqual(order, ['interactive', 'batch'])
+
+
+@override_settings(QUERY_COUNT_HEADER=True, LLM_SOCRATIC_PROVIDER='stub')
+class QueryCountHeaderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.token = Token.objects.create(user=User.objects.create_user('student'))
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        get_catalog()
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_sync_view_reports_its_queries(self):
+        response = self.client.get(reverse('api_subjects'), **self.headers)
+        self.assertEqual(response['X-DB-Query-Count'], str(ENDPOINT_QUERY_BUDGETS['api_subjects'][3]))
+
+    def test_async_view_counts_queries_on_worker_threads(self):
+        response = self.client.post(reverse('api_socratic_response'), {'message': 'What is a force?', 'subject': 'physics'},
+                                    content_type='application/json', **self.headers)
+        self.assertEqual(response['X-DB-Query-Count'], str(ENDPOINT_QUERY_BUDGETS['api_socratic_response'][3]))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN output is checked against the SQLite planner')
+class IndexUsageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        cls.conversation = Conversation.objects.create(user=cls.user, subject=cls.subject, title='Falling')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, plan)
+
+    def test_transcript_uses_conversation_timestamp_index(self):
+        self.assertUsesIndex(
+            Message.objects.filter(conversation=self.conversation).order_by('timestamp'),
+            'tutor_msg_conv_ts_idx'
+        )
+
+    def test_recent_window_uses_conversation_timestamp_index(self):
+        self.assertUsesIndex(
+            Message.objects.filter(conversation=self.conversation).order_by('-timestamp')[:20],
+            'tutor_msg_conv_ts_idx'
+        )
+
+    def test_conversation_list_uses_user_created_index(self):
+        self.assertUsesIndex(
+            Conversation.objects.filter(user=self.user).order_by('-created_at'),
+            'tutor_conv_user_created_idx'
+        )
+
+    def test_progress_uses_user_subject_index(self):
+        self.assertUsesIndex(
+            UserProgress.objects.filter(user=self.user, subject=self.subject, completed=True),
+            'tutor_progress_user_subj_idx'
+        )
+
+
+class ProgressRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        cls.pathway = LearningPathway.objects.create(subject=cls.subject, title='Motion', description='Kinematics', order=1)
+        cls.exercises = [
+            Exercise.objects.create(pathway=cls.pathway, title=f'Exercise {i}', problem_statement='Drop a ball',
+                                    solution='g = 9.81', difficulty='easy')
+            for i in range(4)
+        ]
+
+    def _snapshot(self):
+        return list(UserSubjectStats.objects.order_by('user_id', 'subject_id').values(
+            'user_id', 'subject_id', 'exercises_attempted', 'exercises_completed',
+            'conversation_count', 'questions_asked', 'time_spent', 'last_message_at'))
+
+    def _build_activity(self):
+        conversation = Conversation.objects.create(user=self.user, subject=self.subject, title='Falling')
+        for i in range(3):
+            Message.objects.create(conversation=conversation, role='user', content=f'Question {i}')
+            Message.objects.create(conversation=conversation, role='assistant', content='What do you think?')
+        Conversation.objects.create(user=self.user, subject=self.subject, title='Empty')
+        for exercise in self.exercises[:3]:
+            UserProgress.objects.create(user=self.user, subject=self.subject, pathway=self.pathway, exercise=exercise)
+        progress = UserProgress.objects.get(exercise=self.exercises[0])
+        progress.completed = True
+        progress.save()
+        return conversation
+
+    def test_incremental_updates_match_rebuild(self):
+        conversation = self._build_activity()
+        conversation.delete()
+        UserProgress.objects.get(exercise=self.exercises[2]).delete()
+        incremental = self._snapshot()
+        self.assertEqual(incremental[0]['conversation_count'], 1)
+        self.assertEqual(incremental[0]['exercises_attempted'], 2)
+        self.assertEqual(incremental[0]['exercises_completed'], 1)
+
+        call_command('rebuild_progress_stats', stdout=io.StringIO())
+        rebuilt = self._snapshot()
+        # Deleting a conversation leaves its last message time behind; the rest must agree
+        for row in incremental + rebuilt:
+            row.pop('last_message_at')
+            row.pop('time_spent')
+        self.assertEqual(incremental, rebuilt)
+
+    def test_chat_time_counts_short_gaps_only(self):
+        conversation = self._build_activity()
+        start = timezone.now() - timedelta(hours=2)
+        # Two messages five minutes apart, then one after a long break
+        for offset in (0, 5, 80):
+            message = Message.objects.create(conversation=conversation, role='user', content='Later')
+            Message.objects.filter(pk=message.pk).update(timestamp=start + timedelta(minutes=offset))
+        rebuild_stats()
+        stats = UserSubjectStats.objects.get(user=self.user, subject=self.subject)
+        self.assertGreaterEqual(stats.time_spent, timedelta(minutes=5))
+        self.assertLess(stats.time_spent, timedelta(minutes=30))
+
+    def test_dashboard_reads_rollups(self):
+        self._build_activity()
+        token_cache.clear()
+        response = self.client.get(reverse('api_progress_dashboard'), HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['Physics'], {
+            'subject_id': self.subject.id,
+            'total_exercises': 4,
+            'completed_exercises': 1,
+            'completion_percentage': 25,
+            'conversations_count': 2,
+            'time_spent_minutes': 0,
+        })
+
+
+class ExerciseAttemptTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        cls.pathway = LearningPathway.objects.create(subject=cls.subject, title='Motion', description='Kinematics', order=1)
+        cls.exercise = Exercise.objects.create(pathway=cls.pathway, title='Free fall', problem_statement='Set g',
+                                               solution='g = 9.81\nprint(g)', difficulty='easy')
+
+    def setUp(self):
+        token_cache.clear()
+
+    def _attempt(self, answer):
+        return self.client.post(reverse('api_exercise_attempt', kwargs={'exercise_id': self.exercise.id}),
+                                {'answer': answer}, content_type='application/json',
+                                HTTP_AUTHORIZATION=f'Token {self.token.key}').json()
+
+    def test_attempts_are_stored_in_progress(self):
+        for expected in (1, 2, 3):
+            data = self._attempt('g = 10')
+            self.assertEqual(data['attempts'], expected)
+        self.assertTrue(data['show_solution'])
+        self.assertEqual(data['solution'], self.exercise.solution)
+        progress = UserProgress.objects.get(user=self.user, exercise=self.exercise)
+        self.assertEqual((progress.attempts, progress.completed), (3, False))
+
+    def test_listed_exercises_can_be_attempted(self):
+        # Only real rows are listed, so every id the client sees can be graded
+        headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+        empty = LearningPathway.objects.create(subject=self.subject, title='Energy', description='Work', order=2)
+        self.assertEqual(self.client.get(reverse('api_exercises', kwargs={'pathway_id': empty.id}), **headers).json(), [])
+        listed = self.client.get(reverse('api_exercises', kwargs={'pathway_id': self.pathway.id}), **headers).json()
+        self.assertEqual([exercise['id'] for exercise in listed], [self.exercise.id])
+        self.assertEqual(self._attempt('g = 10')['attempts'], 1)
+
+    def test_answer_is_checked_against_the_solution(self):
+        self.assertFalse(self._attempt('g = 10')['completed'])
+        data = self._attempt('  g = 9.81   \r\n\r\nprint(g)\n')
+        self.assertTrue(data['completed'])
+        self.assertEqual(data['attempts'], 2)
+        stats = UserSubjectStats.objects.get(user=self.user, subject=self.subject)
+        self.assertEqual((stats.exercises_attempted, stats.exercises_completed), (1, 1))
+        # Solving it again counts the attempt but not a second completion
+        self._attempt('g = 9.81\nprint(g)')
+        stats.refresh_from_db()
+        self.assertEqual(stats.exercises_completed, 1)
+        self.assertEqual(UserProgress.objects.get(user=self.user, exercise=self.exercise).attempts, 3)
+
+    def test_unknown_exercise_is_not_found(self):
+        response = self.client.post(reverse('api_exercise_attempt', kwargs={'exercise_id': 9999}), {'answer': 'x'},
+                                    content_type='application/json', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(EXERCISE_SANDBOX={
+    'WORKERS': 1, 'PREFORK': False, 'MAX_TASKS_PER_WORKER': 100, 'CPU_SECONDS': 1, 'WALL_SECONDS': 2,
+    'MEMORY_MB': 256, 'OUTPUT_BYTES': 4096, 'QUEUE_TIMEOUT': 5, 'CACHE_ALIAS': 'default', 'RESULT_TTL': 60,
+})
+class SandboxGradingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Python Programming', system_prompt='Ask, never tell.')
+        cls.pathway = LearningPathway.objects.create(subject=cls.subject, title='Basics', description='Basics', order=1)
+        cls.exercise = Exercise.objects.create(
+            pathway=cls.pathway, title='Sign', problem_statement='Print the sign', difficulty='easy',
+            solution='n = int(input())\nprint("Positive" if n > 0 else "Negative" if n < 0 else "Zero")',
+            test_cases=[{'input': '5\n', 'output': 'Positive'}, {'input': '-2\n', 'output': 'Negative'},
+                        {'input': '0\n', 'output': 'Zero', 'hidden': True}]
+        )
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+
+    def test_correct_program_passes_every_case(self):
+        result = grade_answer(self.exercise, self.exercise.solution)
+        self.assertTrue(result['passed'])
+        self.assertEqual([case['status'] for case in result['cases']], ['ok', 'ok', 'ok'])
+
+    def test_wrong_output_fails_without_revealing_hidden_cases(self):
+        result = grade_answer(self.exercise, 'n = int(input())\nprint("Positive" if n > 0 else "Negative")')
+        self.assertFalse(result['passed'])
+        self.assertEqual([case['passed'] for case in result['cases']], [True, True, False])
+        self.assertEqual(result['cases'][2]['status'], 'wrong_output')
+        self.assertIsNone(result['cases'][2]['output'])
+
+    def test_limits_and_blocked_operations(self):
+        for answer, expected in [('while True:\n    pass', 'timeout'),
+                                 ('while True:\n    print("spam")', 'output_limit'),
+                                 ('import socket', 'error'),
+                                 ('print(open("/etc/hostname").read())', 'error')]:
+            with self.subTest(answer=answer):
+                result = grade_answer(self.exercise, answer)
+                self.assertEqual(result['cases'][0]['status'], expected)
+
+    def test_results_are_cached_per_normalized_answer(self):
+        grade_answer(self.exercise, self.exercise.solution)
+        evaluations = get_evaluator_pool().stats()['evaluations']
+        result = grade_answer(self.exercise, self.exercise.solution + '\n\n   ')
+        self.assertTrue(result['passed'])
+        self.assertEqual(get_evaluator_pool().stats()['evaluations'], evaluations)
+
+    def test_attempt_endpoint_runs_test_cases(self):
+        response = self.client.post(reverse('api_exercise_attempt', kwargs={'exercise_id': self.exercise.id}),
+                                    {'answer': 'n = int(input())\nif n > 0:\n    print("Positive")\nelif n < 0:\n'
+                                               '    print("Negative")\nelse:\n    print("Zero")'},
+                                    content_type='application/json', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        data = response.json()
+        self.assertTrue(data['completed'])
+        self.assertEqual(len(data['test_results']), 3)
+
+
+@override_settings(LLM_VISION_PROVIDER='stub')
+class ImageAnalysisTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def _photo(self, size=(3000, 2000), mode='RGB', color='orange'):
+        buffer = io.BytesIO()
+        Image.new(mode, size, color).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def test_prepare_image_downscales_to_jpeg(self):
+        jpeg, width, height = prepare_image(self._photo())
+        self.assertEqual((width, height), (1024, 683))
+        self.assertEqual(Image.open(io.BytesIO(jpeg)).format, 'JPEG')
+        # Transparent images are flattened rather than rejected by the JPEG encoder
+        jpeg, width, height = prepare_image(self._photo((64, 64), 'RGBA', (0, 0, 0, 0)))
+        self.assertEqual(Image.open(io.BytesIO(jpeg)).getpixel((0, 0)), (255, 255, 255))
+
+    def test_image_parts_are_counted_as_tokens(self):
+        messages = image_messages('Ask, never tell.', 'physics', b'jpeg')
+        self.assertGreater(estimate_tokens(messages), IMAGE_PART_TOKENS)
+
+    def test_upload_is_analysed_once_per_image(self):
+        upload = SimpleUploadedFile('diagram.png', self._photo(), content_type='image/png')
+        data = self.client.post(reverse('api_analyze_image'), {'image': upload, 'subject': 'physics'}, **self.headers).json()
+        self.assertFalse(data['metadata']['cached'])
+        self.assertEqual((data['metadata']['width'], data['metadata']['height']), (1024, 683))
+        self.assertEqual(UsageRecord.objects.filter(endpoint='image_analysis').count(), 1)
+
+        # The camera sends the same picture as a data URL
+        data_url = 'data:image/png;base64,' + base64.b64encode(self._photo()).decode()
+        data = self.client.post(reverse('api_analyze_image'), {'image': data_url, 'subject': 'physics'},
+                                content_type='application/json', **self.headers).json()
+        self.assertTrue(data['metadata']['cached'])
+        self.assertEqual(UsageRecord.objects.filter(endpoint='image_analysis').count(), 1)
+
+    def test_free_text_subjects_make_valid_cache_keys(self):
+        upload = SimpleUploadedFile('diagram.png', self._photo((64, 64)), content_type='image/png')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            with self.settings(SINGLE_FLIGHT=dict(settings.SINGLE_FLIGHT, ENABLED=True, CACHE_ALIAS='default')):
+                response = self.client.post(reverse('api_analyze_image'),
+                                            {'image': upload, 'subject': 'forces on a ramp ' * 40}, **self.headers)
+        self.assertNotIn('fallback', response.json()['metadata'])
+
+    def test_invalid_images_are_rejected(self):
+        upload = SimpleUploadedFile('notes.png', b'not an image', content_type='image/png')
+        response = self.client.post(reverse('api_analyze_image'), {'image': upload}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('api_analyze_image'), {'subject': 'physics'}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class AvatarTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.other = User.objects.create_user('classmate')
+        cls.other_token = Token.objects.create(user=cls.other)
+
+    def setUp(self):
+        token_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.enterContext(self.settings(MEDIA_ROOT=self.media_root))
+
+    def _photo(self):
+        exif = Image.Exif()
+        exif[0x010f] = 'PhoneMaker'
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 800), 'teal').save(buffer, format='JPEG', exif=exif)
+        return SimpleUploadedFile('me.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def _upload(self, token, upload):
+        return self.client.post(reverse('api_upload_profile_picture'), {'profile_picture': upload},
+                                HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_upload_stores_square_variants_without_metadata(self):
+        data = self._upload(self.token, self._photo()).json()
+        self.assertEqual(set(data['avatar']), {'64', '128', '256'})
+        digest = UserProfile.objects.get(user=self.user).avatar_hash
+        for size in (64, 128, 256):
+            for fmt in ('webp', 'jpeg'):
+                with default_storage.open(variant_path(digest, size, fmt)) as f:
+                    image = Image.open(f)
+                    image.load()
+                self.assertEqual(image.size, (size, size))
+                self.assertNotIn('exif', image.info)
+        self.assertTrue(data['avatar']['64']['webp'].endswith(f'{digest}/64.webp'))
+
+        profile = self.client.get(reverse('api_get_profile'), HTTP_AUTHORIZATION=f'Token {self.token.key}').json()
+        self.assertEqual(profile['avatar'], data['avatar'])
+        self.assertEqual(profile['profile_picture_url'], data['avatar']['256']['jpeg'])
+
+    def test_identical_uploads_share_files(self):
+        self._upload(self.token, self._photo())
+        self._upload(self.other_token, self._photo())
+        hashes = set(UserProfile.objects.values_list('avatar_hash', flat=True))
+        self.assertEqual(len(hashes), 1)
+        directory = os.path.join(self.media_root, 'avatars', hashes.pop()[:2])
+        self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertEqual(len(os.listdir(os.path.join(directory, os.listdir(directory)[0]))), 6)
+
+    def test_non_images_are_rejected(self):
+        response = self._upload(self.token, SimpleUploadedFile('me.jpg', b'%PDF-1.4', content_type='image/jpeg'))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(UserProfile.objects.filter(user=self.user).exclude(avatar_hash='').exists())
+
+
+class SpaShellTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.index = os.path.join(directory, 'index.html')
+        self._write('<html><body>v1</body></html>')
+        self.enterContext(self.settings(SPA_INDEX_PATH=self.index))
+
+    def _write(self, html, mtime=None):
+        with open(self.index, 'w') as f:
+            f.write(html + ' ' * 2000)
+        if mtime:
+            os.utime(self.index, (mtime, mtime))
+
+    def test_shell_has_etag_and_answers_conditional_requests(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'v1', response.content)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_compressed_variant_follows_accept_encoding(self):
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'v1', gzip.decompress(response.content))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_prebuilt_variant_is_preferred(self):
+        with open(self.index + '.gz', 'wb') as f:
+            f.write(gzip.compress(b'<html>prebuilt</html>'))
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(gzip.decompress(response.content), b'<html>prebuilt</html>')
+
+    def test_shell_reloads_when_file_changes(self):
+        etag = self.client.get('/')['ETag']
+        self._write('<html><body>v2</body></html>', mtime=time.time() + 10)
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'v2', response.content)
+
+
+class SubjectCatalogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.token = Token.objects.create(user=User.objects.create_user('student'))
+        cls.python = Subject.objects.create(name='Python Programming', system_prompt='Ask about code.')
+        cls.algebra = Subject.objects.create(name='Linear Algebra', system_prompt='Ask about vectors.')
+        cls.geometry = Subject.objects.create(name='Linear Geometry', system_prompt='Ask about shapes.')
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_resolves_slugs_names_and_unambiguous_short_names(self):
+        catalog = get_catalog()
+        self.assertEqual(self.python.slug, 'python-programming')
+        self.assertEqual(catalog.resolve('python-programming').id, self.python.id)
+        self.assertEqual(catalog.resolve('Python Programming').id, self.python.id)
+        self.assertEqual(catalog.resolve('python').id, self.python.id)
+        self.assertEqual(catalog.resolve('python').prompt_hash, prompt_hash('Ask about code.'))
+        # "linear" could be either subject
+        self.assertIsNone(catalog.resolve('linear'))
+        self.assertIsNone(catalog.resolve('chemistry'))
+
+    def test_warm_catalog_serves_subjects_without_queries(self):
+        get_catalog()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_subjects'), **self.headers)
+        self.assertEqual([subject['slug'] for subject in response.json()],
+                         ['python-programming', 'linear-algebra', 'linear-geometry'])
+
+    def test_unchanged_subject_list_is_not_modified(self):
+        etag = self.client.get(reverse('api_subjects'), **self.headers)['ETag']
+        response = self.client.get(reverse('api_subjects'), HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_saving_a_subject_reloads_the_catalog(self):
+        etag = self.client.get(reverse('api_subjects'), **self.headers)['ETag']
+        self.algebra.system_prompt = 'Ask about matrices.'
+        self.algebra.description = 'Vectors and matrices'
+        self.algebra.save()
+        self.assertEqual(get_catalog().resolve('linear-algebra').system_prompt, 'Ask about matrices.')
+        response = self.client.get(reverse('api_subjects'), HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        self.geometry.delete()
+        self.assertIsNone(get_catalog().resolve('linear-geometry'))
+        self.assertEqual(get_catalog().resolve('linear').id, self.algebra.id)
+
+    def test_changes_from_other_processes_are_picked_up_on_recheck(self):
+        get_catalog()
+        # What another worker or a management command does: nothing reaches this process's cache
+        Subject.objects.filter(id=self.python.id).update(system_prompt='Ask about loops.', updated_at=timezone.now())
+        self.assertEqual(get_catalog().resolve('python').system_prompt, 'Ask about code.')
+
+        with self.settings(SUBJECT_CATALOG_RECHECK_SECONDS=0):
+            self.assertEqual(get_catalog().resolve('python').system_prompt, 'Ask about loops.')
+            catalog = get_catalog()
+            with self.assertNumQueries(1):
+                self.assertIs(get_catalog(), catalog)
+
+
+@override_settings(LLM_PROVIDERS=TEST_PROVIDERS, LLM_CHAT_PROVIDER='stub', ROLLING_SUMMARY_TURNS=0)
+class ChatTurnTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+
+    def setUp(self):
+        cache.clear()
+        reset_breakers()
+        token_cache.clear()
+        self.conversation = Conversation.objects.create(user=self.user, subject=self.subject, title='New Conversation')
+        self.url = reverse('api_chat', kwargs={'conversation_id': self.conversation.id})
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def chat(self, message):
+        return self.client.post(self.url, {'message': message}, content_type='application/json', **self.headers)
+
+    def test_turn_returns_only_the_new_messages(self):
+        first = self.chat('Why does a ball fall?').json()
+        second = self.chat('Is it gravity?').json()
+        self.assertEqual(second['title'], 'Why does a ball fall?')
+        self.assertEqual((first['version'], second['version']), (1, 2))
+        self.assertEqual([message['role'] for message in second['messages']], ['user', 'assistant'])
+        self.assertEqual(second['messages'][0]['content'], 'Is it gravity?')
+        self.assertEqual(list(self.conversation.messages.values_list('id', flat=True)),
+                         [message['id'] for message in first['messages'] + second['messages']])
+
+    def test_the_model_sees_the_new_question(self):
+        self.chat('Why does a ball fall?')
+        reply = self.conversation.messages.get(role='assistant').content
+        self.assertIn('Why does a ball fall?', reply)
+
+    def test_failed_turn_saves_nothing(self):
+        with self.settings(LLM_CHAT_PROVIDER='down'):
+            response = self.chat('Why does a ball fall?')
+        self.assertEqual(response.status_code, 500)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.messages.count(), self.conversation.version), (0, 0))
+        self.assertEqual(self.conversation.title, 'New Conversation')
+
+    def test_turn_updates_the_rollups(self):
+        self.chat('Why does a ball fall?')
+        self.chat('Is it gravity?')
+        stats = UserSubjectStats.objects.get(user=self.user, subject=self.subject)
+        self.assertEqual(stats.questions_asked, 2)
+        self.assertEqual(stats.last_message_at, self.conversation.messages.last().timestamp)
+        incremental = stats.time_spent
+        rebuild_stats([self.user.id])
+        self.assertEqual(UserSubjectStats.objects.get(user=self.user, subject=self.subject).time_spent, incremental)
+
+
+class ConversationSyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        cls.conversation = Conversation.objects.create(user=cls.user, subject=cls.subject, title='Falling')
+        for i in range(3):
+            save_turn(cls.conversation, ('user', f'Question {i}'), ('assistant', f'Answer {i}'))
+
+    def setUp(self):
+        token_cache.clear()
+        self.url = reverse('api_conversation_messages', kwargs={'conversation_id': self.conversation.id})
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def sync(self, **params):
+        headers = dict(self.headers)
+        if 'etag' in params:
+            headers['HTTP_IF_NONE_MATCH'] = params.pop('etag')
+        return self.client.get(self.url, params, **headers)
+
+    def test_returns_messages_after_the_cursor(self):
+        everything = self.sync().json()
+        self.assertEqual(everything['version'], 3)
+        self.assertEqual(len(everything['messages']), 6)
+
+        cursor = everything['messages'][3]['id']
+        delta = self.sync(after=cursor).json()
+        self.assertEqual([message['content'] for message in delta['messages']], ['Question 2', 'Answer 2'])
+        self.assertEqual(delta['cursor'], everything['cursor'])
+
+        since = self.sync(since=everything['messages'][3]['timestamp']).json()
+        self.assertEqual(since['messages'], delta['messages'])
+
+    def test_pages_long_conversations(self):
+        first = self.sync(limit=4).json()
+        self.assertTrue(first['has_more'])
+        rest = self.sync(after=first['cursor'], limit=4).json()
+        self.assertFalse(rest['has_more'])
+        self.assertEqual(len(first['messages'] + rest['messages']), 6)
+
+    def test_up_to_date_client_gets_not_modified(self):
+        response = self.sync()
+        etag = response['ETag']
+        cursor = response.json()['cursor']
+        with self.assertNumQueries(1):
+            response = self.sync(after=cursor, etag=etag)
+        self.assertEqual(response.status_code, 304)
+
+        save_turn(self.conversation, ('user', 'Question 3'), ('assistant', 'Answer 3'))
+        response = self.sync(after=cursor, etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([message['content'] for message in response.json()['messages']], ['Question 3', 'Answer 3'])
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_rejects_bad_cursors_and_other_users(self):
+        self.assertEqual(self.sync(after='latest').status_code, 400)
+        self.assertEqual(self.sync(since='yesterday').status_code, 400)
+        other = Token.objects.create(user=User.objects.create_user('someone'))
+        response = self.client.get(self.url, HTTP_AUTHORIZATION=f'Token {other.key}')
+        self.assertEqual(response.status_code, 404)
+
+
+class AdminStudentsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.token = Token.objects.create(user=User.objects.create_user('admin', date_joined=timezone.now()))
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+        now = timezone.now()
+        cls.users = {}
+        # (username, email, days since joining, conversations, questions)
+        for name, email, days, conversations, questions in [
+            ('ada', 'ada@uni.example', 30, 3, 1),
+            ('bob', 'bob@example.com', 20, 1, 5),
+            ('cyd', 'cyd@uni.example', 10, 2, 2),
+        ]:
+            user = User.objects.create_user(name, email=email, date_joined=now - timedelta(days=days))
+            cls.users[name] = user
+            for i in range(conversations):
+                conversation = Conversation.objects.create(user=user, subject=cls.subject, title=f'Session {i}')
+            for i in range(questions):
+                save_turn(conversation, ('user', f'Question {i}'), ('assistant', 'What do you think?'))
+            UserSubjectStats.objects.filter(user=user).update(last_activity=now - timedelta(days=days - 1))
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+
+    def students(self, **params):
+        response = self.client.get(reverse('api_admin_students'), params, HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def names(self, **params):
+        return [student['name'] for student in self.students(**params)['students'] if student['name'] != 'admin']
+
+    def test_pages(self):
+        first = self.students(page_size=2, sort='name')
+        self.assertEqual((first['count'], first['num_pages'], first['page']), (4, 2, 1))
+        self.assertEqual([student['name'] for student in first['students']], ['ada', 'admin'])
+        second = self.students(page_size=2, sort='name', page=2)
+        self.assertEqual([student['name'] for student in second['students']], ['bob', 'cyd'])
+        # Out of range pages fall back to the last one
+        self.assertEqual(self.students(page_size=2, sort='name', page=9)['page'], 2)
+
+    def test_unpaged_without_page_params(self):
+        # The admin dashboard asks for everyone at once
+        data = self.students()
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(len(data['students']), 4)
+        self.assertNotIn('num_pages', data)
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(self.students(page_size=0)['page_size'], 1)
+        self.assertEqual(self.students(page_size=1000)['page_size'], 200)
+        self.assertEqual(self.students(page_size='many')['page_size'], 50)
+
+    def test_search_matches_name_and_email(self):
+        self.assertEqual(self.names(search='bo'), ['bob'])
+        self.assertEqual(sorted(self.names(search='uni.example')), ['ada', 'cyd'])
+
+    def test_sort_keys(self):
+        self.assertEqual(self.names(sort='name'), ['ada', 'bob', 'cyd'])
+        self.assertEqual(self.names(sort='-name'), ['cyd', 'bob', 'ada'])
+        self.assertEqual(self.names(sort='registeredAt'), ['ada', 'bob', 'cyd'])
+        self.assertEqual(self.names(sort='-registeredAt'), ['cyd', 'bob', 'ada'])
+        self.assertEqual(self.names(sort='-lastActive'), ['cyd', 'bob', 'ada'])
+        self.assertEqual(self.names(sort='-totalSessions'), ['ada', 'cyd', 'bob'])
+        self.assertEqual(self.names(sort='-totalQuestions'), ['bob', 'cyd', 'ada'])
+        # Unknown keys sort by registration date
+        self.assertEqual(self.names(sort='shoeSize'), ['ada', 'bob', 'cyd'])
+
+    def test_new_chat_turns_invalidate_cached_pages(self):
+        before = {student['name']: student for student in self.students()['students']}
+        conversation = Conversation.objects.filter(user=self.users['ada']).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            save_turn(conversation, ('user', 'One more?'), ('assistant', 'What do you think?'))
+        after = {student['name']: student for student in self.students()['students']}
+        self.assertEqual(after['ada']['totalQuestions'], before['ada']['totalQuestions'] + 1)
+        self.assertGreater(after['ada']['lastActive'], before['ada']['lastActive'])
+
+    def test_new_conversations_invalidate_cached_pages(self):
+        self.students()
+        Conversation.objects.create(user=self.users['bob'], subject=self.subject, title='Another')
+        bob = next(student for student in self.students()['students'] if student['name'] == 'bob')
+        self.assertEqual(bob['totalSessions'], 2)
+
+
+def _sse_events(body):
+    events = []
+    for block in body.decode().split('\n\n'):
+        if block:
+            event, data = block.split('\n')
+            events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+    return events
+
+
+@override_settings(LLM_PROVIDERS=TEST_PROVIDERS, LLM_CHAT_PROVIDER='stub', ROLLING_SUMMARY_TURNS=0)
+class StreamingChatTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('student')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.subject = Subject.objects.create(name='Physics', system_prompt='Ask, never tell.')
+
+    def setUp(self):
+        cache.clear()
+        reset_breakers()
+        reset_clients()
+        token_cache.clear()
+        self.conversation = Conversation.objects.create(user=self.user, subject=self.subject, title='New Conversation')
+        self.url = reverse('api_chat', kwargs={'conversation_id': self.conversation.id})
+        self.payload = {'message': 'Why does a ball fall?', 'stream': True}
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def stream(self):
+        # The test client makes WSGI requests, which get the sync generator
+        response = self.client.post(self.url, self.payload, content_type='application/json', **self.headers)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return _sse_events(b''.join(response.streaming_content))
+
+    async def astream(self):
+        # The async client makes ASGI requests, which get the async generator
+        response = await self.async_client.post(self.url, self.payload, content_type='application/json',
+                                                headers={'Authorization': f'Token {self.token.key}'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return _sse_events(b''.join([chunk async for chunk in response.streaming_content]))
+
+    def assertCompleteTurn(self, events):
+        names = [event for event, data in events]
+        self.assertEqual(set(names[:-1]), {'token'})
+        self.assertEqual(names[-1], 'done')
+        reply = ''.join(data['content'] for event, data in events[:-1])
+        done = events[-1][1]
+        self.assertEqual([message['role'] for message in done['messages']], ['user', 'assistant'])
+        self.assertEqual(done['messages'][1]['content'], reply)
+        self.assertEqual((done['title'], done['version']), ('Why does a ball fall?', 1))
+        self.assertEqual(list(self.conversation.messages.values_list('role', 'content')),
+                         [('user', 'Why does a ball fall?'), ('assistant', reply)])
+
+    def assertPartialTurn(self, events):
+        names = [event for event, data in events]
+        self.assertEqual(names, ['token'] * 3 + ['error'])
+        error = events[3][1]
+        self.assertIn('dropped the stream', error['error'])
+        # What arrived before the failure is kept, marked partial
+        partial = ''.join(data['content'] for event, data in events[:3])
+        self.assertEqual([(message['content'], message['partial']) for message in error['messages']],
+                         [('Why does a ball fall?', False), (partial, True)])
+        self.assertEqual(list(self.conversation.messages.values_list('role', 'content', 'partial')),
+                         [('user', 'Why does a ball fall?', False), ('assistant', partial, True)])
+        self.assertEqual(get_breaker('flaky').stats()['failures'], 1)
+
+    def assertFailedTurn(self, events):
+        self.assertEqual([event for event, data in events], ['error'])
+        self.assertFalse(self.conversation.messages.exists())
+
+    def test_wsgi_stream(self):
+        self.assertCompleteTurn(self.stream())
+
+    def test_wsgi_stream_fails_midway(self):
+        with self.settings(LLM_CHAT_PROVIDER='flaky'):
+            self.assertPartialTurn(self.stream())
+
+    def test_wsgi_stream_fails_before_any_token(self):
+        with self.settings(LLM_CHAT_PROVIDER='down'):
+            self.assertFailedTurn(self.stream())
+
+    async def test_asgi_stream(self):
+        events = await self.astream()
+        await sync_to_async(self.assertCompleteTurn)(events)
+
+    async def test_asgi_stream_fails_midway(self):
+        with self.settings(LLM_CHAT_PROVIDER='flaky'):
+            events = await self.astream()
+        await sync_to_async(self.assertPartialTurn)(events)
+
+    async def test_asgi_stream_fails_before_any_token(self):
+        with self.settings(LLM_CHAT_PROVIDER='down'):
+            events = await self.astream()
+        await sync_to_async(self.assertFailedTurn)(events)
+
+    def disconnect_args(self):
+        return (self.conversation, 'Why does a ball fall?',
+                [{'role': 'user', 'content': 'Why does a ball fall?'}], 1000)
+
+    def assertDisconnectedTurn(self, first_token):
+        # The client left after the first token: the question and the
+        # partial reply are saved and the usage recorded
+        self.assertEqual(list(self.conversation.messages.values_list('role', 'content', 'partial')),
+                         [('user', 'Why does a ball fall?', False), ('assistant', first_token, True)])
+        self.assertEqual(UsageRecord.objects.get().endpoint, 'chat')
+
+    @override_settings(RATE_LIMITS=TEST_RATE_LIMITS)
+    def test_wsgi_client_disconnect_saves_the_turn(self):
+        stream = _stream_ai_response(*self.disconnect_args())
+        first = _sse_events(next(stream).encode())[0][1]['content']
+        stream.close()
+        self.assertDisconnectedTurn(first)
+
+    @override_settings(RATE_LIMITS=TEST_RATE_LIMITS)
+    async def test_asgi_client_disconnect_saves_the_turn(self):
+        stream = _astream_ai_response(*await sync_to_async(self.disconnect_args)())
+        first = _sse_events((await stream.__anext__()).encode())[0][1]['content']
+        await stream.aclose()
+        await sync_to_async(self.assertDisconnectedTurn)(first)
@@ -0,0 +1,53 @@
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import F
+from . import rollups
+from .cache_utils import bump_version
+from .models import Conversation, Message
+from .serializers import MessageSerializer
+
+# A chat turn is written in one short transaction once the reply is known:
+# the new messages in a single INSERT, the title if this is the first
+# message, and a bump of Conversation.version. Nothing is held open while
+# the model answers, which keeps SQLite's write lock brief. bulk_create
+# skips post_save, so the rollups and the admin students cache are updated
+# here.
+
+DEFAULT_TITLE = "New Conversation"
+
+
+def turn_title(user_message):
+    return user_message[:50] + "..." if len(user_message) > 50 else user_message
+
+
+def save_turn(conversation, *messages, partial=False):
+    """Saves ``messages`` ((role, content) pairs, oldest first) and returns
+    the Message objects. Updates conversation.title and .version.
+    ``partial`` marks the assistant reply as cut short."""
+    messages = [Message(conversation=conversation, role=role, content=content, partial=partial and role == 'assistant')
+                for role, content in messages]
+    updates = {'version': F('version') + 1}
+    first_question = next((message.content for message in messages if message.role == 'user'), None)
+    if conversation.title == DEFAULT_TITLE and first_question:
+        updates['title'] = conversation.title = turn_title(first_question)
+
+    with transaction.atomic():
+        messages = Message.objects.bulk_create(messages)
+        Conversation.objects.filter(pk=conversation.pk).update(**updates)
+        conversation.version = Conversation.objects.values_list('version', flat=True).get(pk=conversation.pk)
+        rollups.messages_added(conversation, messages)
+        transaction.on_commit(lambda: bump_version('admin_students'))
+    return messages
+
+
+async def asave_turn(conversation, *messages, partial=False):
+    return await sync_to_async(save_turn)(conversation, *messages, partial=partial)
+
+
+def serialize_turn(conversation, messages):
+    return {
+        'conversation_id': conversation.id,
+        'title': conversation.title,
+        'version': conversation.version,
+        'messages': MessageSerializer(messages, many=True).data,
+    }
@@ -12,7 +12,9 @@ urlpatterns = [
     path('conversations/create/', api.create_conversation, name='api_create_conversation'),
     path('conversations/<int:conversation_id>/', api.get_conversation, name='api_get_conversation'),
     path('conversations/<int:conversation_id>/chat/', api.get_ai_response, name='api_chat'),
+    path('conversations/<int:conversation_id>/messages/', api.get_conversation_messages, name='api_conversation_messages'),
     path('socratic-response/', api.socratic_response, name='api_socratic_response'),
+    path('jobs/<uuid:job_id>/', api.get_job, name='api_job_status'),
     path('profile/', api.get_profile, name='api_get_profile'),
     path('profile/upload/', api.upload_profile_picture, name='api_upload_profile_picture'),
     path('auth/oauth/', api.oauth_login, name='api_oauth_login'),
@@ -34,4 +36,5 @@ urlpatterns = [
     path('admin/students/create/', admin_api.admin_create_student, name='api_admin_create_student'),
     path('admin/students/<int:student_id>/delete/', admin_api.admin_delete_student, name='api_admin_delete_student'),
     path('admin/students/<int:student_id>/update/', admin_api.admin_update_student, name='api_admin_update_student'),
+    path('admin/metrics/', admin_api.admin_metrics, name='api_admin_metrics'),
 ]
\ No newline at end of file
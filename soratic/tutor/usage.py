@@ -0,0 +1,266 @@
+import logging
+import math
+import threading
+import time
+import uuid
+from decimal import Decimal
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse
+from .context import count_tokens, message_tokens
+from .models import UsageRecord
+
+logger = logging.getLogger(__name__)
+
+# LLM usage ledger and rate limits. Every upstream call is recorded as a
+# UsageRecord with the provider's token counts. Calls are also charged
+# against token buckets, measured in LLM tokens: one per user, so a single
+# heavy user can't use up the model for everyone, and one shared by
+# everyone, so the total stays under the provider's quota.
+
+
+class RateLimited(Exception):
+    def __init__(self, scope, retry_after):
+        super().__init__(f"{scope} rate limit exceeded, retry in {retry_after:.0f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+def rate_limited_response(error):
+    response = JsonResponse({'error': str(error)}, status=429)
+    response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
+def _refill(state, now, capacity, rate):
+    tokens, updated = state if state else (capacity, now)
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+def _take(state, now, amount, capacity, rate, force):
+    # Returns (new state, seconds to wait); a forced take may go into debt,
+    # which later requests have to wait out
+    tokens = _refill(state, now, capacity, rate)
+    needed = min(amount, capacity)
+    if not force and tokens < needed:
+        return (tokens, now), (needed - tokens) / rate
+    return (min(capacity, tokens - amount), now), 0
+
+
+class MemoryBucketStore:
+    # Exact, but per process: each worker gets its own buckets
+    blocking = False
+
+    def __init__(self, options):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, amount, capacity, rate, force=False):
+        with self._lock:
+            self._buckets[key], wait = _take(self._buckets.get(key), time.monotonic(), amount, capacity, rate, force)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheBucketStore:
+    # Buckets in a Django cache every worker shares, updated under a
+    # cache.add() lock so concurrent takes don't overwrite each other. A
+    # forced take that can't get the lock is parked in an atomic counter
+    # (debit or credit, as Memcached counters can't go negative) and folded
+    # into the bucket by the next take that does.
+    blocking = True
+    LOCK_TIMEOUT = 1
+    LOCK_ATTEMPTS = 50
+
+    def __init__(self, options):
+        self.cache = caches[options['CACHE_ALIAS']]
+
+    def _acquire(self, lock_key):
+        token = uuid.uuid4().hex
+        for attempt in range(self.LOCK_ATTEMPTS):
+            if self.cache.add(lock_key, token, self.LOCK_TIMEOUT):
+                return token
+            time.sleep(0.002)
+        return None
+
+    def _park(self, key, amount, ttl):
+        counter = f"{key}:{'debit' if amount > 0 else 'credit'}"
+        try:
+            self.cache.incr(counter, abs(amount))
+        except ValueError:
+            if not self.cache.add(counter, abs(amount), ttl):
+                self.cache.incr(counter, abs(amount))
+
+    def _parked(self, key):
+        # Takes the parked amounts out of their counters; decr rather than
+        # delete, so amounts parked meanwhile stay for the next take
+        counters = self.cache.get_many([f"{key}:debit", f"{key}:credit"])
+        for counter, value in counters.items():
+            if value:
+                self.cache.decr(counter, value)
+        return counters.get(f"{key}:debit", 0) - counters.get(f"{key}:credit", 0)
+
+    def take(self, key, amount, capacity, rate, force=False):
+        key = f"ratelimit:{key}"
+        lock_key = f"{key}:lock"
+        # Idle buckets are full again by the time they expire
+        ttl = int(capacity / rate) + 1
+        token = self._acquire(lock_key)
+        if token is None:
+            # Never touch the bucket without the lock. A take that may be
+            # refused is refused; a forced one (a refund or the settling of
+            # real usage) is parked for the next take to apply.
+            if force:
+                logger.warning("Rate limit bucket %s is busy; parked a forced take of %s", key, amount)
+                self._park(key, amount, ttl)
+                return 0
+            return self.LOCK_TIMEOUT
+        try:
+            now = time.time()
+            state = self.cache.get(key)
+            parked = self._parked(key)
+            if parked:
+                state, _ = _take(state, now, parked, capacity, rate, force=True)
+            state, wait = _take(state, now, amount, capacity, rate, force)
+            self.cache.set(key, state, ttl)
+            return wait
+        finally:
+            # Only release our own lock: it may have expired and been taken by another worker
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+
+BUCKET_STORES = {
+    'memory': MemoryBucketStore,
+    'cache': CacheBucketStore,
+}
+
+
+class RateLimiter:
+    def __init__(self, options):
+        self.enabled = options['ENABLED']
+        self.store = BUCKET_STORES[options['BACKEND']](options)
+        self.scopes = {
+            'user': (options['USER_CAPACITY'], options['USER_REFILL_PER_SECOND']),
+            'global': (options['GLOBAL_CAPACITY'], options['GLOBAL_REFILL_PER_SECOND']),
+        }
+        self._lock = threading.Lock()
+        self.counters = {'granted': 0, 'limited_user': 0, 'limited_global': 0}
+
+    def _key(self, scope, user_id):
+        return f"user:{user_id}" if scope == 'user' else 'global'
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def reserve(self, user_id, tokens, scopes=('user', 'global')):
+        """Takes ``tokens`` from each bucket in ``scopes`` or raises
+        RateLimited, giving back whatever was already taken."""
+        if not self.enabled:
+            return
+        taken = []
+        for scope in scopes:
+            capacity, rate = self.scopes[scope]
+            wait = self.store.take(self._key(scope, user_id), tokens, capacity, rate)
+            if wait:
+                for other in taken:
+                    self.store.take(self._key(other, user_id), -tokens, *self.scopes[other], force=True)
+                self._count(f"limited_{scope}")
+                raise RateLimited(scope, wait)
+            taken.append(scope)
+        self._count('granted')
+
+    def settle(self, user_id, tokens, scopes=('user', 'global')):
+        # Charges the difference between the estimate and the real usage;
+        # negative gives tokens back
+        if not self.enabled or not tokens:
+            return
+        for scope in scopes:
+            self.store.take(self._key(scope, user_id), tokens, *self.scopes[scope], force=True)
+
+    async def areserve(self, user_id, tokens, scopes=('user', 'global')):
+        if self.store.blocking:
+            return await sync_to_async(self.reserve, thread_sensitive=False)(user_id, tokens, scopes)
+        return self.reserve(user_id, tokens, scopes)
+
+    async def asettle(self, user_id, tokens, scopes=('user', 'global')):
+        if self.store.blocking:
+            return await sync_to_async(self.settle, thread_sensitive=False)(user_id, tokens, scopes)
+        return self.settle(user_id, tokens, scopes)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(settings.RATE_LIMITS)
+    return _limiter
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(sender, setting, **kwargs):
+    global _limiter
+    if setting == 'RATE_LIMITS':
+        _limiter = None
+
+
+def estimate_tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+
+def price(model, prompt_tokens, completion_tokens):
+    # LLM_PRICING maps a model to (prompt, completion) USD per 1K tokens
+    prompt_rate, completion_rate = settings.LLM_PRICING.get(model, (0, 0))
+    cost = (prompt_tokens * Decimal(str(prompt_rate)) + completion_tokens * Decimal(str(completion_rate))) / 1000
+    return cost.quantize(Decimal('0.000001'))
+
+
+def _usage_record(user_id, endpoint, model, usage, messages, reply, latency):
+    # Providers report usage on completions; fall back to our own count
+    # when they don't (e.g. streamed responses)
+    prompt_tokens = usage.prompt_tokens if usage else estimate_tokens(messages)
+    completion_tokens = usage.completion_tokens if usage else count_tokens(reply)
+    return UsageRecord(
+        user_id=user_id,
+        endpoint=endpoint,
+        model=model,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        cost=price(model, prompt_tokens, completion_tokens),
+        latency_ms=int(latency * 1000)
+    )
+
+
+def record(user_id, endpoint, model, usage, messages, reply, latency, reserved=0, scopes=('user', 'global')):
+    """Writes the ledger row for one upstream call and settles the rate
+    limit buckets against the ``reserved`` estimate. Returns the row."""
+    entry = _usage_record(user_id, endpoint, model, usage, messages, reply, latency)
+    entry.save()
+    if reserved:
+        get_rate_limiter().settle(user_id, entry.total_tokens - reserved, scopes)
+    return entry
+
+
+async def arecord(user_id, endpoint, model, usage, messages, reply, latency, reserved=0, scopes=('user', 'global')):
+    entry = _usage_record(user_id, endpoint, model, usage, messages, reply, latency)
+    await entry.asave()
+    if reserved:
+        await get_rate_limiter().asettle(user_id, entry.total_tokens - reserved, scopes)
+    return entry
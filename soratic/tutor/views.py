@@ -1,14 +1,106 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
 from django.views.generic import TemplateView
+import gzip
+import hashlib
 import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 class ReactAppView(TemplateView):
     template_name = 'index.html'
 
+class SpaShell:
+    """index.html of the React build, read once per process and again only
+    when its mtime changes. Keeps the identity, gzip and brotli encodings:
+    the .gz/.br files `whitenoise.compress` writes next to it (see
+    build.sh), or ones compressed here when those are missing."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.variants = {}
+        self._lock = threading.Lock()
+
+    def _read_variant(self, suffix, mtime):
+        try:
+            if os.stat(self.path + suffix).st_mtime >= mtime:
+                with open(self.path + suffix, 'rb') as f:
+                    return f.read()
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _load(self, mtime):
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        tag = hashlib.sha256(body).hexdigest()[:32]
+        variants = {'identity': (body, f'"{tag}"')}
+        compressed = self._read_variant('.br', mtime) or (brotli.compress(body) if brotli else None)
+        if compressed:
+            variants['br'] = (compressed, f'"{tag}-br"')
+        compressed = self._read_variant('.gz', mtime) or gzip.compress(body, mtime=0)
+        variants['gzip'] = (compressed, f'"{tag}-gzip"')
+        return variants
+
+    def get(self):
+        # One stat per request; the file is only read again after a deploy
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self.mtime:
+            with self._lock:
+                if mtime != self.mtime:
+                    self.variants = self._load(mtime)
+                    self.mtime = mtime
+        return self.variants
+
+_shells = {}
+
+def get_spa_shell():
+    path = str(settings.SPA_INDEX_PATH)
+    if path not in _shells:
+        _shells[path] = SpaShell(path)
+    return _shells[path]
+
+def _accepted_encodings(header):
+    encodings = set()
+    for item in header.split(','):
+        name, *params = [part.strip() for part in item.split(';')]
+        quality = next((param[2:] for param in params if param.startswith('q=')), '1')
+        try:
+            if float(quality) > 0:
+                encodings.add(name.lower())
+        except ValueError:
+            pass
+    return encodings
+
 def serve_react(request):
     try:
-        with open(os.path.join(os.path.dirname(__file__), '..', 'client', 'dist', 'index.html')) as f:
-            return HttpResponse(f.read())
+        variants = get_spa_shell().get()
     except FileNotFoundError:
-        return HttpResponse("React app not built. Run 'npm run build' in client directory.")
\ No newline at end of file
+        return HttpResponse("React app not built. Run 'npm run build' in client directory.")
+
+    # Any encoding's ETag identifies the same build
+    etags = {etag for body, etag in variants.values()}
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+
+    accepted = _accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    encoding = next((name for name in ('br', 'gzip') if name in variants and name in accepted), 'identity')
+    body, etag = variants[encoding]
+
+    if if_none_match.strip() == '*' or etags & {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='text/html; charset=utf-8')
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(body))
+    response['ETag'] = etag
+    response['Cache-Control'] = settings.SPA_CACHE_CONTROL
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
@@ -0,0 +1,107 @@
+import asyncio
+import base64
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import caches
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Image preparation for the vision model. Uploads are decoded, turned
+# upright, downscaled to MAX_DIMENSION and re-encoded as JPEG on a small
+# thread pool, so a 12-megapixel phone photo neither blocks the event loop
+# nor goes to the model at full size. Analyses are cached by the SHA-256 of
+# the uploaded bytes, so the same image is only decoded and sent once.
+
+
+class InvalidImage(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_ANALYSIS['DECODE_WORKERS'],
+                                           thread_name_prefix='image-decode')
+        return _executor
+
+
+def image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def prepare_image(data):
+    """Returns (jpeg_bytes, width, height) for the upload in ``data``,
+    no larger than MAX_DIMENSION on either side."""
+    options = settings.IMAGE_ANALYSIS
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > options['MAX_PIXELS']:
+            raise InvalidImage('Image is too large')
+        # draft() lets the JPEG decoder skip detail we would throw away
+        image.draft('RGB', (options['MAX_DIMENSION'], options['MAX_DIMENSION']))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((options['MAX_DIMENSION'], options['MAX_DIMENSION']), Image.LANCZOS)
+        if image.mode != 'RGB':
+            # Flatten transparency onto white, as diagrams usually expect
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+            image = background
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=options['JPEG_QUALITY'], optimize=True)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f'Could not read image: {e}')
+    return output.getvalue(), image.width, image.height
+
+
+async def aprepare_image(data):
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), prepare_image, data)
+
+
+def decode_data_url(value):
+    # The browser sends camera captures as data URLs
+    header, _, encoded = value.partition(',')
+    if not header.startswith('data:image/') or ';base64' not in header:
+        raise InvalidImage('Expected an image upload or a base64 image data URL')
+    try:
+        return base64.b64decode(encoded, validate=True)
+    except ValueError:
+        raise InvalidImage('Image data is not valid base64')
+
+
+def image_messages(system_prompt, subject, jpeg):
+    url = 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode()
+    return [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': f"A student studying {subject} shared this image. Describe briefly what "
+                                     "it shows, then ask one or two questions that help them reason about it "
+                                     "themselves. Do not solve it for them."},
+            {'type': 'image_url', 'image_url': {'url': url, 'detail': settings.IMAGE_ANALYSIS['DETAIL']}},
+        ]},
+    ]
+
+
+def _cache():
+    return caches[settings.IMAGE_ANALYSIS['CACHE_ALIAS']]
+
+
+def _cache_key(digest, subject, system_prompt):
+    # The subject is client text that also goes into the prompt, so it is
+    # part of the key, hashed to keep keys short and free of spaces
+    prompt = hashlib.sha256(f"{subject}\n{system_prompt}".encode()).hexdigest()
+    return f"image_analysis:{prompt}:{digest}"
+
+
+async def aget_analysis(digest, subject, system_prompt):
+    return await _cache().aget(_cache_key(digest, subject, system_prompt))
+
+
+async def aset_analysis(digest, subject, system_prompt, analysis):
+    await _cache().aset(_cache_key(digest, subject, system_prompt), analysis, settings.IMAGE_ANALYSIS['TTL'])